@@ -48,6 +48,9 @@ fixtures = [
 doctype_js = {
     "Sales Invoice": "tims_tevic_type_c_integration/overrides/client/sales_invoice.js"
 }
+doctype_list_js = {
+    "Sales Invoice": "tims_tevic_type_c_integration/overrides/client/sales_invoice_list.js"
+}
 # doctype_list_js = {"doctype" : "public/js/doctype_list.js"}
 # doctype_tree_js = {"doctype" : "public/js/doctype_tree.js"}
 # doctype_calendar_js = {"doctype" : "public/js/doctype_calendar.js"}
@@ -87,7 +90,8 @@ doctype_js = {
 # ------------
 
 # before_install = "tims_tevin_typec_integration.install.before_install"
-# after_install = "tims_tevin_typec_integration.install.after_install"
+after_install = "tims_tevin_typec_integration.install.after_install"
+after_migrate = "tims_tevin_typec_integration.install.after_migrate"
 
 # Uninstallation
 # ------------
@@ -148,13 +152,24 @@ doc_events = {
     # 	"on_trash": "method"
     # }
     "Sales Invoice": {
-       
-        "on_submit": "tims_tevin_typec_integration.tims_tevic_type_c_integration.overrides.server.sales_invoice.on_submit"
+        "validate": "tims_tevin_typec_integration.tims_tevic_type_c_integration.overrides.server.sales_invoice.validate",
+        "before_submit": "tims_tevin_typec_integration.tims_tevic_type_c_integration.overrides.server.sales_invoice.before_submit",
+        "on_submit": "tims_tevin_typec_integration.tims_tevic_type_c_integration.overrides.server.sales_invoice.on_submit",
+        "on_cancel": "tims_tevin_typec_integration.tims_tevic_type_c_integration.overrides.server.sales_invoice.on_cancel",
     },
     "Delivery Note": {
         "before_save": "tims_tevin_typec_integration.tims_tevic_type_c_integration.overrides.server.delivery_note.before_save"
-    }
-    
+    },
+    (
+        "Tax Category",
+        "Tax Rule",
+        "Sales Taxes and Charges Template",
+        "Item Tax Template",
+    ): {
+        "on_update": "tims_tevin_typec_integration.tims_tevic_type_c_integration.utils.cache.clear_tax_metadata_cache",
+        "on_trash": "tims_tevin_typec_integration.tims_tevic_type_c_integration.utils.cache.clear_tax_metadata_cache",
+    },
+
 }
 
 # Scheduled Tasks
@@ -162,7 +177,11 @@ doc_events = {
 
 scheduler_events = {
     "all": [
-        "tims_tevin_typec_integration.tims_tevic_type_c_integration.tasks.tasks.resend_invoices"
+        "tims_tevin_typec_integration.tims_tevic_type_c_integration.tasks.tasks.resend_invoices",
+        "tims_tevin_typec_integration.tims_tevic_type_c_integration.tasks.tasks.send_heartbeats",
+    ],
+    "hourly": [
+        "tims_tevin_typec_integration.tims_tevic_type_c_integration.utils.failures.send_failure_digest"
     ],
     "daily": [
         "tims_tevin_typec_integration.tims_tevic_type_c_integration.tasks.tasks.get_eod_records"
@@ -197,15 +216,22 @@ scheduler_events = {
 
 # ignore_links_on_delete = ["Communication", "ToDo"]
 
+# The TIMS logs of an invoice don't stop it from being deleted once cancelled
+ignore_links_on_delete = ["TIMS Outbox", "TIMS Request Log", "TIMS Failure Event"]
+
 # Request Events
 # ----------------
 # before_request = ["tims_tevin_typec_integration.utils.before_request"]
-# after_request = ["tims_tevin_typec_integration.utils.after_request"]
+after_request = [
+    "tims_tevin_typec_integration.tims_tevic_type_c_integration.utils.metrics.flush_metrics"
+]
 
 # Job Events
 # ----------
 # before_job = ["tims_tevin_typec_integration.utils.before_job"]
-# after_job = ["tims_tevin_typec_integration.utils.after_job"]
+after_job = [
+    "tims_tevin_typec_integration.tims_tevic_type_c_integration.utils.metrics.flush_metrics"
+]
 
 # User Data Protection
 # --------------------
@@ -241,6 +267,9 @@ scheduler_events = {
 # Automatically update python controller files with type annotations for this app.
 # export_python_type_annotations = True
 
-# default_log_clearing_doctypes = {
-# 	"Logging DocType Name": 30  # days to retain logs
-# }
+# Days the TIMS logs are kept for, unless changed in Log Settings
+default_log_clearing_doctypes = {
+    "TIMS Request Log": 90,
+    "TIMS Outbox": 30,
+    "TIMS Failure Event": 30,
+}
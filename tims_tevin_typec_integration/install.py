@@ -0,0 +1,32 @@
+import frappe
+from frappe.utils.fixtures import sync_fixtures
+
+APP_NAME = "tims_tevin_typec_integration"
+
+# Indexes over the app's custom fields, added after every install and migrate,
+# since core doctypes have no `on_doctype_update` of the app's to add them from
+CUSTOM_FIELD_INDEXES = {
+    "Sales Invoice": {
+        # Covers selecting a company's invoices by TIMS Status, e.g. to resend them
+        "tims_status_company_index": ["custom_tims_status", "company", "name"],
+        # Covers the End Of Day reconciliation, which reads a device's invoices of a day
+        "tims_device_posting_date_index": ["custom_tims_device", "posting_date"],
+    },
+}
+
+
+def after_install() -> None:
+    # Custom fields are only synced from fixtures after the install hooks run
+    sync_fixtures(APP_NAME)
+    add_custom_field_indexes()
+
+
+def after_migrate() -> None:
+    add_custom_field_indexes()
+
+
+def add_custom_field_indexes() -> None:
+    """Add the indexes over the app's custom fields that don't exist yet"""
+    for doctype, indexes in CUSTOM_FIELD_INDEXES.items():
+        for index_name, fields in indexes.items():
+            frappe.db.add_index(doctype, fields, index_name=index_name)
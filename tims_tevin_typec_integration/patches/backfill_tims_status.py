@@ -0,0 +1,39 @@
+import frappe
+from frappe.utils.fixtures import sync_fixtures
+
+BATCH_SIZE = 5000
+
+
+def execute() -> None:
+    """Set the TIMS Status of existing Sales Invoices from their CU Invoice Number, in batches"""
+    # Custom fields are only synced from fixtures after the patches run
+    sync_fixtures("tims_tevin_typec_integration")
+
+    last_invoice = ""
+    while True:
+        invoices = frappe.db.sql_list(
+            """
+            SELECT name
+            FROM `tabSales Invoice`
+            WHERE name > %s
+            ORDER BY name
+            LIMIT %s
+            """,
+            (last_invoice, BATCH_SIZE),
+        )
+        if not invoices:
+            break
+
+        frappe.db.sql(
+            """
+            UPDATE `tabSales Invoice`
+            SET custom_tims_status = IF(
+                    IFNULL(custom_cu_invoice_number, '') != '', 'Fiscalised', 'Pending'
+                )
+            WHERE name IN %(invoices)s
+            """,
+            {"invoices": tuple(invoices)},
+        )
+        frappe.db.commit()
+
+        last_invoice = invoices[-1]
@@ -0,0 +1,19 @@
+import frappe
+from frappe.utils.fixtures import sync_fixtures
+
+from tims_tevin_typec_integration.tims_tevic_type_c_integration.tasks.tasks import (
+    add_unsent_invoices_to_outbox,
+)
+
+
+def execute() -> None:
+    """Queue the invoices left unsent before the TIMS Outbox existed, from a background job"""
+    # The job routes invoices by custom fields only synced from fixtures after the patches run
+    sync_fixtures("tims_tevin_typec_integration")
+
+    frappe.enqueue(
+        add_unsent_invoices_to_outbox,
+        queue="long",
+        timeout=3600,
+        enqueue_after_commit=True,
+    )
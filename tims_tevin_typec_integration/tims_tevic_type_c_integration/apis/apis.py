@@ -0,0 +1,165 @@
+from werkzeug.wrappers import Response
+
+import frappe
+from frappe.utils.background_jobs import get_queue
+
+from ..tasks.tasks import fiscalise_invoices_in_bulk
+from ..utils.cache import get_active_tims_settings
+from ..utils.circuit_breaker import get_circuit
+from ..utils.health import get_device_health, get_health_history
+from ..utils.jobs import enqueue_flush_job, get_tims_queue
+from ..utils.metrics import (
+    DEFAULT_WINDOW_MINUTES,
+    get_outbox_depth,
+    get_stage_metrics,
+)
+from ..utils.metrics import get_prometheus_metrics as get_prometheus_text
+from ..utils.offline import is_replaying
+from ..utils.outbox import requeue_dead_letters
+from ..utils.rate_limit import get_send_rate
+from ..utils.reconciliation import enqueue_reconciliation
+
+# Generous upper bound for a bulk job; each batch stops early if the device is unreachable
+BULK_JOB_TIMEOUT = 3600
+
+# Heartbeats charted on TIMS Settings, two hours' worth at the default interval
+HEALTH_HISTORY_SHOWN = 120
+
+
+@frappe.whitelist()
+def fiscalise_invoices(names: str | list[str]) -> str:
+    """Fiscalise several submitted Sales Invoices from a single background job
+
+    Args:
+        names (str | list[str]): The Sales Invoices, as a list or a JSON array
+
+    Returns:
+        str: The ID of the background job
+    """
+    if isinstance(names, str):
+        names = frappe.parse_json(names)
+
+    # Only keep invoices the user is allowed to see
+    invoices = frappe.get_list(
+        "Sales Invoice",
+        filters={"name": ["in", names], "docstatus": 1},
+        pluck="name",
+    )
+    if not invoices:
+        frappe.throw("Please select submitted Sales Invoices to fiscalise")
+
+    job = frappe.enqueue(
+        fiscalise_invoices_in_bulk,
+        invoices=invoices,
+        user=frappe.session.user,
+        queue=get_tims_queue(None, fallback="long"),
+        timeout=BULK_JOB_TIMEOUT,
+    )
+
+    return job.id
+
+
+@frappe.whitelist()
+def requeue_invoices(names: str | list[str]) -> int:
+    """Give dead-lettered invoices in the TIMS Outbox a fresh set of attempts
+
+    Args:
+        names (str | list[str]): The TIMS Outbox entries, as a list or a JSON array
+
+    Returns:
+        int: The number of invoices requeued
+    """
+    frappe.only_for("System Manager")
+
+    if isinstance(names, str):
+        names = frappe.parse_json(names)
+
+    requeued = requeue_dead_letters(names)
+
+    for setting in get_active_tims_settings():
+        if setting.name in requeued:
+            enqueue_flush_job(setting, after_commit=True)
+
+    return sum(len(invoices) for invoices in requeued.values())
+
+
+@frappe.whitelist()
+def get_device_status(setting: str) -> dict:
+    """Return the queue depth, circuit breaker state, send rate, offline backlog replay,
+    and last heartbeats of a TIMS device
+
+    Args:
+        setting (str): The TIMS Settings of the device
+
+    Returns:
+        dict: The device's status
+    """
+    frappe.only_for("System Manager")
+
+    setting = frappe.get_cached_doc("TIMS Settings", setting)
+    queue = get_tims_queue(setting)
+    circuit = get_circuit(setting.server_address)
+
+    return {
+        "queue": queue,
+        "queue_depth": get_queue(queue).count,
+        "circuit_state": circuit.state,
+        "consecutive_failures": circuit.failures,
+        "circuit_opened_at": circuit.opened_at,
+        "send_rate": get_send_rate(setting.server_address),
+        "replaying_backlog": is_replaying(setting),
+        "health": get_device_health(setting.server_address),
+        "health_history": get_health_history(setting.server_address, HEALTH_HISTORY_SHOWN),
+    }
+
+
+@frappe.whitelist()
+def reconcile_eod_record(name: str) -> None:
+    """Reconcile an End Of Day summary against ERPNext again, from a background job
+
+    Args:
+        name (str): The End Of Day TIMS Records entry
+    """
+    frappe.only_for("System Manager")
+
+    if not frappe.db.get_value("End Of Day TIMS Records", name, "device"):
+        frappe.throw("Only End Of Day summaries fetched from a device can be reconciled")
+
+    enqueue_reconciliation(name)
+
+
+@frappe.whitelist()
+def get_metrics(window_minutes: int = DEFAULT_WINDOW_MINUTES) -> dict:
+    """Return the p50/p95/p99 of each fiscalisation stage, success rate, outbox
+    depth and send rate of every active TIMS device, for the TIMS Dashboard
+
+    Args:
+        window_minutes (int, optional): Minutes the percentiles are computed over. Defaults to 60.
+
+    Returns:
+        dict: The metrics, keyed by TIMS Settings
+    """
+    frappe.only_for("System Manager")
+
+    stages = get_stage_metrics(int(window_minutes))
+    depth = get_outbox_depth()
+
+    devices = {}
+    for setting in get_active_tims_settings():
+        metrics = stages.get(setting.name) or frappe._dict(
+            stages={}, outcomes={}, success_rate=None
+        )
+        metrics.outbox = depth.get(setting.name, {})
+        metrics.send_rate = get_send_rate(setting.server_address)
+        devices[setting.name] = metrics
+
+    return devices
+
+
+@frappe.whitelist()
+def get_prometheus_metrics() -> Response:
+    """Return the TIMS metrics in the Prometheus text exposition format, to be scraped
+    with the API key and secret of a System Manager"""
+    frappe.only_for("System Manager")
+
+    return Response(get_prometheus_text(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,113 @@
+"""Load test of the async device client against a local stub device.
+
+Keeps a fixed number of invoices in flight at each concurrency level, with the
+async client and with the pooled session on a thread pool, and reports the
+latency percentiles and throughput of each, e.g.
+
+    bench --site test_site execute \\
+        tims_tevin_typec_integration.tims_tevic_type_c_integration.benchmarks.async_client.run \\
+        --kwargs "{'count': 2000, 'latency': 0.05, 'concurrency_levels': [1, 8, 32, 128]}"
+"""
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ..utils.async_client import AsyncTIMSClient
+from ..utils.device import get_session
+from ..utils.payload import dumps_payload
+from .stub_device import get_server_address, start_stub_device
+
+DEFAULT_CONCURRENCY_LEVELS = (1, 8, 32, 128)
+
+
+def run(
+    count: int = 2000,
+    latency: float = 0.05,
+    concurrency_levels: list[int] | tuple[int, ...] = DEFAULT_CONCURRENCY_LEVELS,
+) -> dict:
+    """Send `count` invoices per client at each concurrency level.
+
+    Args:
+        count (int, optional): Number of invoices sent per run. Defaults to 2000.
+        latency (float, optional): Seconds the stub device takes per invoice. Defaults to 0.05.
+        concurrency_levels (list[int], optional): Invoices in flight at a time, per run. Defaults to 1, 8, 32 and 128.
+
+    Returns:
+        dict: p50, p95 and p99 latency in milliseconds, and throughput, per client and concurrency level
+    """
+    device = start_stub_device(latency=latency)
+    url = f"{get_server_address(device)}/invoice"
+
+    results = {}
+    try:
+        for concurrency in concurrency_levels:
+            results[concurrency] = {
+                "async": summarise(
+                    *asyncio.run(time_async_requests(url, count, concurrency)), count
+                ),
+                "threaded": summarise(
+                    *time_threaded_requests(url, count, concurrency), count
+                ),
+            }
+            print(concurrency, results[concurrency])
+    finally:
+        device.shutdown()
+
+    return results
+
+
+async def time_async_requests(url: str, count: int, concurrency: int) -> tuple[list, float]:
+    latencies, invoices = [], iter(range(count))
+
+    async with AsyncTIMSClient(max_concurrency=concurrency) as client:
+
+        async def send_invoices() -> None:
+            for index in invoices:
+                start = time.perf_counter()
+                await client.post(url, get_payload(index))
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(send_invoices() for _ in range(concurrency)))
+
+    return latencies, time.perf_counter() - start
+
+
+def time_threaded_requests(url: str, count: int, concurrency: int) -> tuple[list, float]:
+    session = get_session(url, pool_size=concurrency)
+
+    def send(index: int) -> float:
+        start = time.perf_counter()
+        session.post(
+            url=url,
+            data=get_payload(index),
+            headers={"Content-Type": "application/json"},
+            timeout=(5, 60),
+        ).raise_for_status()
+
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(send, range(count)))
+
+    return latencies, time.perf_counter() - start
+
+
+def get_payload(index: int) -> bytes:
+    return dumps_payload({"Invoice": {"TraderSystemInvoiceNumber": str(index)}})
+
+
+def summarise(latencies: list[float], elapsed: float, count: int) -> dict:
+    latencies = sorted(latencies)
+
+    def percentile(p: float) -> float:
+        return round(latencies[max(int(len(latencies) * p) - 1, 0)] * 1000, 3)
+
+    return {
+        "p50_ms": percentile(0.50),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+        "requests_per_second": round(count / elapsed, 2),
+    }
@@ -0,0 +1,72 @@
+"""Benchmark of per-request latency with and without the pooled device session.
+
+Sends a burst of invoices to a local stub device, once with a bare
+`requests.post` per invoice and once through the pooled session, e.g.
+
+    bench --site test_site execute \\
+        tims_tevin_typec_integration.tims_tevic_type_c_integration.benchmarks.device_session.run \\
+        --kwargs "{'count': 2000, 'concurrency': 8}"
+"""
+
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from ..utils.device import get_session
+from .stub_device import get_server_address, start_stub_device
+
+
+def run(count: int = 2000, concurrency: int = 8, latency: float = 0) -> dict:
+    """Time `count` invoice submissions with each strategy.
+
+    Args:
+        count (int, optional): Number of invoices sent per strategy. Defaults to 2000.
+        concurrency (int, optional): Invoices in flight at a time. Defaults to 8.
+        latency (float, optional): Seconds the stub device takes per invoice. Defaults to 0.
+
+    Returns:
+        dict: Mean and p95 latency in milliseconds, and throughput, per strategy
+    """
+    device = start_stub_device(latency=latency)
+    server_address = get_server_address(device)
+    url = f"{server_address}/invoice"
+
+    try:
+        results = {
+            "unpooled": time_requests(requests.post, url, count, concurrency),
+            "pooled": time_requests(
+                get_session(server_address, pool_size=concurrency).post,
+                url,
+                count,
+                concurrency,
+            ),
+        }
+    finally:
+        device.shutdown()
+
+    print(results)
+
+    return results
+
+
+def time_requests(post, url: str, count: int, concurrency: int) -> dict:
+    def send(index: int) -> float:
+        payload = {"Invoice": {"TraderSystemInvoiceNumber": str(index)}}
+
+        start = time.perf_counter()
+        post(url=url, json=payload, timeout=(5, 60)).raise_for_status()
+
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = sorted(executor.map(send, range(count)))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 3),
+        "requests_per_second": round(count / elapsed, 2),
+    }
@@ -0,0 +1,96 @@
+"""Benchmark of the time it takes to import the Sales Invoice hooks, which every
+web and background worker loads on the first invoice it saves, and the device
+layer the sending jobs load.
+
+Each module is imported in a fresh interpreter with `python -X importtime`,
+after Frappe, so only the time the app adds is counted, e.g.
+
+    bench --site test_site execute \\
+        tims_tevin_typec_integration.tims_tevic_type_c_integration.benchmarks.import_time.run
+"""
+
+import statistics
+import subprocess
+import sys
+
+import frappe
+
+HOOK_MODULE = "tims_tevin_typec_integration.tims_tevic_type_c_integration.overrides.server.sales_invoice"
+SETTINGS_MODULE = "tims_tevin_typec_integration.tims_tevic_type_c_integration.doctype.tims_settings.tims_settings"
+DEVICE_MODULE = "tims_tevin_typec_integration.tims_tevic_type_c_integration.utils.fiscalisation"
+
+# Only needed to send invoices and render their QR codes
+DEVICE_LIBRARIES = ("requests", "urllib3", "httpx", "qrcode", "PIL")
+
+
+def run(repeat: int = 5) -> dict:
+    """Time importing the hook and device layers.
+
+    Args:
+        repeat (int, optional): Number of fresh interpreters each module is imported in. Defaults to 5.
+
+    Returns:
+        dict: Median cumulative milliseconds, modules imported, and device libraries loaded, per layer
+    """
+    results = {}
+    for layer, module in (("hooks", HOOK_MODULE), ("device", DEVICE_MODULE)):
+        timings = [get_import_times(module) for _ in range(repeat)]
+
+        results[layer] = {
+            "cumulative_ms": round(
+                statistics.median(timing.cumulative_us for timing in timings) / 1000, 3
+            ),
+            "modules": len(timings[0].modules),
+            "device_libraries": get_device_libraries(timings[0].modules),
+        }
+
+    print(results)
+
+    return results
+
+
+def get_import_times(module: str) -> frappe._dict:
+    """Import the module after Frappe in a fresh interpreter, with `-X importtime`
+
+    Returns:
+        frappe._dict: The `cumulative_us` microseconds the import took, and the
+            cumulative microseconds of each of the `modules` it loaded, by name
+    """
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import frappe; import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    # Imports are listed as they finish, each top-level one after those it
+    # triggered, so those after Frappe's own line are the module's
+    lines = [line for line in process.stderr.splitlines() if line.startswith("import time:")]
+    entries = [parse_line(line) for line in lines[1:]]
+    start = next(index for index, entry in enumerate(entries) if entry[0] == "frappe") + 1
+
+    modules, cumulative_us = {}, 0
+    for name, cumulative, is_top_level in entries[start:]:
+        modules[name] = cumulative
+        if is_top_level:
+            cumulative_us += cumulative
+
+    return frappe._dict(cumulative_us=cumulative_us, modules=modules)
+
+
+def parse_line(line: str) -> tuple[str, int, bool]:
+    """Return the name, cumulative microseconds, and whether it was imported at the
+    top level, of a line like `import time:       120 |        450 |   requests`"""
+    _, cumulative, name = line.split("|")
+    # One space after the separator, then two more per level of nesting
+    name = name[1:].rstrip()
+
+    return name.strip(), int(cumulative), not name.startswith(" ")
+
+
+def get_device_libraries(modules: dict[str, int]) -> list[str]:
+    return [
+        library
+        for library in DEVICE_LIBRARIES
+        if any(name == library or name.startswith(f"{library}.") for name in modules)
+    ]
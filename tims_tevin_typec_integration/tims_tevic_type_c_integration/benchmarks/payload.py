@@ -0,0 +1,63 @@
+"""Benchmark of building and serialising payloads of invoices with many lines, e.g.
+
+    bench --site test_site execute \\
+        tims_tevin_typec_integration.tims_tevic_type_c_integration.benchmarks.payload.run
+"""
+
+import json
+import time
+
+from ..utils.payload import build_item_details, dumps_payload
+
+LINE_COUNTS = (10, 1000, 10000)
+DISTINCT_ITEMS = 50
+
+
+def run(repeat: int = 20) -> dict:
+    """Time building the ItemDetails, with and without aggregation, and serialising the payload.
+
+    Args:
+        repeat (int, optional): Number of times each step is repeated. Defaults to 20.
+
+    Returns:
+        dict: Milliseconds per step, per number of invoice lines
+    """
+    results = {}
+    for line_count in LINE_COUNTS:
+        items = get_item_columns(line_count)
+
+        item_details = build_item_details(items, 16, "")
+        payload = {"Invoice": {"ItemDetails": item_details}}
+
+        results[f"{line_count} lines"] = {
+            "build_ms": time_ms(lambda: build_item_details(items, 16, ""), repeat),
+            "build_aggregated_ms": time_ms(
+                lambda: build_item_details(items, 16, "", aggregate=True), repeat
+            ),
+            "stdlib_json_ms": time_ms(lambda: json.dumps(payload), repeat),
+            "dumps_payload_ms": time_ms(lambda: dumps_payload(payload), repeat),
+        }
+
+    print(results)
+
+    return results
+
+
+def get_item_columns(line_count: int) -> dict[str, list]:
+    return {
+        "item_code": [f"ITEM-{index % DISTINCT_ITEMS:04d}" for index in range(line_count)],
+        "description": [f"Item {index % DISTINCT_ITEMS}" for index in range(line_count)],
+        "net_amount": [100.0 * (index % 7 + 1) for index in range(line_count)],
+        "net_rate": [100.0] * line_count,
+        "qty": [float(index % 7 + 1) for index in range(line_count)],
+        "custom_tax_rate": [16.0] * line_count,
+        "custom_tax_amount": [None] * line_count,
+    }
+
+
+def time_ms(function, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+
+    return round((time.perf_counter() - start) / repeat * 1000, 3)
@@ -0,0 +1,66 @@
+"""Micro-benchmark of QR Code rendering per output mode.
+
+Reports the render time and the bytes stored on the invoice for each format,
+and the time taken when the render is served from the cache, e.g.
+
+    bench --site test_site execute \\
+        tims_tevin_typec_integration.tims_tevic_type_c_integration.benchmarks.qr_code.run
+"""
+
+import time
+
+from ..utils.qr_code import add_file_info, bytes_to_base64_string, get_qr_code_bytes
+
+MODES = {
+    "PNG, box 10, M": ("PNG", 10, "M"),
+    "PNG, box 4, L": ("PNG", 4, "L"),
+    "SVG, box 10, M": ("SVG", 10, "M"),
+    "SVG, box 4, L": ("SVG", 4, "L"),
+}
+
+
+def run(count: int = 500) -> dict:
+    """Render `count` distinct QR Codes in each mode.
+
+    Args:
+        count (int, optional): Number of QR Codes rendered per mode. Defaults to 500.
+
+    Returns:
+        dict: Mean render time, cached render time and mean bytes stored, per mode
+    """
+    payloads = [
+        f"https://itax.kra.go.ke/KRA-Portal/invoiceChk.htm?actionCode=loadPage&invoiceNo={index:019d}"
+        for index in range(count)
+    ]
+
+    results = {}
+    for mode, (format, box_size, error_correction) in MODES.items():
+        get_qr_code_bytes.cache_clear()
+
+        start = time.perf_counter()
+        images = [
+            get_qr_code_bytes(payload, format, box_size, error_correction)
+            for payload in payloads
+        ]
+        render_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for payload in payloads:
+            get_qr_code_bytes(payload, format, box_size, error_correction)
+        cached_time = time.perf_counter() - start
+
+        stored = sum(
+            len(add_file_info(bytes_to_base64_string(image), format))
+            for image in images
+        )
+
+        results[mode] = {
+            "render_ms": round(render_time / count * 1000, 3),
+            "cached_render_ms": round(cached_time / count * 1000, 4),
+            "image_bytes": sum(map(len, images)) // count,
+            "inline_bytes_stored": stored // count,
+        }
+
+    print(results)
+
+    return results
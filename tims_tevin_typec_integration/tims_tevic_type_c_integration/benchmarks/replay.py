@@ -0,0 +1,265 @@
+"""Replay of captured invoice traffic against the stub device.
+
+Reads the payloads of invoices sent before, from the TIMS Request Logs or the
+Integration Requests that preceded them, and replays them at their original
+pace sped up `speed` times: each is queued in the TIMS Outbox and committed as
+on submit, then drained, sent to a local stub device and written back as by
+the dispatch jobs.
+
+Only the pipeline from the outbox on is covered. The captured payloads are
+queued as they are, so the submit hooks' routing, validation and payload
+build aren't run or timed; `benchmarks.submit` times those.
+
+The payloads are renumbered to `INV-REPLAY-…` invoices, so no existing Sales
+Invoice is written to. Run it on a throwaway site without other TIMS Settings
+for the company, e.g.
+
+    bench --site test_site execute \\
+        tims_tevin_typec_integration.tims_tevic_type_c_integration.benchmarks.replay.run \\
+        --kwargs "{'company': 'Navari Ltd', 'count': 5000, 'speed': 10, 'error_rate': 0.01}"
+"""
+
+import json
+import statistics
+import time
+
+import frappe
+
+from ..tasks.tasks import drain_outbox
+from ..utils.failures import FAILURE_EVENT_DOCTYPE
+from ..utils.idempotency import FISCALISED_KEY
+from ..utils.outbox import OUTBOX_DOCTYPE, add_to_outbox
+from ..utils.request_log import REQUEST_LOG_DOCTYPE, decompress_payload
+from .stub_device import get_server_address, start_stub_device
+
+REPLAY_PREFIX = "REPLAY-"
+POLL_INTERVAL = 0.1  # seconds
+SOURCES = (REQUEST_LOG_DOCTYPE, "Integration Request")
+
+# Session counters of the statements the replay ran
+WRITE_STATUS_VARIABLES = ("Com_insert", "Com_update", "Com_delete")
+
+
+def run(
+    company: str,
+    count: int = 1000,
+    speed: float = 1,
+    source: str = REQUEST_LOG_DOCTYPE,
+    latency: float = 0.05,
+    jitter: float = 0,
+    error_rate: float = 0,
+    reject_rate: float = 0,
+    concurrency: int = 8,
+) -> dict:
+    """Replay up to `count` captured invoices, `speed` times faster than they were sent.
+
+    Args:
+        company (str): The company of the stub device's TIMS Settings
+        count (int, optional): Number of captured invoices to replay. Defaults to 1000.
+        speed (float, optional): How many times faster than captured to replay them. Defaults to 1.
+        source (str, optional): TIMS Request Log or Integration Request. Defaults to TIMS Request Log.
+        latency (float, optional): Seconds the stub device takes per request. Defaults to 0.05.
+        jitter (float, optional): Up to this many more seconds, at random, per request. Defaults to 0.
+        error_rate (float, optional): Share of the invoices the device fails with HTTP 500. Defaults to 0.
+        reject_rate (float, optional): Share of the invoices the device rejects with HTTP 400. Defaults to 0.
+        concurrency (int, optional): Invoices in flight at a time. Defaults to 8.
+
+    Returns:
+        dict: Throughput, submit-to-fiscalised latency percentiles, and database write rates
+    """
+    captured = get_captured_payloads(source, count)
+    if not captured:
+        frappe.throw(f"No captured invoice payloads found in {source}")
+
+    device = start_stub_device(
+        latency=latency, jitter=jitter, error_rate=error_rate, reject_rate=reject_rate
+    )
+    setting = None
+
+    try:
+        setting = frappe.get_doc(
+            {
+                "doctype": "TIMS Settings",
+                "company": company,
+                "server_address": get_server_address(device),
+                "sender_id": "REPLAY",
+                "is_active": 1,
+                "resend_concurrency": concurrency,
+                # Invoices the device fails or rejects are given up on, rather
+                # than retried for hours
+                "max_attempts": 1,
+                "resend_backoff_minutes": 0.01,
+            }
+        ).insert(ignore_permissions=True)
+        frappe.db.commit()
+
+        result = replay(captured, frappe._dict(setting.as_dict()), speed)
+
+    finally:
+        device.shutdown()
+        remove_replayed_invoices()
+        if setting:
+            frappe.delete_doc("TIMS Settings", setting.name, force=True, ignore_permissions=True)
+        frappe.db.commit()
+
+    result.update(
+        invoices=len(captured),
+        speed=speed,
+        device_requests=device.invoices_received,
+    )
+    print(result)
+
+    return result
+
+
+def replay(captured: list[tuple[float, dict]], setting: frappe._dict, speed: float) -> dict:
+    """Queue each payload once its time comes, and drain the outbox in between"""
+    first = captured[0][0]
+    schedule = [
+        (
+            (sent_at - first) / speed,
+            f"INV-{REPLAY_PREFIX}{index:06d}",
+            renumber_payload(payload, index, setting.sender_id),
+        )
+        for index, (sent_at, payload) in enumerate(captured, 1)
+    ]
+
+    submitted_at, latencies = {}, []
+    writes_before = get_write_counts()
+    start = time.perf_counter()
+
+    next_index = 0
+    while next_index < len(schedule) or len(latencies) + get_given_up_count() < len(schedule):
+        elapsed = time.perf_counter() - start
+
+        due = {}
+        while next_index < len(schedule) and schedule[next_index][0] <= elapsed:
+            _, invoice, payload = schedule[next_index]
+            due[invoice] = payload
+            next_index += 1
+
+        if due:
+            # One commit per invoice, as each is submitted on its own
+            for invoice, payload in due.items():
+                add_to_outbox({invoice: payload}, setting)
+                frappe.db.commit()
+                submitted_at[invoice] = time.perf_counter()
+
+        batches = drain_outbox(setting)
+        if batches:
+            fiscalised_at = time.perf_counter()
+            for invoice in get_newly_sent(submitted_at):
+                latencies.append(fiscalised_at - submitted_at.pop(invoice))
+
+        elif not due:
+            next_due = schedule[next_index][0] - elapsed if next_index < len(schedule) else 0
+            time.sleep(max(min(next_due, 1), POLL_INTERVAL))
+
+    elapsed = time.perf_counter() - start
+    writes = {
+        variable: round((count - writes_before[variable]) / elapsed, 2)
+        for variable, count in get_write_counts().items()
+    }
+    latencies.sort()
+
+    return frappe._dict(
+        seconds=round(elapsed, 2),
+        fiscalised=len(latencies),
+        invoices_per_second=round(len(latencies) / elapsed, 2),
+        latency_p50_ms=get_percentile_ms(latencies, 0.50),
+        latency_p95_ms=get_percentile_ms(latencies, 0.95),
+        latency_p99_ms=get_percentile_ms(latencies, 0.99),
+        latency_mean_ms=round(statistics.fmean(latencies) * 1000, 3) if latencies else None,
+        writes_per_second=writes,
+    )
+
+
+def get_captured_payloads(source: str, count: int) -> list[tuple[float, dict]]:
+    """Return when each captured invoice was sent, as a timestamp, and its payload, oldest first"""
+    if source not in SOURCES:
+        frappe.throw(f"Payloads can only be replayed from {' or '.join(SOURCES)}")
+
+    if source == REQUEST_LOG_DOCTYPE:
+        rows = frappe.get_all(
+            REQUEST_LOG_DOCTYPE,
+            filters={"payload": ["is", "set"]},
+            fields=["last_attempt as sent_at", "payload"],
+            order_by="last_attempt asc",
+            limit=count,
+        )
+        payloads = [(row.sent_at, decompress_payload(row.payload)) for row in rows]
+
+    else:
+        rows = frappe.get_all(
+            "Integration Request",
+            filters={"url": ["like", "%/invoice"], "data": ["is", "set"]},
+            fields=["creation as sent_at", "data"],
+            order_by="creation asc",
+            limit=count,
+        )
+        payloads = [(row.sent_at, row.data) for row in rows]
+
+    captured = []
+    for sent_at, payload in payloads:
+        payload = json.loads(payload)
+        if isinstance(payload, dict) and "Invoice" in payload:
+            captured.append((sent_at.timestamp(), payload))
+
+    return captured
+
+
+def renumber_payload(payload: dict, index: int, sender_id: str) -> dict:
+    payload = json.loads(json.dumps(payload))
+    payload["Invoice"]["TraderSystemInvoiceNumber"] = f"{REPLAY_PREFIX}{index:06d}"
+    payload["Invoice"]["SenderId"] = sender_id
+
+    return payload
+
+
+def get_newly_sent(submitted_at: dict[str, float]) -> list[str]:
+    if not submitted_at:
+        return []
+
+    return frappe.get_all(
+        OUTBOX_DOCTYPE,
+        filters={"name": ["in", list(submitted_at)], "status": "Sent"},
+        pluck="name",
+    )
+
+
+def get_given_up_count() -> int:
+    return frappe.db.count(
+        OUTBOX_DOCTYPE,
+        {"name": ["like", f"INV-{REPLAY_PREFIX}%"], "status": "Dead Letter"},
+    )
+
+
+def get_write_counts() -> dict[str, int]:
+    return {
+        variable: int(value)
+        for variable, value in frappe.db.sql(
+            "SHOW SESSION STATUS WHERE Variable_name IN %(variables)s",
+            {"variables": WRITE_STATUS_VARIABLES},
+        )
+    }
+
+
+def get_percentile_ms(latencies: list[float], quantile: float) -> float | None:
+    if not latencies:
+        return None
+
+    return round(latencies[max(int(len(latencies) * quantile) - 1, 0)] * 1000, 3)
+
+
+def remove_replayed_invoices() -> None:
+    pattern = f"INV-{REPLAY_PREFIX}%"
+
+    for doctype, field in (
+        (OUTBOX_DOCTYPE, "name"),
+        (REQUEST_LOG_DOCTYPE, "name"),
+        (FAILURE_EVENT_DOCTYPE, "sales_invoice"),
+    ):
+        frappe.db.delete(doctype, {field: ["like", pattern]})
+
+    # Otherwise the next replay's invoices are recorded from these responses
+    frappe.cache().delete_keys(f"{FISCALISED_KEY}:{REPLAY_PREFIX}")
@@ -0,0 +1,148 @@
+"""Benchmark of draining a backlog of unfiscalised invoices with the resend job.
+
+Seeds copies of an existing Sales Invoice as pending invoices, attaches one or
+more local stub devices to their company and queues the invoices in the TIMS
+Outbox, then runs the resend job until the backlog is drained. The resend job enqueues a job per device, so it needs at
+least as many workers on the TIMS queue as there are devices. Run it on a
+throwaway site without other TIMS Settings for the company, e.g.
+
+    bench --site test_site execute \\
+        tims_tevin_typec_integration.tims_tevic_type_c_integration.benchmarks.resend_invoices.run \\
+        --kwargs "{'template_invoice': 'INV-0001', 'count': 50000, 'devices': 4}"
+"""
+
+import time
+
+import frappe
+
+from ..tasks.tasks import add_unsent_invoices_to_outbox, resend_invoices
+from .stub_device import get_server_address, start_stub_device
+
+BENCHMARK_PREFIX = "INV-BENCH-"
+POLL_INTERVAL = 1  # seconds
+
+
+def run(
+    template_invoice: str,
+    count: int = 50000,
+    devices: int = 1,
+    limit: int = 500,
+    concurrency: int = 8,
+    latency: float = 0.02,
+) -> dict:
+    """Seed `count` pending invoices and time how long the resend job takes to drain them.
+
+    Args:
+        template_invoice (str): A submitted Sales Invoice the pending invoices are copied from
+        count (int, optional): Number of pending invoices to seed. Defaults to 50000.
+        devices (int, optional): Number of stub devices the invoices are routed across. Defaults to 1.
+        limit (int, optional): Invoices sent per resend run of each device. Defaults to 500.
+        concurrency (int, optional): Invoices in flight at a time per device. Defaults to 8.
+        latency (float, optional): Seconds the stub devices take per invoice. Defaults to 0.02.
+
+    Returns:
+        dict: The drain time, number of resend runs and throughput
+    """
+    template = frappe.get_doc("Sales Invoice", template_invoice)
+    stub_devices = [start_stub_device(latency=latency) for _ in range(devices)]
+    settings = []
+
+    try:
+        seed_pending_invoices(template, count)
+
+        for index, device in enumerate(stub_devices):
+            settings.append(
+                frappe.get_doc(
+                    {
+                        "doctype": "TIMS Settings",
+                        "company": template.company,
+                        "server_address": get_server_address(device),
+                        "sender_id": f"BENCHMARK-{index}",
+                        "is_active": 1,
+                        "resend_limit": limit,
+                        "resend_concurrency": concurrency,
+                    }
+                ).insert(ignore_permissions=True)
+            )
+        frappe.db.commit()
+        add_unsent_invoices_to_outbox(template.company)
+
+        runs, start = 0, time.perf_counter()
+        while has_pending_seeded_invoices():
+            resend_invoices()
+            runs += 1
+            time.sleep(POLL_INTERVAL)
+
+        elapsed = time.perf_counter() - start
+
+    finally:
+        for device in stub_devices:
+            device.shutdown()
+
+        remove_seeded_invoices()
+        for setting in settings:
+            frappe.delete_doc("TIMS Settings", setting.name, force=True, ignore_permissions=True)
+        frappe.db.commit()
+
+    result = {
+        "invoices": count,
+        "devices": devices,
+        "resend_runs": runs,
+        "drain_seconds": round(elapsed, 2),
+        "invoices_per_second": round(count / elapsed, 2),
+    }
+    print(result)
+
+    return result
+
+
+def seed_pending_invoices(template, count: int) -> None:
+    """Insert `count` submitted copies of the template without a CU Invoice Number or QR Code"""
+    for index in range(1, count + 1):
+        invoice = frappe.copy_doc(template)
+        invoice.name = f"{BENCHMARK_PREFIX}{index:06d}"
+        invoice.docstatus = 1
+        invoice.custom_cu_invoice_number = None
+        invoice.custom_qr_code = None
+        invoice.custom_tims_status = "Pending"
+        invoice.custom_tims_device = None
+
+        invoice.db_insert()
+        for child in invoice.get_all_children():
+            child.parent = invoice.name
+            child.docstatus = 1
+            child.db_insert()
+
+        if index % 1000 == 0:
+            frappe.db.commit()
+
+    frappe.db.commit()
+
+
+def has_pending_seeded_invoices() -> bool:
+    return bool(
+        frappe.db.exists(
+            "Sales Invoice",
+            {
+                "name": ["like", f"{BENCHMARK_PREFIX}%"],
+                "custom_cu_invoice_number": ["is", "not set"],
+            },
+        )
+    )
+
+
+def remove_seeded_invoices() -> None:
+    pattern = f"{BENCHMARK_PREFIX}%"
+
+    for child_table in (
+        "Sales Invoice Item",
+        "Sales Taxes and Charges",
+        "Sales Invoice Payment",
+    ):
+        frappe.db.delete(child_table, {"parent": ["like", pattern]})
+
+    frappe.db.delete("TIMS Outbox", {"sales_invoice": ["like", pattern]})
+    frappe.db.delete("TIMS Request Log", {"sales_invoice": ["like", pattern]})
+    frappe.db.delete("TIMS Failure Event", {"sales_invoice": ["like", pattern]})
+    frappe.db.delete("Sales Invoice", {"name": ["like", pattern]})
+    frappe.db.commit()
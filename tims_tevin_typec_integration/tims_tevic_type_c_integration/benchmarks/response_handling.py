@@ -0,0 +1,138 @@
+"""Benchmark of the database time spent recording each fiscalised invoice.
+
+Seeds copies of an existing Sales Invoice with their TIMS Request Logs, then
+records a device response for each and commits, once with the previous
+document-based handling and once with `handle_tims_response`, e.g.
+
+    bench --site test_site execute \\
+        tims_tevin_typec_integration.tims_tevic_type_c_integration.benchmarks.response_handling.run \\
+        --kwargs "{'template_invoice': 'INV-0001', 'count': 1000}"
+"""
+
+import json
+import statistics
+import time
+
+import requests
+
+import frappe
+
+from ..utils.fiscalisation import handle_tims_response
+from ..utils.qr_code import get_qr_code_value
+from ..utils.request_log import REQUEST_LOG_DOCTYPE, log_tims_requests
+from .resend_invoices import (
+    BENCHMARK_PREFIX,
+    remove_seeded_invoices,
+    seed_pending_invoices,
+)
+
+
+def run(template_invoice: str, count: int = 1000) -> dict:
+    """Time recording the responses of `count` invoices with each handler.
+
+    Args:
+        template_invoice (str): A submitted Sales Invoice the invoices are copied from
+        count (int, optional): Number of invoices recorded per handler. Defaults to 1000.
+
+    Returns:
+        dict: Mean, p95 and p99 milliseconds per fiscalised invoice, commit included, per handler
+    """
+    template = frappe.get_doc("Sales Invoice", template_invoice)
+    setting = frappe._dict(company=template.company, server_address="http://127.0.0.1/api")
+
+    results = {}
+    try:
+        for name, handler in (
+            ("before", handle_tims_response_with_documents),
+            ("after", handle_tims_response),
+        ):
+            seed_pending_invoices(template, count)
+            results[name] = time_responses(handler, setting)
+            remove_seeded_invoices()
+    finally:
+        remove_seeded_invoices()
+
+    print(results)
+
+    return results
+
+
+def time_responses(handler, setting: frappe._dict) -> dict:
+    invoices = frappe.get_all(
+        "Sales Invoice",
+        filters={"name": ["like", f"{BENCHMARK_PREFIX}%"]},
+        pluck="name",
+        order_by="name",
+    )
+    log_tims_requests(
+        f"{setting.server_address}/invoice",
+        {invoice: {"Invoice": {}} for invoice in invoices},
+        setting.name,
+    )
+    frappe.db.commit()
+
+    latencies = []
+    for index, invoice in enumerate(invoices):
+        response = get_device_response(invoice, index)
+
+        start = time.perf_counter()
+        handler(response, setting)
+        frappe.db.commit()
+        latencies.append(time.perf_counter() - start)
+
+    latencies.sort()
+
+    return {
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 3),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 3),
+    }
+
+
+def get_device_response(invoice: str, index: int) -> requests.Response:
+    control_code = f"{index:019d}"
+
+    response = requests.Response()
+    response.status_code = 200
+    response._content = json.dumps(
+        {
+            "Invoice": {
+                "TraderSystemInvoiceNumber": invoice.removeprefix("INV-"),
+                "ControlCode": control_code,
+                "QRCode": f"https://itax.kra.go.ke/KRA-Portal/invoiceChk.htm?actionCode=loadPage&invoiceNo={control_code}",
+            }
+        }
+    ).encode()
+
+    return response
+
+
+def handle_tims_response_with_documents(
+    response: requests.Response, setting: frappe._dict
+) -> None:
+    """The response handling this benchmark compares against, which parsed the
+    response three times and loaded and saved the whole request log"""
+    try:
+        invoice_info = response.json()["Invoice"]
+    except KeyError:
+        invoice_info = response.json()["Existing"]
+    invoice = invoice_info["TraderSystemInvoiceNumber"]
+
+    doc = frappe.get_doc(REQUEST_LOG_DOCTYPE, f"INV-{invoice}", for_update=True)
+    doc.status = "Completed"
+    doc.error = str(None)
+    doc.output = str(response.json())
+    doc.save(ignore_permissions=True)
+
+    qr_code = get_qr_code_value(invoice_info["QRCode"], f"INV-{invoice}", setting)
+
+    frappe.db.set_value(
+        "Sales Invoice",
+        f"INV-{invoice}",
+        {
+            "custom_cu_invoice_number": invoice_info["ControlCode"],
+            "custom_qr_code": qr_code,
+            "custom_tims_status": "Fiscalised",
+        },
+        update_modified=True,
+    )
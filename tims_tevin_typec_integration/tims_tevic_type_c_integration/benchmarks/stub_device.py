@@ -0,0 +1,206 @@
+"""A stand-in for the Tevin Type-C device, used by the benchmarks and tests.
+
+It fiscalises invoices posted to `/api/invoice`, answering an invoice it has
+already fiscalised with the `Existing` one like the device does, and serves
+End Of Day summaries of the invoices it received on `/api/eod/<sender_id>`,
+for the day given as the `date` query parameter or else the latest one.
+
+Each request can be delayed to mimic the device's processing time, and a
+share of the invoices can be failed with a server error, or rejected.
+"""
+
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+QR_CODE_URL = "https://itax.kra.go.ke/KRA-Portal/invoiceChk.htm?actionCode=loadPage&invoiceNo={}"
+
+
+class StubDeviceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.delay()
+
+        if urlsplit(self.path).path != "/api/invoice":
+            self.send_json({"Message": "Not Found"}, 404)
+            return
+
+        outcome = random.random()
+        if outcome < self.server.error_rate:
+            self.send_json({"Message": "Internal Server Error"}, 500)
+            return
+
+        if outcome < self.server.error_rate + self.server.reject_rate:
+            self.send_json({"Message": "Invalid invoice"}, 400)
+            return
+
+        key, invoice = self.server.fiscalise(json.loads(body)["Invoice"])
+        self.send_json({key: invoice})
+
+    def do_GET(self) -> None:
+        self.server.delay()
+
+        url = urlsplit(self.path)
+        if not url.path.startswith("/api/eod/"):
+            # Answers the circuit breaker's probes
+            self.send_json({"Message": "Not Found"}, 404)
+            return
+
+        day = parse_qs(url.query).get("date", [None])[0]
+        summary = self.server.get_eod_summary(url.path.rsplit("/", 1)[-1], day)
+        if not summary:
+            self.send_json({"Message": "No summary for the day"}, 404)
+            return
+
+        self.send_json(summary)
+
+    def send_json(self, data: dict, status: int = 200) -> None:
+        body = json.dumps(data).encode()
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+class StubDevice(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        port: int = 0,
+        latency: float = 0,
+        jitter: float = 0,
+        error_rate: float = 0,
+        reject_rate: float = 0,
+    ):
+        super().__init__(("127.0.0.1", port), StubDeviceHandler)
+
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.reject_rate = reject_rate
+
+        self.lock = threading.Lock()
+        self.invoices_received = 0
+        # TraderSystemInvoiceNumber > the fiscalised invoice
+        self.invoices: dict[str, dict] = {}
+        # (SenderId, day) > the day's invoice numbers and totals
+        self.days: dict[tuple[str, str], dict] = {}
+
+    def delay(self) -> None:
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+
+    def fiscalise(self, invoice: dict) -> tuple[str, dict]:
+        """Fiscalise the invoice, unless it already was
+
+        Returns:
+            tuple[str, dict]: `Invoice` and the fiscalised invoice, or `Existing`
+                and the one fiscalised before
+        """
+        number = invoice["TraderSystemInvoiceNumber"]
+
+        with self.lock:
+            self.invoices_received += 1
+
+            if number in self.invoices:
+                return "Existing", self.invoices[number]
+
+            control_code = f"{len(self.invoices) + 1:019d}"
+            self.invoices[number] = {
+                "TraderSystemInvoiceNumber": number,
+                "ControlCode": control_code,
+                "QRCode": QR_CODE_URL.format(control_code),
+            }
+            self.add_to_day(invoice)
+
+            return "Invoice", self.invoices[number]
+
+    def add_to_day(self, invoice: dict) -> None:
+        key = (invoice.get("SenderId"), str(invoice.get("InvoiceTimestamp", ""))[:10])
+        day = self.days.setdefault(
+            key, {"numbers": [], "invoice_amount": 0, "taxable_amount": 0, "tax_amount": 0}
+        )
+
+        day["numbers"].append(invoice["TraderSystemInvoiceNumber"])
+        day["invoice_amount"] += invoice.get("TotalInvoiceAmount") or 0
+        day["taxable_amount"] += invoice.get("TotalTaxableAmount") or 0
+        day["tax_amount"] += invoice.get("TotalTaxAmount") or 0
+
+    def get_eod_summary(self, sender_id: str, day: str | None = None) -> dict | None:
+        """Return the End Of Day summary of the sender's invoices of the day, or its latest day"""
+        with self.lock:
+            sender_days = sorted(
+                date for sender, date in self.days if sender == sender_id
+            )
+            if not sender_days:
+                return None
+
+            day = day or sender_days[-1]
+            totals = self.days.get((sender_id, day))
+            if not totals:
+                return None
+
+            numbers = sorted(
+                int(number) for number in totals["numbers"] if str(number).isdigit()
+            )
+
+            return {
+                "EODId": f"{sender_id}-{day}",
+                "DateOfEODSummary": day,
+                "EODTransmissionTimestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "NumberOfFirstInvoice": numbers[0] if numbers else 0,
+                "NumberOfLastInvoice": numbers[-1] if numbers else 0,
+                "TotalInvoiceAmountOfTheDay": round(totals["invoice_amount"], 2),
+                "TotalTaxableAmountOfTheDay": round(totals["taxable_amount"], 2),
+                "TotalTaxAmountOfTheDay": round(totals["tax_amount"], 2),
+                "NumberOfInvoicesSentOfTheDay": len(totals["numbers"]),
+            }
+
+
+def start_stub_device(
+    latency: float = 0,
+    port: int = 0,
+    jitter: float = 0,
+    error_rate: float = 0,
+    reject_rate: float = 0,
+) -> StubDevice:
+    """Start the stub device on a background thread.
+
+    Args:
+        latency (float, optional): Seconds the device takes to answer each request. Defaults to 0.
+        port (int, optional): Port to listen on. Defaults to 0, i.e. any free port.
+        jitter (float, optional): Up to this many more seconds, at random, per request. Defaults to 0.
+        error_rate (float, optional): Share of the invoices answered with HTTP 500. Defaults to 0.
+        reject_rate (float, optional): Share of the invoices answered with HTTP 400. Defaults to 0.
+
+    Returns:
+        StubDevice: The running server. Its address is `server.server_address`
+    """
+    server = StubDevice(
+        port=port,
+        latency=latency,
+        jitter=jitter,
+        error_rate=error_rate,
+        reject_rate=reject_rate,
+    )
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+def get_server_address(server: ThreadingHTTPServer) -> str:
+    """Return the stub device's address in the format stored on TIMS Settings"""
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}/api"
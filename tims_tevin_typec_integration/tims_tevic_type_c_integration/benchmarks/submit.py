@@ -0,0 +1,87 @@
+"""Benchmark of the wall time of submitting a Sales Invoice, with its payload
+built on submit and with it built in the background.
+
+Attaches a TIMS Settings record to the template's company, then submits drafts
+copied from the template in each mode. Every submission is rolled back, so
+nothing is left behind. Run it on a throwaway site without other TIMS Settings
+for the company, e.g.
+
+    bench --site test_site execute \\
+        tims_tevin_typec_integration.tims_tevic_type_c_integration.benchmarks.submit.run \\
+        --kwargs "{'template_invoice': 'INV-0001', 'count': 200}"
+"""
+
+import statistics
+import time
+
+import frappe
+
+from ..utils.cache import clear_tims_settings_cache
+
+SAVEPOINT = "tims_submit_benchmark"
+
+
+def run(template_invoice: str, count: int = 200) -> dict:
+    """Time submitting `count` copies of an invoice in each mode.
+
+    Args:
+        template_invoice (str): A Sales Invoice the submitted drafts are copied from
+        count (int, optional): Number of invoices submitted per mode. Defaults to 200.
+
+    Returns:
+        dict: Mean, p95 and p99 milliseconds per submit, per mode
+    """
+    template = frappe.get_doc("Sales Invoice", template_invoice)
+
+    results = {}
+    try:
+        setting = frappe.get_doc(
+            {
+                "doctype": "TIMS Settings",
+                "company": template.company,
+                "server_address": "http://127.0.0.1/api",
+                "sender_id": "BENCHMARK",
+                "is_active": 1,
+            }
+        ).insert(ignore_permissions=True)
+
+        for mode, in_background in (("on_submit", 0), ("in_background", 1)):
+            frappe.db.set_value(
+                "TIMS Settings", setting.name, "build_payloads_in_background", in_background
+            )
+            clear_tims_settings_cache()
+
+            results[mode] = time_submits(template, count)
+
+    finally:
+        # Nothing is committed, so the setting and every invoice are discarded
+        frappe.db.rollback()
+        clear_tims_settings_cache()
+
+    print(results)
+
+    return results
+
+
+def time_submits(template, count: int) -> dict:
+    latencies = []
+    for _ in range(count):
+        frappe.db.savepoint(SAVEPOINT)
+
+        invoice = frappe.copy_doc(template)
+        invoice.docstatus = 0
+        invoice.insert(ignore_permissions=True)
+
+        start = time.perf_counter()
+        invoice.submit()
+        latencies.append(time.perf_counter() - start)
+
+        frappe.db.rollback(save_point=SAVEPOINT)
+
+    latencies.sort()
+
+    return {
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 3),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 3),
+    }
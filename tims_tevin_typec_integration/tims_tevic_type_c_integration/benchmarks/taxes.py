@@ -0,0 +1,81 @@
+"""Benchmark of setting the line taxes of documents with many lines, as done on
+every save of a Delivery Note, e.g.
+
+    bench --site test_site execute \\
+        tims_tevin_typec_integration.tims_tevic_type_c_integration.benchmarks.taxes.run \\
+        --kwargs "{'taxes_and_charges': 'Kenya Tax - NL', 'item_tax_template': 'Exempt - NL'}"
+"""
+
+import frappe
+from frappe.model.document import Document
+
+from ..utils.taxes import set_line_taxes
+from .payload import time_ms
+
+LINE_COUNTS = (10, 1000, 5000)
+
+
+def run(
+    taxes_and_charges: str,
+    item_tax_template: str | None = None,
+    repeat: int = 20,
+) -> dict:
+    """Time setting the line taxes of in-memory Delivery Notes, the way it was
+    done before and with `set_line_taxes`.
+
+    Args:
+        taxes_and_charges (str): The Sales Taxes and Charges Template of the documents
+        item_tax_template (str | None, optional): An Item Tax Template set on every tenth line. Defaults to None.
+        repeat (int, optional): Number of times each document is processed. Defaults to 20.
+
+    Returns:
+        dict: Milliseconds per save, per number of lines
+    """
+    results = {}
+    for line_count in LINE_COUNTS:
+        doc = get_delivery_note(line_count, taxes_and_charges, item_tax_template)
+
+        results[f"{line_count} lines"] = {
+            "before_ms": time_ms(lambda: calculate_tax_with_documents(doc), repeat),
+            "after_ms": time_ms(lambda: set_line_taxes(doc), repeat),
+        }
+
+    print(results)
+
+    return results
+
+
+def get_delivery_note(
+    line_count: int, taxes_and_charges: str, item_tax_template: str | None
+) -> Document:
+    doc = frappe.new_doc("Delivery Note")
+    doc.taxes_and_charges = taxes_and_charges
+
+    for row in frappe.get_doc("Sales Taxes and Charges Template", taxes_and_charges).taxes:
+        doc.append("taxes", {"account_head": row.account_head, "rate": row.rate})
+
+    for index in range(line_count):
+        doc.append(
+            "items",
+            {
+                "item_code": f"ITEM-{index % 50:04d}",
+                "net_amount": 100.0 * (index % 7 + 1),
+                "item_tax_template": item_tax_template if index % 10 == 0 else None,
+            },
+        )
+
+    return doc
+
+
+def calculate_tax_with_documents(doc: Document) -> None:
+    """The line taxes as previously set, loading the template on every save"""
+    tax_template = frappe.get_doc("Sales Taxes and Charges Template", doc.taxes_and_charges)
+    tax_rate = tax_template.taxes[0].rate if tax_template.taxes else None
+
+    for item in doc.items:
+        tax = 0
+        if tax_rate:
+            tax = item.net_amount * tax_rate / 100
+        item.custom_tax_amount = tax
+        item.custom_tax_rate = tax_rate
+
@@ -1,8 +1,24 @@
 // Copyright (c) 2024, Navari Ltd and contributors
 // For license information, please see license.txt
 
-// frappe.ui.form.on("End Of Day TIMS Records", {
-// 	refresh(frm) {
+frappe.ui.form.on("End Of Day TIMS Records", {
+	refresh(frm) {
+		if (!frm.doc.device) {
+			return;
+		}
 
-// 	},
-// });
+		frm.add_custom_button(__("Reconcile"), () => {
+			frappe.call({
+				method:
+					"tims_tevin_typec_integration.tims_tevic_type_c_integration.apis.apis.reconcile_eod_record",
+				args: { name: frm.doc.name },
+				callback: () => {
+					frappe.show_alert({
+						message: __("Reconciling against ERPNext in the background"),
+						indicator: "blue",
+					});
+				},
+			});
+		});
+	},
+});
@@ -1,9 +1,21 @@
 # Copyright (c) 2024, Navari Ltd and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
 
 
 class EndOfDayTIMSRecords(Document):
 	pass
+
+
+def on_doctype_update() -> None:
+	# Covers looking up the last summary of each device, to backfill the days since
+	frappe.db.add_index("End Of Day TIMS Records", ["device", "date_of_summary"])
+	# Devices number their summaries independently, so an EOD ID is only
+	# unique per device
+	frappe.db.add_unique(
+		"End Of Day TIMS Records",
+		["device", "end_of_day_id"],
+		constraint_name="unique_device_end_of_day_id",
+	)
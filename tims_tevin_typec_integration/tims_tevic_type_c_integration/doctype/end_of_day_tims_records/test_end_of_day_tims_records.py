@@ -1,9 +1,105 @@
 # Copyright (c) 2024, Navari Ltd and Contributors
 # See license.txt
 
-# import frappe
+import requests
+
+import frappe
 from frappe.tests.utils import FrappeTestCase
 
+from ...benchmarks.stub_device import get_server_address, start_stub_device
+from ...utils.end_of_day import fetch_eod_summaries
+
 
 class TestEndOfDayTIMSRecords(FrappeTestCase):
-	pass
+	def setUp(self) -> None:
+		self.device = start_stub_device()
+		self.setting = frappe._dict(
+			name="_Test TIMS Device",
+			server_address=get_server_address(self.device),
+			sender_id="_TEST",
+			max_retries=0,
+		)
+
+	def tearDown(self) -> None:
+		self.device.shutdown()
+		self.device.server_close()
+
+	def send_invoice(
+		self, number: str, amount: float, setting: frappe._dict | None = None
+	) -> None:
+		setting = setting or self.setting
+		requests.post(
+			f"{setting.server_address}/invoice",
+			json={
+				"Invoice": {
+					"SenderId": setting.sender_id,
+					"TraderSystemInvoiceNumber": number,
+					"InvoiceTimestamp": "2026-01-15T10:00:00",
+					"TotalInvoiceAmount": amount,
+					"TotalTaxableAmount": amount / 1.16,
+					"TotalTaxAmount": amount - amount / 1.16,
+				}
+			},
+			timeout=5,
+		).raise_for_status()
+
+	def test_summary_is_fetched_and_updated(self) -> None:
+		self.send_invoice("1001", 116)
+		self.send_invoice("1002", 232)
+
+		(record,) = fetch_eod_summaries([self.setting], backfill=False)
+		summary = frappe.db.get_value(
+			"End Of Day TIMS Records",
+			record,
+			["device", "first_invoice_number", "last_invoice_number", "total_invoice_amount"],
+			as_dict=True,
+		)
+
+		self.assertEqual(summary.device, self.setting.name)
+		self.assertEqual((summary.first_invoice_number, summary.last_invoice_number), (1001, 1002))
+		self.assertEqual(summary.total_invoice_amount, 348)
+
+		# Fetched again, the same summary is updated instead of failing
+		self.send_invoice("1003", 116)
+		self.assertEqual(fetch_eod_summaries([self.setting], backfill=False), [record])
+		self.assertEqual(
+			frappe.db.get_value("End Of Day TIMS Records", record, "last_invoice_number"), 1003
+		)
+
+	def test_devices_with_the_same_eod_id_keep_their_own_summary(self) -> None:
+		other_device = start_stub_device()
+		self.addCleanup(other_device.server_close)
+		self.addCleanup(other_device.shutdown)
+		# The stub devices number their summaries by sender and day alike
+		other_setting = frappe._dict(
+			self.setting,
+			name="_Test TIMS Device 2",
+			server_address=get_server_address(other_device),
+		)
+
+		self.send_invoice("1001", 116)
+		self.send_invoice("1002", 232, other_setting)
+
+		records = fetch_eod_summaries([self.setting, other_setting], backfill=False)
+		summaries = frappe.get_all(
+			"End Of Day TIMS Records",
+			filters={"name": ["in", records]},
+			fields=["device", "end_of_day_id", "total_invoice_amount"],
+			order_by="device",
+		)
+
+		self.assertEqual(len(set(records)), 2)
+		self.assertEqual(summaries[0].end_of_day_id, summaries[1].end_of_day_id)
+		self.assertEqual(
+			[(summary.device, summary.total_invoice_amount) for summary in summaries],
+			[(self.setting.name, 116), (other_setting.name, 232)],
+		)
+
+	def test_unreachable_device_is_recorded_as_a_failure(self) -> None:
+		self.device.shutdown()
+		self.device.server_close()
+
+		self.assertEqual(fetch_eod_summaries([self.setting], backfill=False), [])
+		self.assertTrue(
+			frappe.db.exists("TIMS Failure Event", {"device": self.setting.name})
+		)
@@ -0,0 +1,20 @@
+# Copyright (c) 2026, Navari Ltd and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+from ...utils.failures import FAILURE_EVENT_DOCTYPE
+from ...utils.request_log import clear_old_rows
+
+
+class TIMSFailureEvent(Document):
+	@staticmethod
+	def clear_old_logs(days: int = 30) -> None:
+		# Events are kept until they're in a digest
+		clear_old_rows(FAILURE_EVENT_DOCTYPE, days, {"digested": 1})
+
+
+def on_doctype_update() -> None:
+	# Covers the digest's queries, which only read the events not digested yet
+	frappe.db.add_index("TIMS Failure Event", ["digested", "creation"])
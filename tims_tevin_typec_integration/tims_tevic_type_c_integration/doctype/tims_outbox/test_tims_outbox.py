@@ -0,0 +1,213 @@
+# Copyright (c) 2026, Navari Ltd and Contributors
+# See license.txt
+
+import json
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_to_date, now_datetime
+
+from ...tasks.tasks import settle_duplicate_rows
+from ...utils.idempotency import (
+	FISCALISED_KEY,
+	IN_FLIGHT_KEY,
+	acquire_invoice_locks,
+	get_invoice_number,
+	release_invoice_locks,
+)
+from ...utils.outbox import (
+	CLAIM_TIMEOUT_MINUTES,
+	OUTBOX_DOCTYPE,
+	add_to_outbox,
+	claim_outbox,
+	get_backoff_minutes,
+	record_outbox_results,
+)
+
+INVOICE_PREFIX = "INV-TIMSTEST"
+
+
+class TestTIMSOutbox(FrappeTestCase):
+	def setUp(self) -> None:
+		self.setting = frappe._dict(
+			name="_Test TIMS Device", company="_Test Company", max_attempts=3
+		)
+		self.invoice_count = 0
+		self.addCleanup(self.remove_test_rows)
+
+	def remove_test_rows(self) -> None:
+		cache = frappe.cache()
+		for invoice_number in range(1, self.invoice_count + 1):
+			number = get_invoice_number(f"{INVOICE_PREFIX}{invoice_number:04d}")
+			cache.delete_value([f"{IN_FLIGHT_KEY}:{number}", f"{FISCALISED_KEY}:{number}"])
+
+		frappe.db.delete(OUTBOX_DOCTYPE, {"device": self.setting.name})
+		frappe.db.delete("Sales Invoice", {"name": ["like", f"{INVOICE_PREFIX}%"]})
+		frappe.db.commit()
+
+	def queue_invoices(self, count: int, docstatus: int = 1) -> list[str]:
+		"""Insert bare Sales Invoices of the docstatus, and queue them in the device's outbox"""
+		invoices = []
+		for _ in range(count):
+			self.invoice_count += 1
+			invoice = f"{INVOICE_PREFIX}{self.invoice_count:04d}"
+
+			frappe.get_doc(
+				{
+					"doctype": "Sales Invoice",
+					"name": invoice,
+					"company": self.setting.company,
+					"customer": "_Test Customer",
+					"docstatus": docstatus,
+				}
+			).db_insert()
+			invoices.append(invoice)
+
+		add_to_outbox(dict.fromkeys(invoices), self.setting)
+
+		return invoices
+
+	def record_failure(self, invoice: str, attempts: int, reached_device: bool = True) -> list[str]:
+		return record_outbox_results(
+			[
+				frappe._dict(
+					invoice=invoice,
+					outbox=invoice,
+					attempts=attempts,
+					outcome="Failed",
+					error="500 Internal Server Error",
+					reached_device=reached_device,
+				)
+			],
+			self.setting,
+		)
+
+	def get_row(self, invoice: str) -> frappe._dict:
+		return frappe.db.get_value(
+			OUTBOX_DOCTYPE,
+			invoice,
+			["status", "attempts", "next_retry_at", "last_error"],
+			as_dict=True,
+		)
+
+	def test_backoff_doubles_up_to_its_cap(self) -> None:
+		setting = frappe._dict(resend_backoff_minutes=2, max_resend_backoff_minutes=10)
+
+		self.assertEqual(
+			[get_backoff_minutes(attempts, setting) for attempts in range(1, 6)],
+			[2, 4, 8, 10, 10],
+		)
+		self.assertEqual(get_backoff_minutes(1, frappe._dict()), 1)
+		self.assertEqual(get_backoff_minutes(20, frappe._dict()), 360)
+
+	def test_rejected_invoice_is_dead_lettered_after_max_attempts(self) -> None:
+		(invoice,) = self.queue_invoices(1)
+
+		self.assertEqual(self.record_failure(invoice, attempts=1), [])
+		row = self.get_row(invoice)
+		self.assertEqual((row.status, row.attempts), ("Queued", 2))
+		# Retried after the backoff of its second attempt
+		self.assertGreater(row.next_retry_at, add_to_date(now_datetime(), minutes=1))
+
+		self.assertEqual(self.record_failure(invoice, attempts=2), [invoice])
+		row = self.get_row(invoice)
+		self.assertEqual((row.status, row.attempts), ("Dead Letter", 3))
+
+	def test_connection_errors_dont_count_as_attempts(self) -> None:
+		(invoice,) = self.queue_invoices(1)
+		frappe.db.set_value(OUTBOX_DOCTYPE, invoice, "attempts", 2, update_modified=False)
+
+		# The last attempt before dead-lettering, had it reached the device
+		self.assertEqual(self.record_failure(invoice, attempts=2, reached_device=False), [])
+
+		row = self.get_row(invoice)
+		self.assertEqual((row.status, row.attempts), ("Queued", 2))
+		self.assertEqual(row.last_error, "500 Internal Server Error")
+
+	def test_claim_removes_invoices_no_longer_submitted(self) -> None:
+		submitted = self.queue_invoices(2)
+		(cancelled,) = self.queue_invoices(1, docstatus=2)
+		submitted += self.queue_invoices(1)
+
+		rows = claim_outbox(self.setting, limit=10)
+
+		# Claimed in the order they were queued
+		self.assertEqual([row.sales_invoice for row in rows], submitted)
+		self.assertFalse(frappe.db.exists(OUTBOX_DOCTYPE, cancelled))
+		self.assertEqual(
+			{self.get_row(invoice).status for invoice in submitted}, {"Sending"}
+		)
+		self.assertEqual(claim_outbox(self.setting, limit=10), [])
+
+	def test_expired_claim_is_claimed_again(self) -> None:
+		(invoice,) = self.queue_invoices(1)
+
+		self.assertEqual(len(claim_outbox(self.setting)), 1)
+		self.assertEqual(claim_outbox(self.setting), [])
+
+		# Its worker is assumed lost once the claim expires
+		frappe.db.set_value(
+			OUTBOX_DOCTYPE,
+			invoice,
+			"claimed_at",
+			add_to_date(now_datetime(), minutes=-CLAIM_TIMEOUT_MINUTES - 1),
+			update_modified=False,
+		)
+
+		self.assertEqual(
+			[row.sales_invoice for row in claim_outbox(self.setting)], [invoice]
+		)
+
+	def test_invoice_locks_are_only_released_by_their_holder(self) -> None:
+		invoices = self.queue_invoices(2)
+
+		self.assertEqual(acquire_invoice_locks(invoices, "first"), set(invoices))
+		self.assertEqual(acquire_invoice_locks(invoices, "second"), set())
+
+		# Another job's token leaves the locks in place
+		release_invoice_locks(invoices, "second")
+		self.assertEqual(acquire_invoice_locks(invoices, "second"), set())
+
+		release_invoice_locks(invoices, "first")
+		self.assertEqual(acquire_invoice_locks(invoices, "second"), set(invoices))
+
+	def test_second_drainer_defers_then_reuses_the_response(self) -> None:
+		(invoice,) = self.queue_invoices(1)
+		rows = claim_outbox(self.setting)
+		# Nothing listens there, so any call to the device would fail
+		setting = frappe._dict(self.setting, server_address="http://127.0.0.1:9/api")
+
+		acquire_invoice_locks([invoice], "first")
+
+		# A second job with the same invoice, e.g. once its claim expired
+		to_send, settled = settle_duplicate_rows(
+			rows, acquire_invoice_locks([invoice], "second"), setting
+		)
+		self.assertEqual(to_send, [])
+		self.assertEqual([request.outcome for request in settled], ["Deferred"])
+
+		output = json.dumps(
+			{
+				"Invoice": {
+					"TraderSystemInvoiceNumber": get_invoice_number(invoice),
+					"ControlCode": "KRAMW0000000000000001",
+					"QRCode": "https://itax.kra.go.ke/KRA-Portal/invoiceChk.htm",
+				}
+			}
+		)
+		release_invoice_locks([invoice], "first", {invoice: output})
+
+		# Sent again, it's recorded from the first job's response instead
+		to_send, settled = settle_duplicate_rows(
+			rows, acquire_invoice_locks([invoice], "third"), setting
+		)
+		self.assertEqual(to_send, [])
+		self.assertEqual([request.outcome for request in settled], ["Completed"])
+		self.assertEqual(
+			frappe.db.get_value(
+				"Sales Invoice",
+				invoice,
+				["custom_tims_status", "custom_cu_invoice_number"],
+			),
+			("Fiscalised", "KRAMW0000000000000001"),
+		)
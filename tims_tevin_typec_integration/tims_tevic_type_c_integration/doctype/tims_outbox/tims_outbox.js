@@ -0,0 +1,8 @@
+// Copyright (c) 2026, Navari Ltd and contributors
+// For license information, please see license.txt
+
+// frappe.ui.form.on("TIMS Outbox", {
+// 	refresh(frm) {
+
+// 	},
+// });
@@ -0,0 +1,22 @@
+# Copyright (c) 2026, Navari Ltd and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+from ...utils.outbox import OUTBOX_DOCTYPE
+from ...utils.request_log import clear_old_rows
+
+
+class TIMSOutbox(Document):
+	@staticmethod
+	def clear_old_logs(days: int = 30) -> None:
+		# Queued and dead-lettered invoices are kept until sent
+		clear_old_rows(OUTBOX_DOCTYPE, days, {"status": "Sent"})
+
+
+def on_doctype_update() -> None:
+	# Cover the dispatchers' claim query, which scans a device's due rows in
+	# the order they were queued
+	frappe.db.add_index("TIMS Outbox", ["device", "status", "next_retry_at"])
+	frappe.db.add_index("TIMS Outbox", ["device", "status", "creation"])
@@ -0,0 +1,34 @@
+// Copyright (c) 2026, Navari Ltd and contributors
+// For license information, please see license.txt
+
+frappe.listview_settings["TIMS Outbox"] = {
+  get_indicator(doc) {
+    const colors = {
+      Queued: "orange",
+      Sending: "blue",
+      Sent: "green",
+      "Dead Letter": "red",
+    };
+
+    return [__(doc.status), colors[doc.status], `status,=,${doc.status}`];
+  },
+
+  onload(listview) {
+    listview.page.add_actions_menu_item(__("Requeue"), () => {
+      const names = listview.get_checked_items(true);
+
+      frappe.call({
+        method:
+          "tims_tevin_typec_integration.tims_tevic_type_c_integration.apis.apis.requeue_invoices",
+        args: { names: names },
+        callback: (r) => {
+          frappe.show_alert({
+            message: __("Requeued {0} dead-lettered invoices", [r.message]),
+            indicator: "green",
+          });
+          listview.refresh();
+        },
+      });
+    });
+  },
+};
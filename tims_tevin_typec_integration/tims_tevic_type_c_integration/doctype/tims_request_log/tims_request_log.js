@@ -0,0 +1,12 @@
+// Copyright (c) 2026, Navari Ltd and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on("TIMS Request Log", {
+	refresh(frm) {
+		const payload = frm.doc.__onload && frm.doc.__onload.payload;
+
+		frm.get_field("payload_preview").$wrapper.html(
+			payload ? `<pre>${frappe.utils.escape_html(payload)}</pre>` : ""
+		);
+	},
+});
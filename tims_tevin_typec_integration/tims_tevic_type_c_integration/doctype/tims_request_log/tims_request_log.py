@@ -0,0 +1,19 @@
+# Copyright (c) 2026, Navari Ltd and contributors
+# For license information, please see license.txt
+
+from frappe.model.document import Document
+
+from ...utils.request_log import (
+	REQUEST_LOG_DOCTYPE,
+	clear_old_rows,
+	decompress_payload,
+)
+
+
+class TIMSRequestLog(Document):
+	def onload(self) -> None:
+		self.set_onload("payload", decompress_payload(self.payload))
+
+	@staticmethod
+	def clear_old_logs(days: int = 30) -> None:
+		clear_old_rows(REQUEST_LOG_DOCTYPE, days)
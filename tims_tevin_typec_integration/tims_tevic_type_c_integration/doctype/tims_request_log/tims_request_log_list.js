@@ -0,0 +1,15 @@
+// Copyright (c) 2026, Navari Ltd and contributors
+// For license information, please see license.txt
+
+frappe.listview_settings["TIMS Request Log"] = {
+  get_indicator(doc) {
+    const colors = {
+      Queued: "orange",
+      Completed: "green",
+      Failed: "red",
+      Cancelled: "grey",
+    };
+
+    return [__(doc.status), colors[doc.status], `status,=,${doc.status}`];
+  },
+};
@@ -1,9 +1,197 @@
 # Copyright (c) 2024, Navari Ltd and Contributors
 # See license.txt
 
-# import frappe
+import frappe
 from frappe.tests.utils import FrappeTestCase
 
+from ...benchmarks.stub_device import get_server_address, start_stub_device
+from ...utils.circuit_breaker import CIRCUIT_BREAKER_KEY, is_circuit_open, open_circuit
+from ...utils.health import (
+    HEALTH_HISTORY_KEY,
+    HEALTH_KEY,
+    HEARTBEAT_TOLERANCE,
+    check_devices,
+    get_health_history,
+    send_heartbeat,
+)
+from ...utils.offline import finish_replay, is_replaying
+from ...utils.outbox import OUTBOX_DOCTYPE, add_to_outbox
+from ...utils.router import get_invoice_devices, route_invoice
+
+TEST_COMPANY = "_Test Company"
+
 
 class TestTIMSSettings(FrappeTestCase):
-    pass
+    def test_server_address_is_normalised(self) -> None:
+        setting = frappe.get_doc(
+            {"doctype": "TIMS Settings", "server_address": "127.0.0.1:8080"}
+        )
+        setting.validate()
+
+        self.assertEqual(setting.server_address, "http://127.0.0.1:8080/api")
+
+    def test_heartbeat_finds_device_reachable_until_it_stops(self) -> None:
+        device = start_stub_device()
+        setting = frappe._dict(server_address=get_server_address(device))
+
+        self.assertTrue(send_heartbeat(setting).healthy)
+
+        device.shutdown()
+        device.server_close()
+
+        self.assertFalse(send_heartbeat(setting).healthy)
+
+    def test_heartbeat_opens_and_closes_circuit(self) -> None:
+        device = start_stub_device()
+        port = device.server_address[1]
+        setting = frappe._dict(
+            name="_Test TIMS Device",
+            company="_Test Company",
+            server_address=get_server_address(device),
+        )
+        self.addCleanup(self.clear_health, setting)
+
+        self.assertTrue(check_devices([setting])[setting.name].healthy)
+        # Not due again until the interval has passed
+        self.assertEqual(check_devices([setting]), {})
+
+        setting.breaker_probe_interval = HEARTBEAT_TOLERANCE
+        device.shutdown()
+        device.server_close()
+
+        self.assertFalse(check_devices([setting])[setting.name].healthy)
+        self.assertTrue(is_circuit_open(setting.server_address))
+
+        # Submitted while the device is offline, and replayed once it's back
+        add_to_outbox({"_Test TIMS Offline Invoice": None}, setting)
+        frappe.db.set_value(
+            OUTBOX_DOCTYPE,
+            "_Test TIMS Offline Invoice",
+            "next_retry_at",
+            "2099-01-01",
+            update_modified=False,
+        )
+        self.assertFalse(is_replaying(setting))
+
+        device = start_stub_device(port=port)
+        self.addCleanup(device.server_close)
+        self.addCleanup(device.shutdown)
+
+        self.assertTrue(check_devices([setting])[setting.name].healthy)
+        self.assertFalse(is_circuit_open(setting.server_address))
+        self.assertTrue(is_replaying(setting))
+        self.assertLess(
+            frappe.db.get_value(OUTBOX_DOCTYPE, "_Test TIMS Offline Invoice", "next_retry_at"),
+            frappe.utils.now_datetime(),
+        )
+        self.assertEqual(
+            [heartbeat["healthy"] for heartbeat in get_health_history(setting.server_address)],
+            [True, False, True],
+        )
+
+    def clear_health(self, setting: frappe._dict) -> None:
+        cache = frappe.cache()
+        cache.delete_value(f"{CIRCUIT_BREAKER_KEY}:{setting.server_address}")
+        cache.hdel(HEALTH_KEY, setting.server_address)
+        cache.delete_value(f"{HEALTH_HISTORY_KEY}:{setting.server_address}")
+        finish_replay(setting)
+        frappe.db.delete(OUTBOX_DOCTYPE, {"device": setting.name})
+        frappe.db.commit()
+
+
+class TestInvoiceRouting(FrappeTestCase):
+    def setUp(self) -> None:
+        self.setting_count = 0
+
+    def insert_setting(self, **values) -> frappe._dict:
+        """Insert an active TIMS Settings of the test company, and return it as routed"""
+        self.setting_count += 1
+        setting = frappe.get_doc(
+            {
+                "doctype": "TIMS Settings",
+                "company": TEST_COMPANY,
+                # Circuits are kept per server address
+                "server_address": f"127.0.0.1:{9100 + self.setting_count}",
+                "sender_id": "_TEST",
+                "cusn": "_TEST",
+                "branch_id": "00",
+                "is_active": 1,
+                **values,
+            }
+        ).insert(ignore_permissions=True, ignore_links=True)
+        self.addCleanup(
+            frappe.delete_doc, "TIMS Settings", setting.name, force=True, ignore_permissions=True
+        )
+        self.addCleanup(
+            frappe.cache().delete_value, f"{CIRCUIT_BREAKER_KEY}:{setting.server_address}"
+        )
+
+        return frappe._dict(name=setting.name, server_address=setting.server_address)
+
+    def get_invoice(self, name: str, **values) -> frappe._dict:
+        return frappe._dict(name=name, company=TEST_COMPANY, **values)
+
+    def get_device_names(self, invoice: frappe._dict) -> list[str]:
+        return [setting.name for setting in get_invoice_devices(invoice)]
+
+    def test_most_specific_devices_come_first(self) -> None:
+        unrestricted = self.insert_setting()
+        warehouse = self.insert_setting(warehouse="_Test Warehouse - _TC")
+        self.insert_setting(warehouse="Stores - _TC")
+
+        invoice = self.get_invoice("INV-TIMSROUTE1", set_warehouse="_Test Warehouse - _TC")
+
+        # The device of another warehouse isn't one of the invoice's
+        self.assertEqual(self.get_device_names(invoice), [warehouse.name, unrestricted.name])
+        self.assertEqual(
+            self.get_device_names(self.get_invoice("INV-TIMSROUTE1")), [unrestricted.name]
+        )
+        self.assertEqual(
+            self.get_device_names(frappe._dict(invoice, company="_Test Company 1")), []
+        )
+
+    def test_invoices_keep_their_device_as_devices_are_added(self) -> None:
+        settings = [self.insert_setting(), self.insert_setting()]
+        invoices = [self.get_invoice(f"INV-TIMSROUTE{index}") for index in range(50)]
+
+        routed = {invoice.name: route_invoice(invoice).name for invoice in invoices}
+
+        self.assertEqual(set(routed.values()), {setting.name for setting in settings})
+        self.assertEqual(
+            {invoice.name: route_invoice(invoice).name for invoice in invoices}, routed
+        )
+
+        # Only the invoices the new device ranks first move to it
+        added = self.insert_setting()
+        for invoice in invoices:
+            self.assertIn(route_invoice(invoice).name, (routed[invoice.name], added.name))
+
+    def test_device_last_sent_to_is_preferred(self) -> None:
+        self.insert_setting()
+        self.insert_setting()
+        invoice = self.get_invoice("INV-TIMSROUTE1")
+
+        (first, second) = self.get_device_names(invoice)
+        invoice.custom_tims_device = second
+
+        self.assertEqual(self.get_device_names(invoice), [second, first])
+
+    def test_invoice_fails_over_while_its_device_is_unavailable(self) -> None:
+        self.insert_setting()
+        self.insert_setting()
+        invoice = self.get_invoice("INV-TIMSROUTE1")
+
+        first, second = get_invoice_devices(invoice)
+        self.assertEqual(route_invoice(invoice).name, first.name)
+
+        open_circuit(first.server_address)
+
+        self.assertEqual(route_invoice(invoice).name, second.name)
+        self.assertEqual(
+            route_invoice(invoice, unavailable={first.server_address}).name, second.name
+        )
+        self.assertIsNone(
+            route_invoice(
+                invoice, unavailable={first.server_address, second.server_address}
+            )
+        )
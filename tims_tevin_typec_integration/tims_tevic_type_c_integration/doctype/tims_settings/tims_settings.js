@@ -1,8 +1,88 @@
 // Copyright (c) 2024, Navari Ltd and contributors
 // For license information, please see license.txt
 
-// frappe.ui.form.on("TIMS Settings", {
-// 	refresh(frm) {
+frappe.ui.form.on("TIMS Settings", {
+  refresh(frm) {
+    if (frm.is_new()) {
+      return;
+    }
 
-// 	},
-// });
+    frm.add_custom_button(__("Refresh Status"), () => render_device_status(frm));
+    render_device_status(frm);
+  },
+});
+
+function render_device_status(frm) {
+  frappe.call({
+    method:
+      "tims_tevin_typec_integration.tims_tevic_type_c_integration.apis.apis.get_device_status",
+    args: { setting: frm.doc.name },
+    callback: ({ message: status }) => {
+      const indicator = status.circuit_state === "Closed" ? "green" : "red";
+
+      frm.get_field("device_status").$wrapper.html(`
+        <table class="table table-bordered">
+          <tr><th>${__("Circuit Breaker")}</th>
+            <td><span class="indicator-pill ${indicator}">${__(status.circuit_state)}</span></td></tr>
+          <tr><th>${__("Consecutive Failures")}</th><td>${status.consecutive_failures}</td></tr>
+          <tr><th>${__("Queue")}</th><td>${status.queue}</td></tr>
+          <tr><th>${__("Queue Depth")}</th><td>${status.queue_depth}</td></tr>
+          <tr><th>${__("Send Rate")}</th><td>${status.send_rate} ${__("requests/second")}</td></tr>
+          <tr><th>${__("Replaying Offline Backlog")}</th>
+            <td>${status.replaying_backlog ? __("Yes") : __("No")}</td></tr>
+          ${get_health_rows(status.health, status.health_history)}
+        </table>
+      `);
+
+      render_health_history(frm, status.health_history);
+    },
+  });
+}
+
+function get_health_rows(health, history) {
+  if (!health.checked_at) {
+    return `<tr><th>${__("Last Heartbeat")}</th><td>${__("Not sent yet")}</td></tr>`;
+  }
+
+  const indicator = health.healthy ? "green" : "red";
+  const missed = history.filter((heartbeat) => !heartbeat.healthy).length;
+
+  return `
+    <tr><th>${__("Health")}</th>
+      <td><span class="indicator-pill ${indicator}">${
+        health.healthy ? __("Reachable") : __("Unreachable")
+      }</span></td></tr>
+    <tr><th>${__("Last Heartbeat")}</th><td>${moment.unix(health.checked_at).fromNow()}</td></tr>
+    <tr><th>${__("Heartbeat Latency")}</th><td>${health.latency_ms} ms</td></tr>
+    <tr><th>${__("Missed Heartbeats")}</th><td>${missed} / ${history.length}</td></tr>
+  `;
+}
+
+function render_health_history(frm, history) {
+  const $wrapper = frm.get_field("device_health").$wrapper.empty();
+  if (!history.length) {
+    return;
+  }
+
+  new frappe.Chart($wrapper[0], {
+    title: __("Heartbeat Latency (ms)"),
+    type: "line",
+    height: 240,
+    colors: ["blue", "red"],
+    data: {
+      labels: history.map((heartbeat) => moment.unix(heartbeat.checked_at).format("HH:mm")),
+      datasets: [
+        {
+          name: __("Reachable"),
+          values: history.map((heartbeat) => (heartbeat.healthy ? heartbeat.latency_ms : 0)),
+        },
+        {
+          name: __("Unreachable"),
+          values: history.map((heartbeat) => (heartbeat.healthy ? 0 : heartbeat.latency_ms)),
+        },
+      ],
+    },
+    axisOptions: { xIsSeries: true },
+    lineOptions: { hideDots: 1, regionFill: 1 },
+  });
+}
@@ -5,12 +5,10 @@ import frappe
 from frappe.email.queue import flush
 from frappe.model.document import Document
 
-from ...tasks.tasks import get_eod_records, resend_invoices
+from ...utils.cache import clear_tims_settings_cache
 
 
 class TIMSSettings(Document):
-    # TODO: Provide link to Branch
-
     def validate(self) -> None:
         if self.server_address:
             if not self.server_address.startswith("http"):
@@ -21,6 +19,26 @@ class TIMSSettings(Document):
                 self.server_address = f"{self.server_address}/api"
 
     def on_update(self) -> None:
+        # Imported here, as the tasks load the HTTP client, which loading a
+        # TIMS Settings document, e.g. to open its form, doesn't need
+        from ...tasks.tasks import (
+            add_unsent_invoices_to_outbox,
+            get_eod_records,
+            resend_invoices,
+        )
+
+        clear_tims_settings_cache()
+
+        if self.is_active and self.has_value_changed("is_active"):
+            # Invoices submitted while the company had no active device
+            frappe.enqueue(
+                add_unsent_invoices_to_outbox,
+                company=self.company,
+                queue="long",
+                timeout=3600,
+                enqueue_after_commit=True,
+            )
+
         if self.has_value_changed("flush_email_frequency"):
             if self.flush_email_frequency:
                 flush_emails_task: Document = frappe.get_doc(
@@ -68,3 +86,6 @@ class TIMSSettings(Document):
                     resend_invoices_task.cron_format = self.resend_invoices_cron
 
                 resend_invoices_task.save()
+
+    def on_trash(self) -> None:
+        clear_tims_settings_cache()
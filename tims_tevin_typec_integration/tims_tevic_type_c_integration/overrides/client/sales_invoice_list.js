@@ -0,0 +1,29 @@
+(() => {
+  const listviewSettings = (frappe.listview_settings["Sales Invoice"] =
+    frappe.listview_settings["Sales Invoice"] || {});
+  const erpnextOnload = listviewSettings.onload;
+
+  listviewSettings.onload = function (listview) {
+    if (erpnextOnload) {
+      erpnextOnload(listview);
+    }
+
+    listview.page.add_actions_menu_item(__("Fiscalise with TIMS"), () => {
+      const names = listview.get_checked_items(true);
+
+      frappe.call({
+        method:
+          "tims_tevin_typec_integration.tims_tevic_type_c_integration.apis.apis.fiscalise_invoices",
+        args: { names: names },
+        callback: () => {
+          frappe.show_alert({
+            message: __("Fiscalising {0} invoices in the background", [
+              names.length,
+            ]),
+            indicator: "blue",
+          });
+        },
+      });
+    });
+  };
+})();
@@ -0,0 +1,195 @@
+# Copyright (c) 2024, Navari Ltd and Contributors
+# See license.txt
+
+import frappe
+from frappe.model.document import Document
+from frappe.tests.utils import FrappeTestCase
+
+from ...benchmarks.import_time import (
+    DEVICE_MODULE,
+    HOOK_MODULE,
+    SETTINGS_MODULE,
+    get_device_libraries,
+    get_import_times,
+)
+from ...utils.cache import (
+    ITEM_TAX_TEMPLATE_CACHE_KEY,
+    TAX_TEMPLATE_CACHE_KEY,
+    clear_tax_metadata_cache,
+    get_cached_value,
+)
+from ...utils.payload import ITEM_FIELDS, build_item_details
+from ...utils.taxes import compute_tax_amounts, set_line_taxes
+
+HS_CODE = "0001.12.00"
+TAX_ACCOUNT = "_Test TIMS VAT - _TC"
+
+
+class TestSalesInvoiceImports(FrappeTestCase):
+    def test_hooks_do_not_import_device_libraries(self) -> None:
+        hooks = get_import_times(HOOK_MODULE)
+
+        self.assertIn(HOOK_MODULE, hooks.modules)
+        self.assertEqual(get_device_libraries(hooks.modules), [])
+
+    def test_settings_do_not_import_device_libraries(self) -> None:
+        # Loaded with every TIMS Settings document
+        settings = get_import_times(SETTINGS_MODULE)
+
+        self.assertIn(SETTINGS_MODULE, settings.modules)
+        self.assertEqual(get_device_libraries(settings.modules), [])
+
+    def test_hooks_import_faster_than_device_layer(self) -> None:
+        hooks = get_import_times(HOOK_MODULE)
+        device = get_import_times(DEVICE_MODULE)
+
+        # The device layer imports the hooks as well, plus its libraries
+        self.assertTrue(set(hooks.modules) < set(device.modules))
+        self.assertLess(hooks.cumulative_us, device.cumulative_us)
+
+
+class TestItemDetails(FrappeTestCase):
+    def get_items(self, *lines: tuple) -> dict[str, list]:
+        """Return the item columns of lines of (item_code, net_amount, net_rate, qty,
+        custom_tax_rate, custom_tax_amount)"""
+        columns = {field: [] for field in ITEM_FIELDS}
+        for item_code, net_amount, net_rate, qty, tax_rate, tax_amount in lines:
+            columns["item_code"].append(item_code)
+            columns["description"].append(f"{item_code} description")
+            columns["net_amount"].append(net_amount)
+            columns["net_rate"].append(net_rate)
+            columns["qty"].append(qty)
+            columns["custom_tax_rate"].append(tax_rate)
+            columns["custom_tax_amount"].append(tax_amount)
+
+        return columns
+
+    def test_exempt_lines_have_no_tax_and_the_hs_code(self) -> None:
+        items = self.get_items(("A", 100.0, 50.0, 2, None, None))
+
+        self.assertEqual(
+            build_item_details(items, 0, HS_CODE),
+            [
+                {
+                    "HSDesc": "A description",
+                    "TaxRate": 0,
+                    "ItemAmount": 100.0,
+                    "TaxAmount": 0,
+                    "TransactionType": "1",
+                    "UnitPrice": 50.0,
+                    "HSCode": HS_CODE,
+                    "Quantity": 2,
+                }
+            ],
+        )
+
+    def test_taxable_lines_fall_back_to_the_invoice_rate(self) -> None:
+        items = self.get_items(
+            ("A", 100.0, 50.0, 2, 16, 16.0),
+            # No tax of its own, so it's taxed at the invoice's rate
+            ("B", 50.0, 50.0, 1, None, None),
+        )
+
+        (first, second) = build_item_details(items, 8, None)
+
+        self.assertEqual(
+            (first["TaxRate"], first["TaxAmount"], first["HSCode"]), (16, 16.0, "")
+        )
+        self.assertEqual((second["TaxRate"], second["TaxAmount"]), (8, 4.0))
+
+    def test_credit_note_quantities_are_positive(self) -> None:
+        items = self.get_items(("A", -100.0, 50.0, -2, 16, -16.0))
+
+        (exempt,) = build_item_details(items, 0, HS_CODE)
+        self.assertEqual((exempt["ItemAmount"], exempt["Quantity"]), (100.0, 2))
+
+        # Taxable lines keep the sign of their amounts, and only the quantity's is dropped
+        (taxable,) = build_item_details(items, 16, None)
+        self.assertEqual(
+            (taxable["ItemAmount"], taxable["TaxAmount"], taxable["Quantity"]),
+            (-100.0, -16.0, 2),
+        )
+
+    def test_only_lines_of_the_same_item_hs_code_and_rate_are_aggregated(self) -> None:
+        items = self.get_items(
+            ("A", 100.0, 50.0, 2, 16, 16.0),
+            ("B", 50.0, 50.0, 1, 16, 8.0),
+            ("A", 200.0, 100.0, 2, 16, 32.0),
+            ("A", 30.0, 30.0, 1, 8, 2.4),
+        )
+
+        details = build_item_details(items, 16, None, aggregate=True)
+
+        self.assertEqual(
+            [
+                (detail["HSDesc"], detail["TaxRate"], detail["ItemAmount"], detail["TaxAmount"])
+                for detail in details
+            ],
+            [
+                ("A description", 16, 300.0, 48.0),
+                ("B description", 16, 50.0, 8.0),
+                ("A description", 8, 30.0, 2.4),
+            ],
+        )
+        self.assertEqual((details[0]["Quantity"], details[0]["UnitPrice"]), (4, 75.0))
+
+
+class TestLineTaxes(FrappeTestCase):
+    def setUp(self) -> None:
+        # The template rates are read through the TIMS cache, so they're
+        # seeded there rather than created
+        self.addCleanup(clear_tax_metadata_cache)
+        clear_tax_metadata_cache()
+
+        get_cached_value(
+            ITEM_TAX_TEMPLATE_CACHE_KEY, "_Test TIMS VAT 8", lambda: {TAX_ACCOUNT: 8}
+        )
+        get_cached_value(
+            ITEM_TAX_TEMPLATE_CACHE_KEY, "_Test TIMS Excise", lambda: {"_Test Excise - _TC": 10}
+        )
+        get_cached_value(
+            TAX_TEMPLATE_CACHE_KEY, "_Test TIMS VAT 16", lambda: (TAX_ACCOUNT, 16)
+        )
+
+    def get_invoice(self, *item_tax_templates: str | None, **values) -> Document:
+        return frappe.get_doc(
+            {
+                "doctype": "Sales Invoice",
+                "items": [
+                    {"item_code": "_Test Item", "net_amount": 100, "item_tax_template": template}
+                    for template in item_tax_templates
+                ],
+                **values,
+            }
+        )
+
+    def test_item_tax_template_overrides_the_document_rate(self) -> None:
+        invoice = self.get_invoice(
+            "_Test TIMS VAT 8",
+            None,
+            # Has no rate for the document's tax account
+            "_Test TIMS Excise",
+            taxes=[{"charge_type": "On Net Total", "account_head": TAX_ACCOUNT, "rate": 16}],
+        )
+
+        set_line_taxes(invoice)
+
+        self.assertEqual([item.custom_tax_rate for item in invoice.items], [8, 16, 16])
+        self.assertEqual([item.custom_tax_amount for item in invoice.items], [8, 16, 16])
+
+    def test_rate_falls_back_to_the_sales_taxes_and_charges_template(self) -> None:
+        invoice = self.get_invoice(None, taxes_and_charges="_Test TIMS VAT 16")
+
+        set_line_taxes(invoice)
+
+        self.assertEqual(
+            (invoice.items[0].custom_tax_rate, invoice.items[0].custom_tax_amount), (16, 16)
+        )
+
+    def test_each_line_is_rounded_to_the_amount_precision(self) -> None:
+        amounts = compute_tax_amounts([33.33, 33.33, 33.34], [16, 16, 16], 2)
+
+        # Rounded line by line, so they don't add up to the tax of the total
+        self.assertEqual(amounts, [5.33, 5.33, 5.33])
+        self.assertEqual(compute_tax_amounts([33.33], [16], 0), [5])
+        self.assertEqual(compute_tax_amounts([None, 100], [16, None], 2), [0, 0])
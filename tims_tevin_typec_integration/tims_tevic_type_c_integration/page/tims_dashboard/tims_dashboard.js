@@ -0,0 +1,109 @@
+// Copyright (c) 2026, Navari Ltd and contributors
+// For license information, please see license.txt
+
+const METRICS_METHOD =
+	"tims_tevin_typec_integration.tims_tevic_type_c_integration.apis.apis.get_metrics";
+const REFRESH_INTERVAL = 30000; // milliseconds
+
+frappe.pages["tims-dashboard"].on_page_load = function (wrapper) {
+	const page = frappe.ui.make_app_page({
+		parent: wrapper,
+		title: __("TIMS Dashboard"),
+		single_column: true,
+	});
+
+	const window_field = page.add_field({
+		fieldname: "window_minutes",
+		label: __("Window"),
+		fieldtype: "Select",
+		options: [
+			{ value: 15, label: __("Last 15 Minutes") },
+			{ value: 60, label: __("Last Hour") },
+			{ value: 120, label: __("Last 2 Hours") },
+		],
+		default: 60,
+		change: () => refresh(),
+	});
+
+	page.set_primary_action(__("Refresh"), () => refresh(), "refresh");
+
+	const $body = $(`<div class="tims-dashboard"></div>`).appendTo(page.main);
+
+	const refresh = () => {
+		frappe.call({
+			method: METRICS_METHOD,
+			args: { window_minutes: window_field.get_value() || 60 },
+			callback: ({ message: devices }) => render(devices || {}),
+		});
+	};
+
+	const render = (devices) => {
+		const names = Object.keys(devices).sort();
+		if (!names.length) {
+			$body.html(`<p class="text-muted">${__("No active TIMS devices")}</p>`);
+			return;
+		}
+
+		$body.html(names.map((name) => render_device(name, devices[name])).join(""));
+	};
+
+	refresh();
+	setInterval(() => {
+		if (frappe.get_route_str() === "tims-dashboard") refresh();
+	}, REFRESH_INTERVAL);
+};
+
+function render_device(name, metrics) {
+	const outbox = metrics.outbox || {};
+	const outcomes = metrics.outcomes || {};
+	const success_rate =
+		metrics.success_rate === null || metrics.success_rate === undefined
+			? "-"
+			: `${metrics.success_rate}%`;
+
+	const stages = Object.values(metrics.stages || {});
+	const rows = stages.length
+		? stages
+				.map(
+					(stage) => `
+				<tr>
+					<td>${__(stage.label)}</td>
+					<td class="text-right">${stage.count}</td>
+					<td class="text-right">${format_ms(stage.p50)}</td>
+					<td class="text-right">${format_ms(stage.p95)}</td>
+					<td class="text-right">${format_ms(stage.p99)}</td>
+				</tr>`
+				)
+				.join("")
+		: `<tr><td colspan="5" class="text-muted">${__("Nothing observed in this window")}</td></tr>`;
+
+	return `
+		<div class="frappe-card mb-4 p-4">
+			<h4>${frappe.utils.escape_html(name)}</h4>
+			<div class="row mb-3">
+				<div class="col-sm-2"><b>${__("Success Rate")}</b><br>${success_rate}</div>
+				<div class="col-sm-2"><b>${__("Completed")}</b><br>${outcomes.Completed || 0}</div>
+				<div class="col-sm-2"><b>${__("Failed")}</b><br>${outcomes.Failed || 0}</div>
+				<div class="col-sm-2"><b>${__("Queued")}</b><br>${outbox.Queued || 0}</div>
+				<div class="col-sm-2"><b>${__("Dead Letter")}</b><br>${outbox["Dead Letter"] || 0}</div>
+				<div class="col-sm-2"><b>${__("Send Rate")}</b><br>${metrics.send_rate || 0}/s</div>
+			</div>
+			<table class="table table-bordered">
+				<thead>
+					<tr>
+						<th>${__("Stage")}</th>
+						<th class="text-right">${__("Count")}</th>
+						<th class="text-right">p50</th>
+						<th class="text-right">p95</th>
+						<th class="text-right">p99</th>
+					</tr>
+				</thead>
+				<tbody>${rows}</tbody>
+			</table>
+		</div>
+	`;
+}
+
+function format_ms(ms) {
+	return ms >= 1000 ? `${(ms / 1000).toFixed(2)} s` : `${ms} ms`;
+}
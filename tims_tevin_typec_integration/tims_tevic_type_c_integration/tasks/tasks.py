@@ -1,92 +1,555 @@
-import requests
+import sys
+import time
+from datetime import datetime
 
 import frappe
-from frappe.integrations.utils import create_request_log
+from frappe.utils import add_to_date, now_datetime
 
-from ..overrides.server.sales_invoice import (
-    notify_users,
-    on_submit,
-    update_integration_request,
+from ..overrides.server.sales_invoice import set_tims_status
+from ..utils.cache import get_active_tims_settings, prefetch_tax_metadata
+from ..utils.async_client import DEFAULT_DEADLINE, DEFAULT_MAX_CONCURRENCY
+from ..utils.circuit_breaker import is_circuit_open
+from ..utils.device import get_job_timeout
+from ..utils.dispatch import DEFAULT_CONCURRENCY, dispatch_tims_requests
+from ..utils.end_of_day import fetch_eod_summaries
+from ..utils.fiscalisation import record_fiscalised_invoice
+from ..utils.health import check_devices
+from ..utils.idempotency import (
+    acquire_invoice_locks,
+    get_fiscalised_results,
+    release_invoice_locks,
 )
+from ..utils.jobs import FLUSH_JOB_TIMEOUT, enqueue_flush_job
+from ..utils.metrics import flush_metrics, observe, timed
+from ..utils.offline import finish_replay, is_replaying
+from ..utils.outbox import (
+    CLAIM_BATCH_SIZE,
+    CLAIM_TIMEOUT_MINUTES,
+    OUTBOX_DOCTYPE,
+    add_to_outbox,
+    claim_outbox,
+    record_outbox_results,
+    requeue_outbox,
+    reroute_outbox,
+)
+from ..utils.payload import build_invoice_payload_from_db, dumps_payload
+from ..utils.rate_limit import DEFAULT_ACQUIRE_TIMEOUT
+from ..utils.request_log import log_tims_requests
+from ..utils.router import get_routing_fields, get_unavailable_devices, route_invoice
+
+DEFAULT_RESEND_LIMIT = 500
+RESEND_CHUNK_SIZE = 100
+
+PAYLOAD_BUILD_ERROR = "Its payload couldn't be built. See the Error Log for details"
+
+# Seconds of a claim its batch is sized to be sent within, the rest being a margin
+CLAIM_BUDGET_SECONDS = CLAIM_TIMEOUT_MINUTES * 60 * 0.8
+
+# Seconds a flush job replays a device's offline backlog for, before leaving
+# the rest to the next one
+REPLAY_SECONDS = FLUSH_JOB_TIMEOUT // 2
+
+# Invoices still In-Flight this many minutes after being sent are assumed lost
+IN_FLIGHT_WINDOW_MINUTES = 10
 
 
 def resend_invoices() -> None:
-    # Fetch all invoices with no CU Invoice number and QR code value, that are submitted
-    query = """
-    SELECT name
-    FROM `tabSales Invoice`
-    WHERE custom_cu_invoice_number IS NULL
-        AND custom_qr_code IS NULL
-        AND docstatus = 1
-        AND name like 'INV-%'
-   """
-    invoices = frappe.db.sql(query, as_dict=True)
+    """Enqueue a job per available device to send its due outbox rows, so the
+    devices of a company are sent to in parallel. The queued invoices of
+    unavailable devices are failed over to the other devices."""
+    settings = get_active_tims_settings()
 
-    for invoice in invoices:
-        doc = frappe.get_doc("Sales Invoice", invoice.name)
+    for setting in settings:
+        if is_circuit_open(setting.server_address):
+            if reroute_outbox(setting):
+                frappe.db.commit()
+        else:
+            enqueue_flush_job(setting)
 
-        on_submit(doc)
 
+def send_heartbeats() -> None:
+    """Send a heartbeat to each active device that is due one, marking those
+    that miss it unavailable, and bringing back those reachable again"""
+    check_devices(get_active_tims_settings())
 
-def get_eod_records() -> None:
-    company = frappe.defaults.get_user_default("Company")
 
-    setting = frappe.db.get_value(
-        "TIMS Settings",
-        {"company": company},
-        ["server_address", "sender_id"],
-        as_dict=True,
+def flush_pending_invoices(setting: str) -> None:
+    """Send the due outbox rows of a device.
+
+    Enqueued on submit and by the resend job. At most one runs at a time per
+    device, so a burst of submissions is sent by a single job.
+    """
+    for active_setting in get_active_tims_settings():
+        if active_setting.name == setting and not is_circuit_open(
+            active_setting.server_address
+        ):
+            drain_outbox(active_setting)
+
+
+def drain_outbox(
+    setting: frappe._dict,
+    limit: int | None = None,
+    invoices: list[str] | None = None,
+) -> list[frappe._dict]:
+    """Send the due outbox rows of the setting's device, a claimed batch at a time.
+
+    At most `limit` invoices are sent per run, and the run stops early once
+    the device is found to be unreachable. Each batch's invoices are locked
+    while they're sent, so none is in flight from two jobs at once.
+
+    While the device's offline backlog is replayed, invoices are sent one at a
+    time in the order they were submitted, for up to `REPLAY_SECONDS` unless a
+    limit is given, and the replay ends once the outbox is drained. Batches are
+    sized to be sent within their claim, and within what's left of the replay.
+
+    Args:
+        setting (frappe._dict): The TIMS Settings of the device
+        limit (int | None, optional): Maximum number of invoices to send. Defaults to the setting's resend limit.
+        invoices (list[str] | None, optional): Only send these Sales Invoices. Defaults to any of the device's.
+
+    Returns:
+        list[frappe._dict]: The number of invoices, completed and failed requests, and seconds taken, per batch
+    """
+    concurrency = setting.resend_concurrency or DEFAULT_CONCURRENCY
+    deadline = None
+
+    replaying = is_replaying(setting)
+    if replaying:
+        # Sent in sequence from the thread pool, whatever the setting's client
+        setting, concurrency = frappe._dict(setting, use_async_client=0), 1
+        if not limit:
+            limit, deadline = sys.maxsize, time.monotonic() + REPLAY_SECONDS
+
+    limit = limit or setting.resend_limit or DEFAULT_RESEND_LIMIT
+
+    batches, sent = [], 0
+    # Sized so a batch is sent well before its claim, and the invoices' locks,
+    # expire and another job could claim it again
+    batch_size = max(get_batch_size(setting, concurrency, CLAIM_BUDGET_SECONDS), 1)
+
+    while sent < limit:
+        size = min(batch_size, limit - sent)
+        if deadline:
+            size = min(size, get_batch_size(setting, concurrency, deadline - time.monotonic()))
+            if not size:
+                break
+
+        start = time.perf_counter()
+
+        rows = claim_outbox(setting, size, invoices)
+        if not rows:
+            if replaying:
+                finish_replay(setting)
+            break
+
+        token, tims_requests = frappe.generate_hash(length=10), []
+        locked = acquire_invoice_locks([row.sales_invoice for row in rows], token)
+        try:
+            rows, settled = settle_duplicate_rows(rows, locked, setting)
+            tims_requests = prepare_tims_requests(rows, setting)
+            result = dispatch_tims_requests(tims_requests, setting, concurrency)
+            set_tims_status(
+                record_outbox_results([*settled, *tims_requests], setting), "Dead Letter"
+            )
+            frappe.db.commit()
+        finally:
+            release_invoice_locks(
+                list(locked),
+                token,
+                {
+                    tims_request.invoice: tims_request.output
+                    for tims_request in tims_requests
+                    if tims_request.outcome == "Completed"
+                },
+            )
+        flush_metrics()
+
+        sent += len(rows)
+        batches.append(
+            frappe._dict(
+                invoices=len(rows),
+                completed=result.completed,
+                failed=result.failed,
+                seconds=time.perf_counter() - start,
+            )
+        )
+
+        if result.device_unreachable:
+            break
+
+    return batches
+
+
+def get_batch_size(setting: frappe._dict, concurrency: int, seconds: float) -> int:
+    """Return how many invoices can be claimed at once and all be sent within
+    `seconds`, even if each waits out the rate limiter and the device's timeouts"""
+    if setting.use_async_client:
+        concurrency = setting.async_concurrency or DEFAULT_MAX_CONCURRENCY
+        request_seconds = setting.request_deadline or DEFAULT_DEADLINE
+    else:
+        request_seconds = get_job_timeout(setting)
+
+    if setting.rate_limit:
+        request_seconds += DEFAULT_ACQUIRE_TIMEOUT
+
+    rounds = int(max(seconds, 0) // request_seconds)
+
+    return min(rounds * max(concurrency, 1), CLAIM_BATCH_SIZE)
+
+
+def settle_duplicate_rows(
+    rows: list[frappe._dict], locked: set[str], setting: frappe._dict
+) -> tuple[list[frappe._dict], list[frappe._dict]]:
+    """Set aside the claimed rows that mustn't be sent to the device again.
+
+    Rows whose invoice is in flight from another job are Deferred, and left
+    for that job to record. Those the device already fiscalised are recorded
+    from its kept response, and Completed without calling it.
+
+    Args:
+        rows (list[frappe._dict]): The claimed outbox rows
+        locked (set[str]): The invoices locked for this batch
+        setting (frappe._dict): The TIMS Settings of the device they are sent to
+
+    Returns:
+        tuple[list[frappe._dict], list[frappe._dict]]: The rows to send, and the settled requests
+    """
+    outputs = get_fiscalised_results(
+        [row.sales_invoice for row in rows if row.sales_invoice in locked]
     )
 
-    if setting:
-        url = f"{setting.server_address}/eod/{setting.sender_id}"
-        integration_request = create_request_log(
-            url=url,
-            is_remote_request=True,
-            service_name="TIMS",
-            request_headers=None,
-            data=dict(),
+    to_send, settled = [], []
+    for row in rows:
+        if row.sales_invoice not in locked:
+            outcome = "Deferred"
+        elif row.sales_invoice in outputs:
+            record_fiscalised_invoice(outputs[row.sales_invoice], setting)
+            outcome = "Completed"
+        else:
+            to_send.append(row)
+            continue
+
+        settled.append(
+            frappe._dict(
+                invoice=row.sales_invoice,
+                outbox=row.name,
+                attempts=row.attempts,
+                outcome=outcome,
+            )
         )
 
-        frappe.enqueue(
-            make_tims_get_request,
+    return to_send, settled
+
+
+def prepare_tims_requests(rows: list[frappe._dict], setting: frappe._dict) -> list[frappe._dict]:
+    """Log an attempt to send each claimed outbox row, with one upsert of their TIMS Request Logs
+
+    Args:
+        rows (list[frappe._dict]): The claimed outbox rows
+        setting (frappe._dict): The TIMS Settings of the device they are sent to
+
+    Returns:
+        list[frappe._dict]: The requests to dispatch
+    """
+    rows = build_deferred_payloads(rows, setting)
+    if not rows:
+        return []
+
+    url = f"{setting.server_address}/invoice"
+    now = now_datetime()
+
+    for row in rows:
+        observe("queue_wait", setting.name, (now - row.next_retry_at).total_seconds())
+
+    log_tims_requests(
+        url, {row.sales_invoice: row.payload for row in rows}, setting.name
+    )
+    set_tims_status(
+        [row.sales_invoice for row in rows],
+        "In-Flight",
+        attempted=True,
+        device=setting.name,
+    )
+
+    return [
+        frappe._dict(
             url=url,
-            integration_request=integration_request.name,
-            queue="default",
-            is_async=True,
-            timeout=65,
+            payload=row.payload,
+            invoice=row.sales_invoice,
+            outbox=row.name,
+            attempts=row.attempts,
+            queued_at=row.creation,
         )
+        for row in rows
+    ]
+
+
+def build_deferred_payloads(rows: list[frappe._dict], setting: frappe._dict) -> list[frappe._dict]:
+    """Build and store the payloads of the claimed outbox rows queued without one.
+
+    Rows whose payload can't be built are dead-lettered, so they aren't
+    retried until the invoice or its tax setup is fixed and they're requeued.
+
+    Args:
+        rows (list[frappe._dict]): The claimed outbox rows
+        setting (frappe._dict): The TIMS Settings of the device they are sent to
+
+    Returns:
+        list[frappe._dict]: The rows with a payload to send
+    """
+    deferred = [row.sales_invoice for row in rows if not row.payload]
+    if not deferred:
+        return rows
 
+    payloads = build_invoice_payloads(deferred, setting)
+    for row in rows:
+        if not row.payload and row.sales_invoice in payloads:
+            # Stored so retries send it as is
+            row.payload = dumps_payload(payloads[row.sales_invoice]).decode()
+            frappe.db.set_value(
+                OUTBOX_DOCTYPE, row.name, "payload", row.payload, update_modified=False
+            )
 
-def make_tims_get_request(url: str, integration_request: str) -> None:
-    try:
-        response = requests.get(url)
-        response.raise_for_status()
-
-        eod_info = response.json()
-        update_integration_request(integration_request, "Completed", eod_info)
-
-        eod_doc = frappe.new_doc("End Of Day TIMS Records")
-
-        eod_doc.end_of_day_id = eod_info["EODId"]
-        eod_doc.date_of_summary = eod_info["DateOfEODSummary"]
-        eod_doc.transmission_timestamp = eod_info["EODTransmissionTimestamp"]
-        eod_doc.first_invoice_number = eod_info["NumberOfFirstInvoice"]
-        eod_doc.last_invoice_number = eod_info["NumberOfLastInvoice"]
-        eod_doc.total_invoice_amount = eod_info["TotalInvoiceAmountOfTheDay"]
-        eod_doc.total_taxable_amount = eod_info["TotalTaxableAmountOfTheDay"]
-        eod_doc.total_tax_amount = eod_info["TotalTaxAmountOfTheDay"]
-        eod_doc.number_of_invoices_sent = eod_info["NumberOfInvoicesSentOfTheDay"]
-
-        eod_doc.save()
-    except (
-        requests.exceptions.ConnectionError,
-        requests.exceptions.ConnectTimeout,
-        frappe.exceptions.DuplicateEntryError,
-    ) as error:
-        notify_users("System Manager", integration_request)
-        frappe.throw(f"{error}")
-    except requests.exceptions.HTTPError as error:
-        notify_users("System Manager", integration_request)
-        message = f"{error.response.status_code}\n\n{error.response.text}"
-        update_integration_request(integration_request, "Failed", error=message)
+    unbuilt = [row.sales_invoice for row in rows if not row.payload]
+    if unbuilt:
+        frappe.db.set_value(
+            OUTBOX_DOCTYPE,
+            {"name": ["in", unbuilt]},
+            {"status": "Dead Letter", "last_error": PAYLOAD_BUILD_ERROR},
+            update_modified=False,
+        )
+        set_tims_status(unbuilt, "Dead Letter")
+
+    return [row for row in rows if row.payload]
+
+
+def build_invoice_payloads(invoices: list[str], setting: frappe._dict) -> dict[str, dict]:
+    """Build the payloads of submitted invoices from the database.
+
+    Invoices whose payload can't be built are logged to the Error Log and skipped.
+
+    Args:
+        invoices (list[str]): The Sales Invoices
+        setting (frappe._dict): The TIMS Settings of the device they are sent to
+
+    Returns:
+        dict[str, dict]: The payloads, keyed by Sales Invoice
+    """
+    payloads = {}
+    for invoice in invoices:
+        try:
+            with timed("build_payload", setting.name):
+                payloads[invoice] = build_invoice_payload_from_db(invoice, setting)
+        except frappe.ValidationError:
+            frappe.log_error(title=f"TIMS: Unable to send {invoice}")
+            frappe.clear_messages()
+
+    return payloads
+
+
+def queue_invoices(invoices: list[frappe._dict]) -> dict[str, list[str]]:
+    """Queue submitted invoices in the outbox of the device each is routed to.
+
+    Invoices already in the outbox are made due again, with their stored
+    payload. Invoices whose devices are all unavailable are skipped.
+
+    Args:
+        invoices (list[frappe._dict]): The invoices, with the fields they are routed by
+
+    Returns:
+        dict[str, list[str]]: The queued invoices, keyed by TIMS Settings
+    """
+    queued = frappe.get_all(
+        OUTBOX_DOCTYPE,
+        filters={"sales_invoice": ["in", [invoice.name for invoice in invoices]]},
+        pluck="sales_invoice",
+    )
+    requeue_outbox(queued)
+    queued = set(queued)
+
+    unavailable = get_unavailable_devices()
+    settings, invoices_by_device = {}, {}
+    for invoice in invoices:
+        setting = route_invoice(invoice, unavailable=unavailable)
+        if setting:
+            settings[setting.name] = setting
+            invoices_by_device.setdefault(setting.name, []).append(invoice.name)
+
+    for device, device_invoices in invoices_by_device.items():
+        add_to_outbox(
+            build_invoice_payloads(
+                [invoice for invoice in device_invoices if invoice not in queued],
+                settings[device],
+            ),
+            settings[device],
+        )
+
+    return invoices_by_device
+
+
+def add_unsent_invoices_to_outbox(company: str | None = None) -> None:
+    """Queue the unfiscalised invoices that aren't in the outbox yet, e.g. those
+    submitted before the outbox existed, or before their company had a device.
+
+    Args:
+        company (str | None, optional): Only queue this company's invoices. Defaults to all companies with a device.
+    """
+    companies = (
+        [company]
+        if company
+        else {setting.company for setting in get_active_tims_settings()}
+    )
+
+    for company in companies:
+        last_invoice = ""
+        while invoices := get_pending_invoices(company, last_invoice, RESEND_CHUNK_SIZE):
+            last_invoice = invoices[-1].name
+            queue_invoices(invoices)
+            frappe.db.commit()
+
+
+def fiscalise_invoices_in_bulk(invoices: list[str], user: str | None = None) -> list[dict]:
+    """Send several submitted invoices to their TIMS devices from a single job.
+
+    Tax metadata of all the invoices is prefetched, then the invoices are
+    queued in the outbox of their devices, and only their rows are sent, in
+    batches, each with one upsert of its TIMS Request Logs and a bounded number
+    of requests in flight. The invoices of a device whose backlog is being
+    replayed are left to its flush job instead, to be sent in order. The
+    throughput of each batch is logged, and how many of the invoices ended up
+    fiscalised is reported to the user who started the job.
+
+    Args:
+        invoices (list[str]): The Sales Invoices to fiscalise
+        user (str | None, optional): The user to report progress to. Defaults to None.
+
+    Returns:
+        list[dict]: The statistics of each batch
+    """
+    pending = frappe.get_all(
+        "Sales Invoice",
+        filters={
+            "name": ["in", invoices],
+            "docstatus": 1,
+            "custom_tims_status": ["!=", "Fiscalised"],
+        },
+        fields=[
+            *get_routing_fields(),
+            "tax_category",
+            "custom_tims_status",
+            "custom_tims_last_attempt",
+        ],
+        order_by="name",
+    )
+    prefetch_tax_metadata({invoice.tax_category for invoice in pending})
+
+    stale_before = get_stale_before()
+    invoices_by_device = queue_invoices(
+        [
+            invoice
+            for invoice in pending
+            if invoice.custom_tims_status != "In-Flight"
+            or (invoice.custom_tims_last_attempt or datetime.min) < stale_before
+        ]
+    )
+    frappe.db.commit()
+
+    batches = []
+    settings = {setting.name: setting for setting in get_active_tims_settings()}
+    for device, device_invoices in invoices_by_device.items():
+        setting = settings[device]
+
+        if is_replaying(setting):
+            enqueue_flush_job(setting)
+            continue
+
+        for batch in drain_outbox(
+            setting, limit=len(device_invoices), invoices=device_invoices
+        ):
+            batches.append(
+                {
+                    "company": setting.company,
+                    "device": device,
+                    "invoices": batch.invoices,
+                    "completed": batch.completed,
+                    "failed": batch.failed,
+                    "seconds": round(batch.seconds, 3),
+                    "invoices_per_second": round(batch.invoices / batch.seconds, 2),
+                }
+            )
+            frappe.logger("tims").info({"bulk_fiscalisation_batch": batches[-1]})
+
+    if user:
+        # Counted from the invoices themselves, as some may have been sent by
+        # their device's flush job instead
+        fiscalised = frappe.db.count(
+            "Sales Invoice",
+            {"name": ["in", invoices], "custom_tims_status": "Fiscalised"},
+        )
+        completed = sum(batch["completed"] for batch in batches)
+        seconds = sum(batch["seconds"] for batch in batches)
+        frappe.publish_realtime(
+            "msgprint",
+            f"TIMS fiscalised {fiscalised} of {len(invoices)} invoices, sending {completed}"
+            f" in {len(batches)} batches"
+            f" ({round(completed / seconds, 2) if seconds else 0} invoices per second)",
+            user=user,
+        )
+
+    return batches
+
+
+def get_pending_invoices(
+    company: str, after: str = "", limit: int = 100
+) -> list[frappe._dict]:
+    """Fetch submitted invoices that are yet to be fiscalised, ordered by name.
+
+    These are the Pending and Failed invoices, and those In-Flight for longer
+    than the in-flight window, whose request is assumed lost.
+
+    Args:
+        company (str): The company the invoices belong to
+        after (str, optional): Only return invoices named after this one. Defaults to "".
+        limit (int, optional): Maximum number of invoices to return. Defaults to 100.
+
+    Returns:
+        list[frappe._dict]: The invoices, with the fields they are routed by
+    """
+    fields = ", ".join(f"`{field}`" for field in get_routing_fields())
+
+    return frappe.db.sql(
+        f"""
+        SELECT {fields}
+        FROM `tabSales Invoice`
+        WHERE (
+                custom_tims_status IN ('Pending', 'Failed')
+                OR (
+                    custom_tims_status = 'In-Flight'
+                    AND custom_tims_last_attempt < %(stale_before)s
+                )
+            )
+            AND docstatus = 1
+            AND company = %(company)s
+            AND name like 'INV-%%'
+            AND name > %(after)s
+        ORDER BY name
+        LIMIT %(limit)s
+        """,
+        {
+            "company": company,
+            "after": after,
+            "limit": limit,
+            "stale_before": get_stale_before(),
+        },
+        as_dict=True,
+    )
+
+
+def get_stale_before() -> datetime:
+    """Return the time before which invoices still In-Flight are assumed lost"""
+    return add_to_date(now_datetime(), minutes=-IN_FLIGHT_WINDOW_MINUTES)
+
+
+def get_eod_records() -> None:
+    """Fetch the End Of Day summaries of every active device, backfilling the days they missed"""
+    fetch_eod_summaries()
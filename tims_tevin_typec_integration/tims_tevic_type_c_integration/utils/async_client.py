@@ -0,0 +1,133 @@
+"""Asynchronous HTTP client to the TIMS devices.
+
+A single worker keeps up to `max_concurrency` invoice submissions in flight
+on one event loop, instead of blocking on each round-trip or holding a thread
+per request. Connections to each device are pooled and kept alive for the
+lifetime of the client.
+
+Errors are raised as their `requests` equivalents, so responses and failures
+are handled the same way as those of the synchronous session.
+"""
+
+import asyncio
+
+import httpx
+import requests
+
+DEFAULT_MAX_CONCURRENCY = 32
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_DEADLINE = 60  # seconds
+DEFAULT_MAX_RETRIES = 3
+
+
+class AsyncTIMSClient:
+    """Sends invoices to TIMS devices with at most `max_concurrency` requests
+    in flight across all devices, each given `deadline` seconds to complete.
+
+    Use it as an async context manager, so its connections are closed on exit::
+
+        async with AsyncTIMSClient(max_concurrency=64) as client:
+            response = await client.post(url, content)
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        deadline: float = DEFAULT_DEADLINE,
+        connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+    ):
+        self.max_concurrency = max(max_concurrency or DEFAULT_MAX_CONCURRENCY, 1)
+        self.deadline = deadline or DEFAULT_DEADLINE
+        self.connect_timeout = connect_timeout or DEFAULT_CONNECT_TIMEOUT
+        self.max_retries = DEFAULT_MAX_RETRIES if max_retries is None else max_retries
+
+        self._clients: dict[str, httpx.AsyncClient] = {}
+        self._semaphore: asyncio.Semaphore | None = None
+
+    async def __aenter__(self) -> "AsyncTIMSClient":
+        # Created here so it's bound to the running event loop
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await asyncio.gather(*(client.aclose() for client in self._clients.values()))
+        self._clients.clear()
+
+    def get_client(self, url: str) -> httpx.AsyncClient:
+        """Return the pooled client to the device the URL points to"""
+        origin = httpx.URL(url).copy_with(path="/", query=None, fragment=None)
+        key = str(origin)
+
+        if key not in self._clients:
+            limits = httpx.Limits(
+                max_connections=self.max_concurrency,
+                max_keepalive_connections=self.max_concurrency,
+            )
+            # Like the synchronous session, only failures to connect are retried,
+            # so an invoice that reached the device is never sent twice
+            transport = httpx.AsyncHTTPTransport(limits=limits, retries=self.max_retries)
+
+            self._clients[key] = httpx.AsyncClient(
+                transport=transport,
+                timeout=httpx.Timeout(self.deadline, connect=self.connect_timeout),
+            )
+
+        return self._clients[key]
+
+    async def post(
+        self, url: str, content: bytes, deadline: float | None = None
+    ) -> httpx.Response:
+        """Post a serialised payload to the device once a slot is free.
+
+        Args:
+            url (str): The device endpoint
+            content (bytes): The JSON encoded payload
+            deadline (float | None, optional): Seconds the request may take once sent. Defaults to the client's deadline.
+
+        Raises:
+            requests.exceptions.ConnectionError: If the device couldn't be reached
+            requests.exceptions.ReadTimeout: If the device didn't answer before the deadline
+            requests.exceptions.HTTPError: If the device answered with an error status
+
+        Returns:
+            httpx.Response: The device's response
+        """
+        async with self._semaphore:
+            try:
+                response = await asyncio.wait_for(
+                    self.get_client(url).post(
+                        url,
+                        content=content,
+                        headers={"Content-Type": "application/json"},
+                    ),
+                    deadline or self.deadline,
+                )
+
+            except (httpx.ConnectError, httpx.ConnectTimeout) as error:
+                raise requests.exceptions.ConnectionError(str(error)) from error
+
+            except (asyncio.TimeoutError, httpx.TimeoutException) as error:
+                raise requests.exceptions.ReadTimeout(
+                    f"No response from {url} within the deadline"
+                ) from error
+
+            except httpx.HTTPError as error:
+                raise requests.exceptions.RequestException(str(error)) from error
+
+        if response.is_error:
+            raise requests.exceptions.HTTPError(
+                f"{response.status_code} Error for url: {url}", response=response
+            )
+
+        return response
+
+
+def get_async_client(setting) -> AsyncTIMSClient:
+    """Return a client configured from the TIMS Settings of a device"""
+    return AsyncTIMSClient(
+        max_concurrency=setting.async_concurrency,
+        deadline=setting.request_deadline,
+        connect_timeout=setting.connect_timeout,
+        max_retries=setting.max_retries,
+    )
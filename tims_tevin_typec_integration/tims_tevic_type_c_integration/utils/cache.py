@@ -0,0 +1,294 @@
+"""Cache of the TIMS Settings and tax metadata read on every invoice submission.
+
+Lookups go through a process-local cache first, then Redis, and only hit the
+database on a miss. Redis entries are cleared by the `on_update` and `on_trash`
+hooks of the doctypes they are derived from. Process-local entries expire after
+`LOCAL_CACHE_TTL` seconds, so other workers pick up changes shortly after.
+"""
+
+import time
+from collections.abc import Callable
+
+import frappe
+
+SETTINGS_CACHE_KEY = "tims_settings"
+TAX_METADATA_CACHE_KEY = "tims_tax_metadata"
+TAX_TEMPLATE_CACHE_KEY = "tims_tax_template"
+ITEM_TAX_TEMPLATE_CACHE_KEY = "tims_item_tax_template"
+CACHE_STATS_KEY = "tims_cache_stats"
+
+# Field the metadata of invoices without a Tax Category is cached under, as
+# Redis hash fields can't be empty
+NO_TAX_CATEGORY = "__none__"
+
+LOCAL_CACHE_TTL = 30  # seconds
+STATS_FLUSH_INTERVAL = 50  # lookups
+
+SETTING_FIELDS = [
+    "name",
+    "company",
+    "server_address",
+    "sender_id",
+    "pos_profile",
+    "warehouse",
+    "branch",
+    "resend_limit",
+    "resend_concurrency",
+    "max_attempts",
+    "resend_backoff_minutes",
+    "max_resend_backoff_minutes",
+    "pool_size",
+    "connect_timeout",
+    "read_timeout",
+    "max_retries",
+    "retry_backoff_factor",
+    "qr_code_format",
+    "qr_code_box_size",
+    "qr_code_error_correction",
+    "qr_code_storage",
+    "queue",
+    "rate_limit",
+    "rate_limit_burst",
+    "breaker_failure_threshold",
+    "breaker_probe_interval",
+    "aggregate_item_lines",
+    "build_payloads_in_background",
+    "use_async_client",
+    "async_concurrency",
+    "request_deadline",
+]
+
+_local_cache: dict[tuple[str, str, str], tuple[float, object]] = {}
+_unflushed_stats = {"hits": 0, "misses": 0}
+
+
+def get_active_tims_settings() -> list[frappe._dict]:
+    """Return every active TIMS Settings record"""
+    settings = get_cached_value(
+        SETTINGS_CACHE_KEY,
+        "active",
+        lambda: frappe.get_all(
+            "TIMS Settings",
+            filters={"is_active": 1},
+            fields=SETTING_FIELDS,
+            order_by="creation",
+        ),
+    )
+
+    return [frappe._dict(setting) for setting in settings]
+
+
+def get_tims_setting(company: str) -> frappe._dict | None:
+    """Return the active TIMS Settings record tied to the given company, if any"""
+    for setting in get_active_tims_settings():
+        if setting.company == company:
+            return setting
+
+    return None
+
+
+def get_tax_metadata(tax_category: str | None) -> frappe._dict:
+    """Return the HS Code and the sales tax rate of the given Tax Category
+
+    Args:
+        tax_category (str | None): The Tax Category
+
+    Returns:
+        frappe._dict: The `hs_code`, `sales_tax_template` and `tax_rate`. The
+            template and rate are None when no sales Tax Rule uses the category.
+    """
+    tax_category = tax_category or ""
+
+    return frappe._dict(
+        get_cached_value(
+            TAX_METADATA_CACHE_KEY,
+            tax_category or NO_TAX_CATEGORY,
+            lambda: fetch_tax_metadata(tax_category),
+        )
+    )
+
+
+def prefetch_tax_metadata(tax_categories: set[str | None]) -> None:
+    """Resolve the tax metadata of several Tax Categories with one query per table,
+    and cache the ones not cached yet"""
+    cache = frappe.cache()
+    missing = [
+        tax_category or ""
+        for tax_category in tax_categories
+        if cache.hget(TAX_METADATA_CACHE_KEY, tax_category or NO_TAX_CATEGORY) is None
+    ]
+    if not missing:
+        return
+
+    hs_codes = dict(
+        frappe.get_all(
+            "Tax Category",
+            filters={"name": ["in", missing]},
+            fields=["name", "custom_hs_code"],
+            as_list=True,
+        )
+    )
+    sales_tax_templates = dict(
+        frappe.get_all(
+            "Tax Rule",
+            filters={"tax_category": ["in", missing], "tax_type": "Sales"},
+            fields=["tax_category", "sales_tax_template"],
+            # Highest priority last, so it's the one kept
+            order_by="priority asc",
+            as_list=True,
+        )
+    )
+    tax_rates = dict(
+        frappe.get_all(
+            "Sales Taxes and Charges",
+            filters={
+                "parent": ["in", list(set(sales_tax_templates.values()))],
+                "parenttype": "Sales Taxes and Charges Template",
+            },
+            fields=["parent", "rate"],
+            # First row last, so it's the one kept
+            order_by="idx desc",
+            as_list=True,
+        )
+    )
+
+    for tax_category in missing:
+        sales_tax_template = sales_tax_templates.get(tax_category)
+        cache.hset(
+            TAX_METADATA_CACHE_KEY,
+            tax_category or NO_TAX_CATEGORY,
+            (
+                {
+                    "hs_code": hs_codes.get(tax_category),
+                    "sales_tax_template": sales_tax_template,
+                    "tax_rate": tax_rates.get(sales_tax_template),
+                },
+            ),
+        )
+
+
+def fetch_tax_metadata(tax_category: str) -> dict:
+    # HS Codes are mapped in the Tax Category doctype.
+    # NOTE: VATABLE tax category never has an HS Code
+    hs_code = frappe.db.get_value(
+        "Tax Category", {"name": tax_category}, ["custom_hs_code"]
+    )
+    # Use the Sales Tax Template to determine the Tax Rate
+    sales_tax_template = frappe.db.get_value(
+        "Tax Rule",
+        {"tax_category": tax_category, "tax_type": "Sales"},
+        ["sales_tax_template"],
+        order_by="priority desc",
+    )
+    tax_rate = None
+    if sales_tax_template:
+        tax_rate = frappe.db.get_value(
+            "Sales Taxes and Charges",
+            {
+                "parent": sales_tax_template,
+                "parenttype": "Sales Taxes and Charges Template",
+            },
+            ["rate"],
+            order_by="idx asc",
+        )
+
+    return {
+        "hs_code": hs_code,
+        "sales_tax_template": sales_tax_template,
+        "tax_rate": tax_rate,
+    }
+
+
+def get_cached_value(key: str, field: str, generator: Callable[[], object]) -> object:
+    """Look the value up in the process-local cache, then Redis, then generate it"""
+    local_key = (frappe.local.site, key, field)
+
+    entry = _local_cache.get(local_key)
+    if entry and entry[0] > time.monotonic():
+        record_lookup("hits")
+        return entry[1]
+
+    # None can't be told apart from a missing entry in Redis, so the
+    # value is wrapped in a tuple
+    cached = frappe.cache().hget(key, field)
+    if cached is None:
+        record_lookup("misses")
+        cached = (generator(),)
+        frappe.cache().hset(key, field, cached)
+    else:
+        record_lookup("hits")
+
+    _local_cache[local_key] = (time.monotonic() + LOCAL_CACHE_TTL, cached[0])
+
+    return cached[0]
+
+
+def clear_cached_values(key: str) -> None:
+    frappe.cache().delete_value(key)
+
+    for local_key in list(_local_cache):
+        if local_key[:2] == (frappe.local.site, key):
+            _local_cache.pop(local_key, None)
+
+
+def clear_tims_settings_cache(doc=None, method: str | None = None) -> None:
+    """Clear the cached TIMS Settings. Called from the TIMS Settings controller."""
+    clear_cached_values(SETTINGS_CACHE_KEY)
+
+
+def clear_tax_metadata_cache(doc=None, method: str | None = None) -> None:
+    """Clear the cached tax metadata and template rates.
+
+    Hooked to Tax Category, Tax Rule, Sales Taxes and Charges Template and
+    Item Tax Template. A change to any of them can affect several Tax
+    Categories, so every entry is cleared.
+    """
+    for key in (TAX_METADATA_CACHE_KEY, TAX_TEMPLATE_CACHE_KEY, ITEM_TAX_TEMPLATE_CACHE_KEY):
+        clear_cached_values(key)
+
+
+def record_lookup(outcome: str) -> None:
+    _unflushed_stats[outcome] += 1
+
+    # Misses already pay for database round-trips, so flush with them
+    if (
+        outcome == "misses"
+        or _unflushed_stats["hits"] + _unflushed_stats["misses"]
+        >= STATS_FLUSH_INTERVAL
+    ):
+        flush_cache_stats()
+
+
+def flush_cache_stats() -> None:
+    """Add this process' hit and miss counts to the shared counters in Redis"""
+    cache = frappe.cache()
+    key = cache.make_key(CACHE_STATS_KEY)
+
+    pipeline = cache.pipeline()
+    for outcome, count in _unflushed_stats.items():
+        if count:
+            pipeline.hincrby(key, outcome, count)
+    pipeline.execute()
+
+    _unflushed_stats.update(hits=0, misses=0)
+
+
+@frappe.whitelist()
+def get_cache_stats() -> dict:
+    """Return the cache hits and misses counted by all processes"""
+    frappe.only_for("System Manager")
+    flush_cache_stats()
+
+    # Counters are stored as plain integers, so bypass the unpickling wrapper
+    pipeline = frappe.cache().pipeline()
+    pipeline.hgetall(frappe.cache().make_key(CACHE_STATS_KEY))
+    (stats,) = pipeline.execute()
+
+    hits = int(stats.get(b"hits", 0))
+    misses = int(stats.get(b"misses", 0))
+
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": round(hits / (hits + misses), 4) if hits + misses else 0,
+    }
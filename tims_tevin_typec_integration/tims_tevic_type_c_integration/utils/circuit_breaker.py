@@ -0,0 +1,109 @@
+"""Per-device circuit breaker shared by all workers through Redis.
+
+After `breaker_failure_threshold` consecutive failures to reach a device, or
+as soon as it misses a heartbeat, its circuit opens, and nothing is dispatched
+to it until a heartbeat finds the device reachable again and closes the circuit.
+
+Reading a circuit is part of routing each submitted invoice, so the HTTP client
+is only imported by the function that handles the device's errors.
+"""
+
+import time
+
+import frappe
+
+CIRCUIT_BREAKER_KEY = "tims_circuit_breaker"
+DEFAULT_FAILURE_THRESHOLD = 5
+
+CLOSED, OPEN = "Closed", "Open"
+
+# Each circuit is a hash of its `state`, `failures` and `opened_at`, updated by
+# these scripts so the changes of concurrent workers aren't lost
+
+# Counts a failure to reach the device, and opens the circuit once the
+# consecutive failures reach the threshold. Returns 1 if the circuit is open
+RECORD_FAILURE_SCRIPT = """
+local failures = redis.call("HINCRBY", KEYS[1], "failures", 1)
+if redis.call("HGET", KEYS[1], "state") == ARGV[3] then
+    return 1
+end
+
+if failures >= tonumber(ARGV[1]) then
+    redis.call("HMSET", KEYS[1], "state", ARGV[3], "opened_at", ARGV[2])
+    return 1
+end
+
+return 0
+"""
+
+# Closes the circuit, only writing to it if it was open or had failures
+RECORD_SUCCESS_SCRIPT = """
+local circuit = redis.call("HMGET", KEYS[1], "state", "failures")
+if (circuit[1] and circuit[1] ~= ARGV[1]) or (tonumber(circuit[2]) or 0) > 0 then
+    redis.call("HMSET", KEYS[1], "state", ARGV[1], "failures", 0)
+end
+"""
+
+
+def get_circuit_key(server_address: str) -> str:
+    return frappe.cache().make_key(f"{CIRCUIT_BREAKER_KEY}:{server_address}")
+
+
+def get_circuit(server_address: str) -> frappe._dict:
+    """Return the circuit's `state`, consecutive `failures`, and when it was `opened_at`"""
+    pipeline = frappe.cache().pipeline(transaction=False)
+    pipeline.hmget(get_circuit_key(server_address), "state", "failures", "opened_at")
+    ((state, failures, opened_at),) = pipeline.execute()
+
+    return frappe._dict(
+        state=state.decode() if state else CLOSED,
+        failures=int(failures or 0),
+        opened_at=float(opened_at) if opened_at else None,
+    )
+
+
+def is_circuit_open(server_address: str) -> bool:
+    return get_circuit(server_address).state == OPEN
+
+
+def record_success(server_address: str) -> None:
+    frappe.cache().register_script(RECORD_SUCCESS_SCRIPT)(
+        keys=[get_circuit_key(server_address)], args=[CLOSED]
+    )
+
+
+def record_failure(setting: frappe._dict) -> bool:
+    """Count a failure to reach the setting's device, opening its circuit past the threshold
+
+    Returns:
+        bool: True if the circuit is open
+    """
+    return bool(
+        frappe.cache().register_script(RECORD_FAILURE_SCRIPT)(
+            keys=[get_circuit_key(setting.server_address)],
+            args=[
+                setting.breaker_failure_threshold or DEFAULT_FAILURE_THRESHOLD,
+                time.time(),
+                OPEN,
+            ],
+        )
+    )
+
+
+def open_circuit(server_address: str) -> None:
+    """Open the circuit at once, e.g. when the device misses a heartbeat"""
+    pipeline = frappe.cache().pipeline(transaction=False)
+    pipeline.hset(
+        get_circuit_key(server_address), mapping={"state": OPEN, "opened_at": time.time()}
+    )
+    pipeline.execute()
+
+
+def is_device_failure(error: Exception) -> bool:
+    """Whether the error means the device itself is failing, rather than rejecting the invoice"""
+    import requests
+
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response is not None and error.response.status_code >= 500
+
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
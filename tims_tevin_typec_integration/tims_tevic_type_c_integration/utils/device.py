@@ -0,0 +1,108 @@
+"""Pooled, keep-alive HTTP sessions to the TIMS devices.
+
+Each worker process keeps one `requests.Session` per device, so consecutive
+invoices reuse open connections instead of paying a TCP connect each. Sessions
+must be looked up on the main thread, as they are configured from the cached
+TIMS Settings, but can then be shared by the threads sending requests.
+"""
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import frappe
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 60
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_RETRY_BACKOFF_FACTOR = 0.5
+
+_sessions: dict[str, tuple[tuple, requests.Session]] = {}
+
+
+def get_device_session(setting: frappe._dict | None) -> requests.Session:
+    """Return the pooled session used to talk to the setting's device
+
+    Args:
+        setting (frappe._dict | None): The TIMS Settings of the device
+
+    Returns:
+        requests.Session: The session, created on first use or when the
+            setting's connection options have changed
+    """
+    if not setting:
+        return get_session("", DEFAULT_POOL_SIZE, DEFAULT_MAX_RETRIES)
+
+    return get_session(
+        setting.server_address,
+        setting.pool_size or DEFAULT_POOL_SIZE,
+        DEFAULT_MAX_RETRIES if setting.max_retries is None else setting.max_retries,
+        setting.retry_backoff_factor or DEFAULT_RETRY_BACKOFF_FACTOR,
+    )
+
+
+def get_session(
+    server_address: str,
+    pool_size: int = DEFAULT_POOL_SIZE,
+    max_retries: int = DEFAULT_MAX_RETRIES,
+    backoff_factor: float = DEFAULT_RETRY_BACKOFF_FACTOR,
+) -> requests.Session:
+    """Return this process' session to the given server address.
+
+    Only failures to connect are retried, with exponential backoff. The
+    invoice has not reached the device when those happen, so retrying a
+    POST can't fiscalise it twice.
+    """
+    options = (pool_size, max_retries, backoff_factor)
+
+    cached = _sessions.get(server_address)
+    if cached and cached[0] == options:
+        return cached[1]
+
+    retry = Retry(
+        total=max_retries,
+        connect=max_retries,
+        read=0,
+        status=0,
+        other=0,
+        backoff_factor=backoff_factor,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    if cached:
+        cached[1].close()
+    _sessions[server_address] = (options, session)
+
+    return session
+
+
+def get_device_timeout(setting: frappe._dict | None) -> tuple[float, float]:
+    """Return the (connect, read) timeout of requests to the setting's device"""
+    setting = setting or frappe._dict()
+
+    return (
+        setting.connect_timeout or DEFAULT_CONNECT_TIMEOUT,
+        setting.read_timeout or DEFAULT_READ_TIMEOUT,
+    )
+
+
+def get_job_timeout(setting: frappe._dict | None) -> int:
+    """Return a background job timeout long enough for one request with all its retries"""
+    setting = setting or frappe._dict()
+    connect_timeout, read_timeout = get_device_timeout(setting)
+    max_retries = DEFAULT_MAX_RETRIES if setting.max_retries is None else setting.max_retries
+    backoff_factor = setting.retry_backoff_factor or DEFAULT_RETRY_BACKOFF_FACTOR
+
+    return int(
+        connect_timeout * (max_retries + 1)
+        + backoff_factor * 2**max_retries
+        + read_timeout
+        + 5
+    )
+
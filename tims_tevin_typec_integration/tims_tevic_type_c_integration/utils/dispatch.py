@@ -0,0 +1,240 @@
+"""Bounded-concurrency dispatch of invoices to the TIMS device.
+
+Only the HTTP round-trips run on worker threads, or on an event loop when the
+device uses the async client. Every database write happens on the calling
+thread, since a Frappe database connection must not be shared between threads.
+"""
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import httpx
+import requests
+
+import frappe
+from frappe.utils import now_datetime
+
+from ..overrides.server.sales_invoice import set_tims_status
+from .async_client import get_async_client
+from .circuit_breaker import is_device_failure, record_failure, record_success
+from .device import get_device_session, get_device_timeout
+from .fiscalisation import (
+    CIRCUIT_OPEN_ERROR,
+    RATE_LIMITED_ERROR,
+    handle_tims_error,
+    handle_tims_response,
+    send_tims_request,
+)
+from .metrics import count_outcome, observe
+from .payload import dumps_payload
+from .rate_limit import RateLimitExceeded, get_token_bucket
+from .request_log import update_request_log
+
+DEFAULT_CONCURRENCY = 4
+
+# Errors recorded against the request, rather than aborting the whole dispatch
+DISPATCH_ERRORS = (RateLimitExceeded, requests.exceptions.RequestException)
+
+
+def dispatch_tims_requests(
+    tims_requests: list[frappe._dict],
+    setting: frappe._dict,
+    concurrency: int = DEFAULT_CONCURRENCY,
+) -> frappe._dict:
+    """Send invoice payloads to the TIMS device, at most `concurrency` at a time.
+
+    Each request waits for a token from the device's rate limiter. Once the
+    device is found to be unreachable, or its circuit opens, requests that have
+    not been sent yet are cancelled instead of each waiting out the timeout.
+
+    When the setting uses the async client, the requests are sent from an event
+    loop instead of a thread pool, with the setting's async concurrency.
+
+    Args:
+        tims_requests (list[frappe._dict]): Requests to send, each with a `url`,
+            `payload` and `invoice`
+        setting (frappe._dict): The TIMS Settings of the device the requests are sent to
+        concurrency (int, optional): Maximum number of requests in flight. Defaults to 4.
+
+    Returns:
+        frappe._dict: Counts of the completed, failed and cancelled requests, and
+            whether the device was unreachable
+    """
+    result = frappe._dict(
+        completed=0, failed=0, cancelled=0, device_unreachable=False
+    )
+    if not tims_requests:
+        return result
+
+    if setting.use_async_client:
+        return asyncio.run(
+            dispatch_tims_requests_async(tims_requests, setting, result)
+        )
+
+    session = get_device_session(setting)
+    timeout = get_device_timeout(setting)
+    token_bucket = get_token_bucket(setting)
+
+    def send(tims_request: frappe._dict) -> requests.Response:
+        if not token_bucket.acquire():
+            raise RateLimitExceeded
+
+        start = time.perf_counter()
+        try:
+            return send_tims_request(
+                tims_request.url, tims_request.payload, timeout, session
+            )
+        finally:
+            # Only recorded here; observed on the calling thread
+            tims_request.round_trip = time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        futures = {
+            executor.submit(send, tims_request): tims_request
+            for tims_request in tims_requests
+        }
+
+        for future in as_completed(futures):
+            if future.cancelled():
+                handle_dispatch_result(futures[future], setting, result, cancelled=True)
+                continue
+
+            response, error = None, future.exception()
+            if not error:
+                response = future.result()
+            elif not isinstance(error, DISPATCH_ERRORS):
+                raise error
+
+            if handle_dispatch_result(futures[future], setting, result, response, error):
+                for pending in futures:
+                    pending.cancel()
+
+    return result
+
+
+async def dispatch_tims_requests_async(
+    tims_requests: list[frappe._dict],
+    setting: frappe._dict,
+    result: frappe._dict,
+) -> frappe._dict:
+    """Send invoice payloads to the TIMS device from a single event loop.
+
+    Up to the setting's async concurrency are kept in flight, each given the
+    setting's request deadline. Results are handled as requests complete, on
+    the calling thread, exactly like those of `dispatch_tims_requests`.
+    """
+    token_bucket = get_token_bucket(setting)
+
+    async with get_async_client(setting) as client:
+
+        async def send(tims_request: frappe._dict) -> httpx.Response:
+            if not await token_bucket.acquire_async():
+                raise RateLimitExceeded
+
+            start = time.perf_counter()
+            try:
+                return await client.post(
+                    tims_request.url, dumps_payload(tims_request.payload)
+                )
+            finally:
+                tims_request.round_trip = time.perf_counter() - start
+
+        tasks = {
+            asyncio.ensure_future(send(tims_request)): tims_request
+            for tims_request in tims_requests
+        }
+
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+
+            for task in done:
+                if task.cancelled():
+                    handle_dispatch_result(tasks[task], setting, result, cancelled=True)
+                    continue
+
+                response, error = None, task.exception()
+                if not error:
+                    response = task.result()
+                elif not isinstance(error, DISPATCH_ERRORS):
+                    raise error
+
+                if handle_dispatch_result(tasks[task], setting, result, response, error):
+                    # Invoices already sent by a cancelled task are left Pending,
+                    # and the device answers with the Existing one when resent
+                    for pending_task in pending:
+                        pending_task.cancel()
+
+    return result
+
+
+def handle_dispatch_result(
+    tims_request: frappe._dict,
+    setting: frappe._dict,
+    result: frappe._dict,
+    response: requests.Response | httpx.Response | None = None,
+    error: Exception | None = None,
+    cancelled: bool = False,
+) -> bool:
+    """Record the outcome of a dispatched request and count it in `result`.
+
+    The request's `outcome` is set to Completed, Failed or Cancelled. Completed
+    requests also get the device's `output`, and failed ones their `error` and
+    whether they `reached_device`. The round-trip and outcome are observed in
+    the TIMS metrics.
+
+    Returns:
+        bool: True if the device was just found to be unreachable, so requests
+            not sent yet should be cancelled
+    """
+    if cancelled or isinstance(error, RateLimitExceeded):
+        update_request_log(
+            tims_request.invoice,
+            "Cancelled",
+            error=RATE_LIMITED_ERROR if error else CIRCUIT_OPEN_ERROR,
+        )
+        set_tims_status(tims_request.invoice, "Pending")
+        tims_request.outcome = "Cancelled"
+        count_outcome(setting.name, tims_request.outcome)
+        result.cancelled += 1
+        return False
+
+    if tims_request.round_trip is not None:
+        observe("round_trip", setting.name, tims_request.round_trip)
+
+    if error:
+        # Connection errors were already retried, so the device is unreachable
+        unreachable = isinstance(error, requests.exceptions.ConnectionError)
+        if is_device_failure(error) and record_failure(setting):
+            unreachable = True
+
+        handle_tims_error(error, tims_request.invoice, setting.name)
+        tims_request.outcome, tims_request.error = "Failed", str(error)
+        count_outcome(setting.name, tims_request.outcome)
+        tims_request.reached_device = not isinstance(
+            error, requests.exceptions.ConnectionError
+        )
+        result.failed += 1
+
+        if unreachable and not result.device_unreachable:
+            result.device_unreachable = True
+            return True
+
+        return False
+
+    record_success(setting.server_address)
+    handle_tims_response(response, setting)
+    tims_request.outcome, tims_request.output = "Completed", response.text
+    count_outcome(setting.name, tims_request.outcome)
+    if tims_request.queued_at:
+        observe(
+            "fiscalisation",
+            setting.name,
+            (now_datetime() - tims_request.queued_at).total_seconds(),
+        )
+    result.completed += 1
+
+    return False
@@ -0,0 +1,222 @@
+"""Fetching of the TIMS devices' End Of Day summaries.
+
+The summaries of every active device are fetched concurrently from one job,
+each request bounded by its own device's timeouts, so a slow or offline
+device neither holds up nor hides the others. Days missed since a device's
+last summary, e.g. while it or the scheduler was down, are fetched in the same
+pass, up to `MAX_BACKFILL_DAYS` back, by passing the day as the `date` query
+parameter of the device's EOD endpoint.
+
+Summaries are upserted by their device and EOD ID, which devices number
+independently, so fetching one again updates it instead of failing, and each
+is then reconciled against ERPNext.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date
+
+import requests
+
+import frappe
+from frappe.utils import add_days, cint, flt, getdate, now_datetime, today
+
+from .cache import get_active_tims_settings
+from .circuit_breaker import is_circuit_open
+from .device import get_device_session, get_device_timeout
+from .failures import record_failure_event
+from .reconciliation import EOD_DOCTYPE, enqueue_reconciliation
+
+EOD_FETCH_CONCURRENCY = 8
+MAX_BACKFILL_DAYS = 31
+
+# Key in the device's summary > End Of Day TIMS Records field, and its type
+EOD_FIELDS = {
+    "EODId": ("end_of_day_id", str),
+    "DateOfEODSummary": ("date_of_summary", getdate),
+    "EODTransmissionTimestamp": ("transmission_timestamp", str),
+    "NumberOfFirstInvoice": ("first_invoice_number", cint),
+    "NumberOfLastInvoice": ("last_invoice_number", cint),
+    "TotalInvoiceAmountOfTheDay": ("total_invoice_amount", flt),
+    "TotalTaxableAmountOfTheDay": ("total_taxable_amount", flt),
+    "TotalTaxAmountOfTheDay": ("total_tax_amount", flt),
+    "NumberOfInvoicesSentOfTheDay": ("number_of_invoices_sent", cint),
+}
+
+# Errors recorded against the device, rather than failing the whole fetch
+FETCH_ERRORS = (requests.exceptions.RequestException, ValueError, KeyError)
+
+
+def fetch_eod_summaries(
+    settings: list[frappe._dict] | None = None, backfill: bool = True
+) -> list[str]:
+    """Fetch and store the latest End Of Day summary of each device, and those of the days it missed
+
+    Args:
+        settings (list[frappe._dict] | None, optional): The TIMS Settings of the devices. Defaults to every active one.
+        backfill (bool, optional): Whether to also fetch the days missed since each device's last summary. Defaults to True.
+
+    Returns:
+        list[str]: The End Of Day TIMS Records entries created or updated
+    """
+    settings = [
+        setting
+        for setting in (settings or get_active_tims_settings())
+        if not is_circuit_open(setting.server_address)
+    ]
+    if not settings:
+        return []
+
+    # None fetches the latest summary
+    days = {setting.name: [None] for setting in settings}
+    if backfill:
+        for device, missed_days in get_missed_days(settings).items():
+            days[device].extend(missed_days)
+
+    summaries = []
+    with ThreadPoolExecutor(
+        max_workers=min(sum(map(len, days.values())), EOD_FETCH_CONCURRENCY)
+    ) as executor:
+        # Sessions are looked up here, as they must be on the main thread
+        futures = {
+            executor.submit(
+                fetch_eod_summary,
+                setting,
+                day,
+                get_device_session(setting),
+                get_device_timeout(setting),
+            ): setting
+            for setting in settings
+            for day in days[setting.name]
+        }
+
+        for future in as_completed(futures):
+            setting = futures[future]
+            try:
+                summaries.append(parse_eod_summary(future.result(), setting))
+            except FETCH_ERRORS as error:
+                record_failure_event(error, device=setting.name)
+
+    records = upsert_eod_records(summaries)
+    for record in records:
+        enqueue_reconciliation(record)
+
+    return records
+
+
+def fetch_eod_summary(
+    setting: frappe._dict,
+    day: date | None,
+    session: requests.Session,
+    timeout: tuple[float, float],
+) -> dict:
+    """Get a device's End Of Day summary of the given day, or its latest one.
+
+    This only performs the HTTP round-trip, so it is safe to call from worker threads.
+    """
+    response = session.get(
+        f"{setting.server_address}/eod/{setting.sender_id}",
+        params={"date": day.isoformat()} if day else None,
+        timeout=timeout,
+    )
+    response.raise_for_status()
+
+    return response.json()
+
+
+def parse_eod_summary(summary: dict, setting: frappe._dict) -> dict:
+    """Map a device's summary to the fields of End Of Day TIMS Records"""
+    values = {field: parse(summary[key]) for key, (field, parse) in EOD_FIELDS.items()}
+    values["device"] = setting.name
+
+    return values
+
+
+def get_missed_days(settings: list[frappe._dict]) -> dict[str, list[date]]:
+    """Return the days before yesterday that each device has no summary for since its last one.
+
+    Devices with no summary yet have nothing to backfill.
+    """
+    last_days = dict(
+        frappe.db.sql(
+            """
+            SELECT device, MAX(date_of_summary)
+            FROM `tabEnd Of Day TIMS Records`
+            WHERE device IN %(devices)s
+            GROUP BY device
+            """,
+            {"devices": [setting.name for setting in settings]},
+        )
+    )
+
+    # Yesterday's summary is the latest, fetched without a date
+    yesterday = getdate(add_days(today(), -1))
+    earliest = getdate(add_days(yesterday, -MAX_BACKFILL_DAYS))
+
+    missed_days = {}
+    for device, last_day in last_days.items():
+        day = max(getdate(add_days(last_day, 1)), earliest)
+        while day < yesterday:
+            missed_days.setdefault(device, []).append(day)
+            day = getdate(add_days(day, 1))
+
+    return missed_days
+
+
+def upsert_eod_records(summaries: list[dict]) -> list[str]:
+    """Store summaries by their device and EOD ID, updating those already stored
+    and inserting the others with one bulk insert
+
+    Returns:
+        list[str]: The End Of Day TIMS Records entries
+    """
+    # The latest summary may also be one of the backfilled days
+    summaries = {
+        (summary["device"], summary["end_of_day_id"]): summary for summary in summaries
+    }
+    if not summaries:
+        return []
+
+    # Looked up by their fields, as records stored before EOD IDs were unique
+    # per device are named after the EOD ID alone
+    records = {
+        (record.device, record.end_of_day_id): record.name
+        for record in frappe.get_all(
+            EOD_DOCTYPE,
+            filters={"end_of_day_id": ["in", [key[1] for key in summaries]]},
+            fields=["name", "device", "end_of_day_id"],
+        )
+    }
+    for key, summary in summaries.items():
+        if key in records:
+            frappe.db.set_value(EOD_DOCTYPE, records[key], summary, update_modified=True)
+
+    new = [summary for key, summary in summaries.items() if key not in records]
+    if new:
+        now, user = now_datetime(), frappe.session.user
+        fields = list(new[0])
+
+        frappe.db.bulk_insert(
+            EOD_DOCTYPE,
+            fields=["name", "creation", "modified", "owner", "modified_by", *fields],
+            values=[
+                (
+                    get_eod_record_name(summary),
+                    now,
+                    now,
+                    user,
+                    user,
+                    *(summary[field] for field in fields),
+                )
+                for summary in new
+            ],
+            ignore_duplicates=True,
+        )
+
+    return [
+        records.get(key) or get_eod_record_name(summary) for key, summary in summaries.items()
+    ]
+
+
+def get_eod_record_name(summary: dict) -> str:
+    """Return the name of a summary's new End Of Day TIMS Records entry, as set by its autoname"""
+    return f"{summary['device']}-{summary['end_of_day_id']}"
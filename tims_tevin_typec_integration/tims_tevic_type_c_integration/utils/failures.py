@@ -0,0 +1,165 @@
+"""Failures of the requests to the TIMS devices, and their digest.
+
+Each failed request is recorded as a compact TIMS Failure Event in the same
+transaction as the failure itself, rather than emailing every System Manager
+on the spot. A scheduled job summarises the events not digested yet into a
+single queued email: the failures per device and error class, and the
+invoices that failed the most.
+"""
+
+import requests
+
+import frappe
+from frappe.utils import get_url_to_list, now_datetime
+from frappe.utils.user import get_users_with_role
+
+FAILURE_EVENT_DOCTYPE = "TIMS Failure Event"
+DIGEST_ROLE = "System Manager"
+DIGEST_TEMPLATE = "tims_failure_digest"
+TOP_FAILING_INVOICES = 10
+
+RECIPIENTS_CACHE_KEY = "tims_failure_digest_recipients"
+RECIPIENTS_CACHE_TTL = 3600  # seconds
+
+# The full response is kept on the request log
+MAX_ERROR_LENGTH = 500
+
+
+def record_failure_event(
+    error: Exception,
+    integration_request: str | None = None,
+    invoice: str | None = None,
+    device: str | None = None,
+) -> None:
+    """Record a failed request to be included in the next digest
+
+    Args:
+        error (Exception): The error raised by the request
+        integration_request (str | None, optional): The failed Integration Request. Defaults to None.
+        invoice (str | None, optional): The Sales Invoice that was sent. Defaults to None.
+        device (str | None, optional): The TIMS Settings of the device. Defaults to None.
+    """
+    now, user = now_datetime(), frappe.session.user
+
+    frappe.db.bulk_insert(
+        FAILURE_EVENT_DOCTYPE,
+        fields=[
+            "name",
+            "creation",
+            "modified",
+            "owner",
+            "modified_by",
+            "device",
+            "error_class",
+            "digested",
+            "sales_invoice",
+            "integration_request",
+            "error",
+        ],
+        values=[
+            (
+                frappe.generate_hash(length=10),
+                now,
+                now,
+                user,
+                user,
+                device,
+                get_error_class(error),
+                0,
+                invoice,
+                integration_request,
+                get_error_message(error)[:MAX_ERROR_LENGTH],
+            )
+        ],
+    )
+
+
+def get_error_class(error: Exception) -> str:
+    """Return the HTTP status the device answered with, e.g. HTTP 400, or the
+    kind of error if it didn't answer, e.g. ReadTimeout"""
+    response = getattr(error, "response", None)
+    if isinstance(error, requests.exceptions.HTTPError) and response is not None:
+        return f"HTTP {response.status_code}"
+
+    return type(error).__name__
+
+
+def get_error_message(error: Exception) -> str:
+    response = getattr(error, "response", None)
+    if isinstance(error, requests.exceptions.HTTPError) and response is not None:
+        return response.text or str(error)
+
+    return str(error)
+
+
+def send_failure_digest() -> None:
+    """Email a summary of the failures recorded since the last digest, if any.
+
+    Runs hourly. The email is queued, so the job never waits on the mail server.
+    """
+    until = now_datetime()
+
+    failures = frappe.db.sql(
+        """
+        SELECT device, error_class, COUNT(*) AS failures, MAX(creation) AS last_failure
+        FROM `tabTIMS Failure Event`
+        WHERE digested = 0 AND creation <= %(until)s
+        GROUP BY device, error_class
+        ORDER BY failures DESC
+        """,
+        {"until": until},
+        as_dict=True,
+    )
+    if not failures:
+        return
+
+    top_invoices = frappe.db.sql(
+        """
+        SELECT sales_invoice, COUNT(*) AS failures, MAX(creation) AS last_failure
+        FROM `tabTIMS Failure Event`
+        WHERE digested = 0 AND creation <= %(until)s AND sales_invoice IS NOT NULL
+        GROUP BY sales_invoice
+        ORDER BY failures DESC
+        LIMIT %(limit)s
+        """,
+        {"until": until, "limit": TOP_FAILING_INVOICES},
+        as_dict=True,
+    )
+
+    recipients = get_digest_recipients()
+    if recipients:
+        total = sum(row.failures for row in failures)
+
+        frappe.sendmail(
+            recipients,
+            subject=f"TIMS: {total} failed requests",
+            template=DIGEST_TEMPLATE,
+            args={
+                "total": total,
+                "failures": failures,
+                "top_invoices": top_invoices,
+                "events_url": get_url_to_list(FAILURE_EVENT_DOCTYPE),
+            },
+        )
+
+    frappe.db.set_value(
+        FAILURE_EVENT_DOCTYPE,
+        {"digested": 0, "creation": ["<=", until]},
+        "digested",
+        1,
+        update_modified=False,
+    )
+
+
+def get_digest_recipients() -> list[str]:
+    """Return the users the digest is sent to, cached for an hour"""
+    cache = frappe.cache()
+
+    recipients = cache.get_value(RECIPIENTS_CACHE_KEY)
+    if recipients is None:
+        recipients = get_users_with_role(DIGEST_ROLE)
+        cache.set_value(
+            RECIPIENTS_CACHE_KEY, recipients, expires_in_sec=RECIPIENTS_CACHE_TTL
+        )
+
+    return recipients
@@ -0,0 +1,110 @@
+"""Sending invoices to the TIMS device and recording its responses.
+
+Only imported by the jobs that send the invoices, as it loads the HTTP client
+and, through the QR codes, the imaging libraries, neither of which the Sales
+Invoice hooks need.
+"""
+
+import json
+
+import requests
+
+import frappe
+
+from ..overrides.server.sales_invoice import set_tims_status
+from .failures import record_failure_event
+from .metrics import timed
+from .payload import dumps_payload
+from .qr_code import get_qr_code_value
+from .request_log import update_request_log
+
+CIRCUIT_OPEN_ERROR = "Not sent as the TIMS device is unavailable"
+RATE_LIMITED_ERROR = "Not sent as the TIMS device's rate limit was reached"
+
+
+def send_tims_request(
+    url: str,
+    payload: dict | None = None,
+    timeout: int | float | tuple = 60,
+    session: requests.Session | None = None,
+) -> requests.Response:
+    """Post the payload to the TIMS device.
+
+    This only performs the HTTP round-trip and never touches the database,
+    so it is safe to call from worker threads.
+
+    Raises:
+        requests.exceptions.RequestException: If the request fails
+    """
+    response = (session or requests).post(
+        url=url,
+        data=dumps_payload(payload),
+        headers={"Content-Type": "application/json"},
+        timeout=timeout,
+    )
+    response.raise_for_status()  # Raise exception if HTTPError or any other exception is raised
+
+    return response
+
+
+def handle_tims_response(
+    response: requests.Response,
+    setting: frappe._dict | None = None,
+) -> None:
+    """Record a successful TIMS response against the Sales Invoice and its TIMS Request Log
+
+    Args:
+        response (requests.Response): The response returned by the device
+        setting (frappe._dict | None, optional): The TIMS Settings of the device. Defaults to None.
+    """
+    record_fiscalised_invoice(response.text, setting)
+
+
+def record_fiscalised_invoice(output: str, setting: frappe._dict | None = None) -> None:
+    """Record the device's response to a fiscalised invoice, whether just
+    received or kept from an earlier request"""
+    data = json.loads(output)
+    # The device answers with the Existing invoice if it was already fiscalised
+    invoice_info = data["Invoice"] if "Invoice" in data else data["Existing"]
+    invoice = f"INV-{invoice_info['TraderSystemInvoiceNumber']}"
+
+    device = setting.name if setting else None
+
+    with timed("qr_code", device):
+        qr_code = get_qr_code_value(invoice_info["QRCode"], invoice, setting)
+
+    # Both are single-row updates of only the changed columns, committed
+    # together with the job
+    with timed("write_back", device):
+        frappe.db.set_value(
+            "Sales Invoice",
+            invoice,
+            {
+                "custom_cu_invoice_number": invoice_info["ControlCode"],
+                "custom_qr_code": qr_code,
+                "custom_tims_status": "Fiscalised",
+            },
+            update_modified=True,
+        )
+        update_request_log(invoice, "Completed", output)
+
+
+def handle_tims_error(
+    error: requests.exceptions.RequestException,
+    invoice: str,
+    device: str | None = None,
+) -> None:
+    """Record a failed TIMS request for the failure digest and mark the Sales Invoice and its TIMS Request Log as Failed
+
+    Args:
+        error (requests.exceptions.RequestException): The error raised by the request
+        invoice (str): The Sales Invoice that was sent
+        device (str | None, optional): The TIMS Settings of the device. Defaults to None.
+    """
+    record_failure_event(error, invoice=invoice, device=device)
+
+    if isinstance(error, requests.exceptions.HTTPError):
+        error = f"{error.response.status_code}\n\n{error.response.text}"
+
+    update_request_log(invoice, "Failed", error=str(error))
+    set_tims_status(invoice, "Failed")
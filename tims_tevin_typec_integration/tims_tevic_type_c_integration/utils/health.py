@@ -0,0 +1,137 @@
+"""Heartbeat of the TIMS devices, with their health shared by all workers through Redis.
+
+A scheduled job probes each active device every `breaker_probe_interval`
+seconds with a GET to its server address. The outcome and latency are kept in
+Redis: the latest heartbeat per device, and a bounded history of them shown on
+TIMS Settings.
+
+Heartbeats are a single attempt with a short timeout, rather than going through
+the device's pooled session and its connection retries, and the devices due
+one are probed at the same time, so offline devices don't hold up the others'.
+
+A device that misses a heartbeat has its circuit opened at once. Its submitted
+invoices are then held in the outbox or failed over, and the jobs skip it, so
+no worker has to find a dead device out by waiting on a request's timeout.
+Once a heartbeat reaches it again, its circuit is closed and the backlog it
+built up while offline is replayed.
+"""
+
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import frappe
+
+from .circuit_breaker import is_circuit_open, open_circuit, record_success
+from .offline import start_replay
+
+HEALTH_KEY = "tims_device_health"
+HEALTH_HISTORY_KEY = "tims_device_health_history"
+
+DEFAULT_HEARTBEAT_INTERVAL = 60  # seconds
+HEARTBEAT_TIMEOUT = 3  # seconds, to connect and to answer
+MAX_CONCURRENT_HEARTBEATS = 16
+# Heartbeats are sent from the scheduler's ticks, which don't fall exactly an
+# interval apart
+HEARTBEAT_TOLERANCE = 5  # seconds
+HEALTH_HISTORY_LENGTH = 1440  # heartbeats, a day's worth at the default interval
+
+
+def check_devices(settings: list[frappe._dict]) -> dict[str, frappe._dict]:
+    """Send a heartbeat to each device that is due one, all at once, and open or
+    close their circuits by the outcome
+
+    Args:
+        settings (list[frappe._dict]): The TIMS Settings of the devices
+
+    Returns:
+        dict[str, frappe._dict]: The heartbeats sent, keyed by TIMS Settings
+    """
+    due = [setting for setting in settings if is_heartbeat_due(setting)]
+    if not due:
+        return {}
+
+    # Only the HTTP round-trips run on the threads; Redis is written to from here
+    with ThreadPoolExecutor(max_workers=min(len(due), MAX_CONCURRENT_HEARTBEATS)) as executor:
+        heartbeats = list(executor.map(send_heartbeat, due))
+
+    for setting, heartbeat in zip(due, heartbeats):
+        record_heartbeat(setting.server_address, heartbeat)
+
+        circuit_open = is_circuit_open(setting.server_address)
+        if not heartbeat.healthy and not circuit_open:
+            open_circuit(setting.server_address)
+
+        elif heartbeat.healthy and circuit_open:
+            record_success(setting.server_address)
+            start_replay(setting)
+
+    return {setting.name: heartbeat for setting, heartbeat in zip(due, heartbeats)}
+
+
+def check_device(setting: frappe._dict) -> frappe._dict | None:
+    """Send the device a heartbeat if one is due, and open or close its circuit by the outcome
+
+    Returns:
+        frappe._dict | None: The heartbeat, or None if none was due
+    """
+    return check_devices([setting]).get(setting.name)
+
+
+def is_heartbeat_due(setting: frappe._dict) -> bool:
+    """Whether the device's last heartbeat is older than the setting's interval"""
+    interval = setting.breaker_probe_interval or DEFAULT_HEARTBEAT_INTERVAL
+    last_checked_at = get_device_health(setting.server_address).checked_at
+
+    return time.time() - (last_checked_at or 0) >= interval - HEARTBEAT_TOLERANCE
+
+
+def send_heartbeat(setting: frappe._dict) -> frappe._dict:
+    """Probe the device once, returning whether it's `healthy` and its `latency_ms`.
+
+    Any HTTP response, whatever its status, means the device is up. This never
+    touches the database or Redis, so it is safe to call from worker threads.
+    """
+    start = time.perf_counter()
+
+    try:
+        requests.get(setting.server_address, timeout=HEARTBEAT_TIMEOUT)
+        healthy = True
+    except requests.exceptions.RequestException:
+        healthy = False
+
+    return frappe._dict(
+        healthy=healthy,
+        latency_ms=round((time.perf_counter() - start) * 1000, 1),
+        checked_at=time.time(),
+    )
+
+
+def record_heartbeat(server_address: str, heartbeat: frappe._dict) -> None:
+    cache = frappe.cache()
+    history_key = f"{HEALTH_HISTORY_KEY}:{server_address}"
+
+    cache.hset(HEALTH_KEY, server_address, dict(heartbeat))
+    cache.lpush(history_key, json.dumps(heartbeat))
+    cache.ltrim(history_key, 0, HEALTH_HISTORY_LENGTH - 1)
+
+
+def get_device_health(server_address: str) -> frappe._dict:
+    """Return the device's last heartbeat: whether it was `healthy`, its
+    `latency_ms`, and when it was `checked_at`"""
+    heartbeat = frappe.cache().hget(HEALTH_KEY, server_address) or {}
+
+    return frappe._dict(
+        healthy=heartbeat.get("healthy"),
+        latency_ms=heartbeat.get("latency_ms"),
+        checked_at=heartbeat.get("checked_at"),
+    )
+
+
+def get_health_history(server_address: str, limit: int = HEALTH_HISTORY_LENGTH) -> list[dict]:
+    """Return the device's last `limit` heartbeats, oldest first"""
+    history = frappe.cache().lrange(f"{HEALTH_HISTORY_KEY}:{server_address}", 0, limit - 1)
+
+    return [json.loads(heartbeat) for heartbeat in reversed(history)]
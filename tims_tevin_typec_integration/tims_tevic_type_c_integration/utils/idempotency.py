@@ -0,0 +1,126 @@
+"""Single-flight sending of invoices, keyed by their TraderSystemInvoiceNumber.
+
+Before a claimed batch is sent, each invoice takes a lock in Redis with
+`SET NX`, so however many jobs end up with the same invoice, e.g. one whose
+claim expired while its device was slow, only one call to the device is
+outstanding for it. The others defer the invoice instead of sending it again.
+
+The device's response to each fiscalised invoice is then kept for a day, and
+stored before its lock is released. An invoice that is locked again, e.g.
+requeued or picked up by a stale job, is recorded from that response without
+calling the device.
+"""
+
+import frappe
+
+from .outbox import CLAIM_TIMEOUT_MINUTES
+
+IN_FLIGHT_KEY = "tims_in_flight"
+FISCALISED_KEY = "tims_fiscalised"
+
+# Outlives a claim, so an invoice claimed again once its claim expired still
+# finds the first job's lock
+LOCK_TTL = CLAIM_TIMEOUT_MINUTES * 60 + 300  # seconds
+RESULT_TTL = 86400  # seconds
+
+# Deletes each lock that is still held with the given token, i.e. that hasn't
+# expired and been taken by another job since
+RELEASE_SCRIPT = """
+for _, key in ipairs(KEYS) do
+    if redis.call("GET", key) == ARGV[1] then
+        redis.call("DEL", key)
+    end
+end
+"""
+
+
+def get_invoice_number(invoice: str) -> str:
+    """Return the invoice's TraderSystemInvoiceNumber, i.e. INV-123456 > 123456"""
+    return invoice.split("-", 1)[-1]
+
+
+def get_fiscalised_results(invoices: list[str]) -> dict[str, str]:
+    """Return the device's responses to the invoices fiscalised within the last day
+
+    Returns:
+        dict[str, str]: The response bodies, keyed by Sales Invoice
+    """
+    if not invoices:
+        return {}
+
+    cache = frappe.cache()
+    outputs = cache.mget(
+        [
+            cache.make_key(f"{FISCALISED_KEY}:{get_invoice_number(invoice)}")
+            for invoice in invoices
+        ]
+    )
+
+    return {
+        invoice: output.decode()
+        for invoice, output in zip(invoices, outputs)
+        if output is not None
+    }
+
+
+def acquire_invoice_locks(invoices: list[str], token: str) -> set[str]:
+    """Lock the invoices to be sent by the caller, in one round-trip
+
+    Args:
+        invoices (list[str]): The Sales Invoices
+        token (str): Identifies the caller's locks, to release them
+
+    Returns:
+        set[str]: The invoices locked, i.e. not already in flight elsewhere
+    """
+    if not invoices:
+        return set()
+
+    cache = frappe.cache()
+    pipeline = cache.pipeline(transaction=False)
+    for invoice in invoices:
+        pipeline.set(
+            cache.make_key(f"{IN_FLIGHT_KEY}:{get_invoice_number(invoice)}"),
+            token,
+            nx=True,
+            ex=LOCK_TTL,
+        )
+
+    return {invoice for invoice, locked in zip(invoices, pipeline.execute()) if locked}
+
+
+def release_invoice_locks(
+    invoices: list[str], token: str, outputs: dict[str, str] | None = None
+) -> None:
+    """Store the responses to the fiscalised invoices and release the caller's locks
+
+    Args:
+        invoices (list[str]): The Sales Invoices locked with `token`
+        token (str): Identifies the caller's locks
+        outputs (dict[str, str] | None, optional): The responses of the fiscalised invoices,
+            keyed by Sales Invoice. Defaults to None.
+    """
+    if not invoices:
+        return
+
+    cache = frappe.cache()
+    pipeline = cache.pipeline(transaction=False)
+
+    # Stored before the locks are released, so the next job to lock an
+    # invoice finds its response
+    for invoice, output in (outputs or {}).items():
+        pipeline.set(
+            cache.make_key(f"{FISCALISED_KEY}:{get_invoice_number(invoice)}"),
+            output,
+            ex=RESULT_TTL,
+        )
+
+    cache.register_script(RELEASE_SCRIPT)(
+        keys=[
+            cache.make_key(f"{IN_FLIGHT_KEY}:{get_invoice_number(invoice)}")
+            for invoice in invoices
+        ],
+        args=[token],
+        client=pipeline,
+    )
+    pipeline.execute()
@@ -0,0 +1,47 @@
+"""Background jobs of the TIMS devices, as enqueued from the Sales Invoice hooks.
+
+Kept apart from the device's HTTP sessions, so submitting an invoice doesn't
+load the HTTP client, which only the jobs sending the invoices use.
+"""
+
+import frappe
+from frappe.utils.background_jobs import get_queue_list
+
+from .cache import get_active_tims_settings
+
+DEFAULT_QUEUE = "tims"
+FLUSH_JOB_TIMEOUT = 1500
+
+
+def get_tims_queue(setting: frappe._dict | None, fallback: str = "default") -> str:
+    """Return the background job queue TIMS jobs of the setting are enqueued on.
+
+    The queue must have workers configured under `workers` in common_site_config.json,
+    otherwise jobs are enqueued on the `fallback` queue instead.
+    """
+    queue = (setting or frappe._dict()).queue or DEFAULT_QUEUE
+
+    return queue if queue in get_queue_list() else fallback
+
+
+def enqueue_flush_job(setting: frappe._dict, after_commit: bool = False) -> None:
+    """Enqueue the job sending the pending invoices of the setting's device,
+    unless it's already queued or running"""
+    frappe.enqueue(
+        "tims_tevin_typec_integration.tims_tevic_type_c_integration.tasks.tasks.flush_pending_invoices",
+        setting=setting.name,
+        queue=get_tims_queue(setting),
+        job_id=f"tims_flush::{setting.name}",
+        deduplicate=True,
+        enqueue_after_commit=after_commit,
+        timeout=FLUSH_JOB_TIMEOUT,
+    )
+
+
+def get_setting_for_url(url: str) -> frappe._dict | None:
+    """Return the active TIMS Settings whose device the given URL points to, if any"""
+    for setting in get_active_tims_settings():
+        if url.startswith(setting.server_address):
+            return setting
+
+    return None
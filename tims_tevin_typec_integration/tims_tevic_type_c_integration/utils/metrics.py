@@ -0,0 +1,294 @@
+"""Latency and throughput metrics of fiscalisation, aggregated in Redis.
+
+The duration of each stage, from submit to the write-back of the device's
+response, is observed per device into histograms with fixed buckets. The
+observations of a request or job are buffered on `frappe.local` and written
+with one pipelined round-trip when it ends, or when a dispatch batch is
+committed, so the hot path never waits on Redis.
+
+Histograms are kept both in five-minute windows, which expire after two hours
+and back the TIMS Dashboard's percentiles, and as running totals for
+Prometheus, which computes its own rates and percentiles.
+"""
+
+import bisect
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+import frappe
+
+METRICS_KEY = "tims_metrics"
+WINDOW_SECONDS = 300
+WINDOW_TTL = 7200  # seconds
+DEFAULT_WINDOW_MINUTES = 60
+
+# Upper bounds of the histogram buckets, in seconds. Durations above the last
+# one fall into an overflow bucket.
+BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    300,
+    1800,
+)
+
+STAGES = {
+    "submit": "Submit",
+    "build_payload": "Payload Build",
+    "queue_wait": "Queue Wait",
+    "round_trip": "Device Round-Trip",
+    "qr_code": "QR Code",
+    "write_back": "Write-Back",
+    "fiscalisation": "Submit to Fiscalised",
+}
+OUTCOMES = ("Completed", "Failed", "Cancelled")
+
+
+def observe(stage: str, device: str | None, seconds: float) -> None:
+    """Buffer the duration of a stage, to be written when the request or job ends"""
+    get_buffer().append((stage, device or "", seconds))
+
+
+def count_outcome(device: str | None, outcome: str) -> None:
+    """Buffer the outcome of a request to a device"""
+    get_buffer().append(("outcome", device or "", outcome))
+
+
+@contextmanager
+def timed(stage: str, device: str | None):
+    """Observe the duration of the enclosed block as the given stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, device, time.perf_counter() - start)
+
+
+def get_buffer() -> list[tuple[str, str, float | str]]:
+    # Only observed from the main thread, as `frappe.local` isn't shared with others
+    if not hasattr(frappe.local, "tims_metrics"):
+        frappe.local.tims_metrics = []
+
+    return frappe.local.tims_metrics
+
+
+def flush_metrics() -> None:
+    """Write the buffered observations to Redis, in one round-trip.
+
+    Hooked to run after every request and background job. Metrics are best
+    effort, so they are dropped rather than failing the request if Redis
+    can't be written to.
+    """
+    observations = getattr(frappe.local, "tims_metrics", None)
+    if not observations:
+        return
+
+    frappe.local.tims_metrics = []
+
+    counts, sums = Counter(), Counter()
+    for stage, device, value in observations:
+        if stage == "outcome":
+            counts[f"outcome|{device}|{value}"] += 1
+            continue
+
+        field = f"{stage}|{device}"
+        counts[f"{field}|{bisect.bisect_left(BUCKETS, value)}"] += 1
+        counts[f"{field}|count"] += 1
+        sums[f"{field}|sum"] += value
+
+    cache = frappe.cache()
+    window_key = cache.make_key(f"{METRICS_KEY}:{int(time.time() // WINDOW_SECONDS)}")
+    total_key = cache.make_key(f"{METRICS_KEY}:total")
+
+    try:
+        pipeline = cache.pipeline(transaction=False)
+        for key in (window_key, total_key):
+            for field, count in counts.items():
+                pipeline.hincrby(key, field, count)
+            for field, seconds in sums.items():
+                pipeline.hincrbyfloat(key, field, seconds)
+
+        pipeline.expire(window_key, WINDOW_TTL)
+        pipeline.execute()
+
+    except Exception:
+        frappe.logger("tims").warning("Unable to write TIMS metrics", exc_info=True)
+
+
+def get_stage_metrics(window_minutes: int = DEFAULT_WINDOW_MINUTES) -> dict[str, dict]:
+    """Return the percentiles of each stage and the outcome counts, per device,
+    over the last `window_minutes`
+
+    Returns:
+        dict[str, dict]: Per device, its `stages` with their `count`, `mean`, `p50`,
+            `p95` and `p99` in milliseconds, and its `outcomes` and `success_rate`
+    """
+    current = int(time.time() // WINDOW_SECONDS)
+    windows = max(1, -(-window_minutes * 60 // WINDOW_SECONDS))
+
+    cache = frappe.cache()
+    pipeline = cache.pipeline(transaction=False)
+    for window in range(current - windows + 1, current + 1):
+        pipeline.hgetall(cache.make_key(f"{METRICS_KEY}:{window}"))
+
+    totals = Counter()
+    for fields in pipeline.execute():
+        for field, value in fields.items():
+            totals[field.decode()] += float(value)
+
+    return summarise(totals)
+
+
+def summarise(totals: Counter) -> dict[str, dict]:
+    devices = {}
+
+    for field, value in totals.items():
+        stage, device, key = parse_field(field)
+        metrics = devices.setdefault(device, frappe._dict(stages={}, outcomes=Counter()))
+
+        if stage == "outcome":
+            metrics.outcomes[key] = int(value)
+
+        elif key == "count":
+            buckets = [
+                totals.get(f"{stage}|{device}|{index}", 0)
+                for index in range(len(BUCKETS) + 1)
+            ]
+            metrics.stages[stage] = {
+                "label": STAGES.get(stage, stage),
+                "count": int(value),
+                "mean": round(totals[f"{stage}|{device}|sum"] / value * 1000, 1),
+                "p50": get_percentile(buckets, value, 0.50),
+                "p95": get_percentile(buckets, value, 0.95),
+                "p99": get_percentile(buckets, value, 0.99),
+            }
+
+    for metrics in devices.values():
+        sent = metrics.outcomes["Completed"] + metrics.outcomes["Failed"]
+        metrics.success_rate = (
+            round(metrics.outcomes["Completed"] / sent * 100, 1) if sent else None
+        )
+        metrics.outcomes = dict(metrics.outcomes)
+
+    return devices
+
+
+def parse_field(field: str) -> tuple[str, str, str]:
+    """Split a hash field into its stage, device and key, e.g. round_trip|Device 1|count"""
+    stage, rest = field.split("|", 1)
+    device, key = rest.rsplit("|", 1)
+
+    return stage, device, key
+
+
+def get_percentile(buckets: list[float], count: float, quantile: float) -> float:
+    """Estimate a percentile, in milliseconds, by interpolating within its histogram bucket"""
+    rank = quantile * count
+    cumulative = 0
+
+    for index, bucket_count in enumerate(buckets):
+        if not bucket_count or cumulative + bucket_count < rank:
+            cumulative += bucket_count
+            continue
+
+        lower = BUCKETS[index - 1] if index else 0
+        if index == len(BUCKETS):
+            # Overflow bucket, with no upper bound to interpolate to
+            return round(lower * 1000, 1)
+
+        upper = BUCKETS[index]
+        return round((lower + (upper - lower) * (rank - cumulative) / bucket_count) * 1000, 1)
+
+    return 0.0
+
+
+def get_outbox_depth() -> dict[str, dict[str, int]]:
+    """Return the number of Queued, Sending and Dead Letter outbox rows per device"""
+    depth = {}
+    for device, status, count in frappe.db.sql(
+        """
+        SELECT device, status, COUNT(*)
+        FROM `tabTIMS Outbox`
+        WHERE status IN ('Queued', 'Sending', 'Dead Letter')
+        GROUP BY device, status
+        """
+    ):
+        depth.setdefault(device, {})[status] = count
+
+    return depth
+
+
+def get_prometheus_metrics() -> str:
+    """Return the running totals of the metrics, and the outbox depth, in the Prometheus text format"""
+    cache = frappe.cache()
+    totals = Counter(
+        {
+            field.decode(): float(value)
+            for field, value in cache.pipeline(transaction=False)
+            .hgetall(cache.make_key(f"{METRICS_KEY}:total"))
+            .execute()[0]
+            .items()
+        }
+    )
+
+    lines = [
+        "# HELP tims_stage_duration_seconds Duration of each stage of fiscalising an invoice.",
+        "# TYPE tims_stage_duration_seconds histogram",
+    ]
+    for field in sorted(totals):
+        stage, device, key = parse_field(field)
+        if stage == "outcome" or key != "count":
+            continue
+
+        labels = f'stage="{escape_label(stage)}",device="{escape_label(device)}"'
+
+        cumulative = 0
+        for index, upper in enumerate((*BUCKETS, "+Inf")):
+            cumulative += totals.get(f"{stage}|{device}|{index}", 0)
+            lines.append(
+                f'tims_stage_duration_seconds_bucket{{{labels},le="{upper}"}} {int(cumulative)}'
+            )
+
+        lines += [
+            f"tims_stage_duration_seconds_sum{{{labels}}} {totals[f'{stage}|{device}|sum']}",
+            f"tims_stage_duration_seconds_count{{{labels}}} {int(totals[field])}",
+        ]
+
+    lines += [
+        "# HELP tims_requests_total Requests sent to the TIMS devices, by outcome.",
+        "# TYPE tims_requests_total counter",
+    ]
+    for field in sorted(totals):
+        stage, device, outcome = parse_field(field)
+        if stage == "outcome":
+            labels = f'device="{escape_label(device)}",outcome="{outcome}"'
+            lines.append(f"tims_requests_total{{{labels}}} {int(totals[field])}")
+
+    lines += [
+        "# HELP tims_outbox_invoices Invoices in the TIMS Outbox waiting to be sent, by status.",
+        "# TYPE tims_outbox_invoices gauge",
+    ]
+    for device, statuses in sorted(get_outbox_depth().items()):
+        for status, count in sorted(statuses.items()):
+            lines.append(
+                f'tims_outbox_invoices{{device="{escape_label(device)}",status="{status}"}} {count}'
+            )
+
+    return "\n".join(lines) + "\n"
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
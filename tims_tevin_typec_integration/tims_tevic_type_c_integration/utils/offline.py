@@ -0,0 +1,47 @@
+"""Store-and-forward of the invoices submitted while a TIMS device is offline.
+
+While a device's circuit is open, its invoices keep being queued in the TIMS
+Outbox, in the order they are submitted, rather than being sent. Once a
+heartbeat finds the device back online, its circuit is closed and its backlog
+is replayed: the queued invoices are made due at once and sent one at a time,
+oldest first, so the device numbers them in sequence and the first and last
+invoice numbers of its End Of Day summaries still match the invoices. A replay
+drains as fast as the device answers and its rate limit allows, and ends once
+the device's outbox is empty.
+"""
+
+import frappe
+
+from .jobs import enqueue_flush_job
+from .outbox import release_backlog
+
+REPLAY_KEY = "tims_offline_replay"
+
+
+def start_replay(setting: frappe._dict) -> int:
+    """Replay the backlog of a device that is back online
+
+    Args:
+        setting (frappe._dict): The TIMS Settings of the device
+
+    Returns:
+        int: The number of invoices in the backlog
+    """
+    backlog = release_backlog(setting)
+    frappe.db.commit()
+
+    if backlog:
+        frappe.cache().hset(REPLAY_KEY, setting.name, 1)
+        enqueue_flush_job(setting)
+
+    return backlog
+
+
+def is_replaying(setting: frappe._dict) -> bool:
+    """Whether the device's backlog is still being replayed"""
+    return bool(frappe.cache().hget(REPLAY_KEY, setting.name))
+
+
+def finish_replay(setting: frappe._dict) -> None:
+    """End the replay of the device's backlog, once its outbox is drained"""
+    frappe.cache().hdel(REPLAY_KEY, setting.name)
@@ -0,0 +1,374 @@
+"""Transactional outbox of the invoices to send to the TIMS devices.
+
+On submit, an invoice's payload is written to the TIMS Outbox in the same
+transaction as the invoice, so it can't be lost along with a background job.
+Dispatch jobs then claim the due rows of their device in batches with
+`SELECT ... FOR UPDATE SKIP LOCKED`, so several workers can drain the outbox in
+parallel without sending an invoice twice, and retries send the stored payload
+as is instead of building it again. Devices set to build payloads in the
+background get only a reference to the invoice on submit, and its payload is
+built and stored by the first dispatch job that claims it.
+
+Failed invoices are retried with exponential backoff. Those the device still
+rejects after the setting's max attempts are moved to the Dead Letter status,
+where they stay until requeued.
+"""
+
+import json
+
+import frappe
+from frappe.utils import add_to_date, now_datetime
+
+from .payload import dumps_payload
+from .router import get_routing_fields, get_unavailable_devices, route_invoice
+
+OUTBOX_DOCTYPE = "TIMS Outbox"
+CLAIM_BATCH_SIZE = 100
+REROUTE_BATCH_SIZE = 500
+
+DEFAULT_MAX_ATTEMPTS = 8
+DEFAULT_BACKOFF_MINUTES = 1
+DEFAULT_MAX_BACKOFF_MINUTES = 360
+
+# Rows claimed this many minutes ago and still Sending are assumed lost with
+# their worker, and can be claimed again
+CLAIM_TIMEOUT_MINUTES = 10
+
+
+def add_to_outbox(payloads: dict[str, dict | None], setting: frappe._dict) -> None:
+    """Queue invoice payloads to be sent to the setting's device, with one bulk insert.
+
+    Invoices already in the outbox are left as they are.
+
+    Args:
+        payloads (dict[str, dict | None]): The invoice payloads, keyed by Sales Invoice.
+            None leaves the payload to be built by the dispatch job.
+        setting (frappe._dict): The TIMS Settings of the device to send them to
+    """
+    if not payloads:
+        return
+
+    now, user = now_datetime(), frappe.session.user
+
+    frappe.db.bulk_insert(
+        OUTBOX_DOCTYPE,
+        fields=[
+            "name",
+            "creation",
+            "modified",
+            "owner",
+            "modified_by",
+            "sales_invoice",
+            "company",
+            "device",
+            "status",
+            "attempts",
+            "next_retry_at",
+            "payload",
+        ],
+        values=[
+            (
+                invoice,
+                now,
+                now,
+                user,
+                user,
+                invoice,
+                setting.company,
+                setting.name,
+                "Queued",
+                0,
+                now,
+                dumps_payload(payload).decode() if payload else None,
+            )
+            for invoice, payload in payloads.items()
+        ],
+        ignore_duplicates=True,
+    )
+
+
+def requeue_outbox(invoices: list[str]) -> None:
+    """Make the outbox rows of the given invoices due now, unless they are being
+    sent. Dead-lettered invoices are also given a fresh set of attempts."""
+    if not invoices:
+        return
+
+    requeue_dead_letters(invoices)
+    frappe.db.set_value(
+        OUTBOX_DOCTYPE,
+        {"sales_invoice": ["in", invoices], "status": "Queued"},
+        {"next_retry_at": now_datetime()},
+        update_modified=False,
+    )
+
+
+def claim_outbox(
+    setting: frappe._dict,
+    limit: int = CLAIM_BATCH_SIZE,
+    invoices: list[str] | None = None,
+) -> list[frappe._dict]:
+    """Claim a batch of the due outbox rows of the setting's device.
+
+    Rows are claimed in the order they were queued, i.e. the invoices in the
+    order they were submitted. Rows locked by another worker's claim are
+    skipped rather than waited on. Rows whose invoice is no longer submitted,
+    e.g. cancelled while it was queued, are removed instead of claimed. The
+    claimed rows are marked Sending and committed before returning, so their
+    locks are only held for the claim itself.
+
+    Args:
+        setting (frappe._dict): The TIMS Settings of the device
+        limit (int, optional): Maximum number of rows to claim. Defaults to 100.
+        invoices (list[str] | None, optional): Only claim the rows of these Sales Invoices.
+            Defaults to any of the device's rows.
+
+    Returns:
+        list[frappe._dict]: The claimed rows' `name`, `sales_invoice`, `payload`,
+            `attempts`, `next_retry_at` and `creation`
+    """
+    invoice_condition = "AND outbox.sales_invoice IN %(invoices)s" if invoices else ""
+
+    while True:
+        now = now_datetime()
+
+        # The invoice's docstatus is read in a subquery, which isn't a locking
+        # read, so the claim doesn't lock the Sales Invoices
+        rows = frappe.db.sql(
+            f"""
+            SELECT
+                outbox.name, outbox.sales_invoice, outbox.payload, outbox.attempts,
+                outbox.next_retry_at, outbox.creation,
+                (
+                    SELECT invoice.docstatus
+                    FROM `tabSales Invoice` invoice
+                    WHERE invoice.name = outbox.sales_invoice
+                ) AS docstatus
+            FROM `tabTIMS Outbox` outbox
+            WHERE outbox.device = %(device)s
+                AND (
+                    (outbox.status = 'Queued' AND outbox.next_retry_at <= %(now)s)
+                    OR (outbox.status = 'Sending' AND outbox.claimed_at < %(claim_expired_before)s)
+                )
+                {invoice_condition}
+            ORDER BY outbox.creation, outbox.name
+            LIMIT %(limit)s
+            FOR UPDATE SKIP LOCKED
+            """,
+            {
+                "device": setting.name,
+                "now": now,
+                "claim_expired_before": add_to_date(now, minutes=-CLAIM_TIMEOUT_MINUTES),
+                "limit": limit,
+                "invoices": tuple(invoices or ()),
+            },
+            as_dict=True,
+        )
+
+        unsubmitted = [row.name for row in rows if row.docstatus != 1]
+        if unsubmitted:
+            frappe.db.delete(OUTBOX_DOCTYPE, {"name": ["in", unsubmitted]})
+
+        rows = [row for row in rows if row.docstatus == 1]
+        if rows:
+            frappe.db.set_value(
+                OUTBOX_DOCTYPE,
+                {"name": ["in", [row.name for row in rows]]},
+                {"status": "Sending", "claimed_at": now},
+                update_modified=False,
+            )
+
+        frappe.db.commit()
+
+        # A batch of only unsubmitted invoices doesn't mean none are due
+        if rows or not unsubmitted:
+            return rows
+
+
+def discard_outbox_rows(invoices: list[str]) -> None:
+    """Remove the invoices from the outbox, unless they are being or were sent,
+    e.g. once they are cancelled"""
+    frappe.db.delete(
+        OUTBOX_DOCTYPE,
+        {"sales_invoice": ["in", invoices], "status": ["in", ["Queued", "Dead Letter"]]},
+    )
+
+
+def record_outbox_results(
+    tims_requests: list[frappe._dict], setting: frappe._dict
+) -> list[str]:
+    """Record the outcome of dispatched outbox rows.
+
+    Sent rows are done with, and cancelled ones, which never reached the
+    device, are retried as soon as possible. Deferred rows are left to the
+    job their invoice is in flight from. Failed rows are retried with
+    exponential backoff, or dead-lettered once they reach the setting's max
+    attempts. Failures to connect don't count as attempts, as the invoice
+    didn't reach the device.
+
+    Args:
+        tims_requests (list[frappe._dict]): The dispatched requests
+        setting (frappe._dict): The TIMS Settings of the device they were sent to
+
+    Returns:
+        list[str]: The Sales Invoices that were dead-lettered
+    """
+    now = now_datetime()
+    max_attempts = setting.max_attempts or DEFAULT_MAX_ATTEMPTS
+    dead_letters = []
+
+    for tims_request in tims_requests:
+        if tims_request.outcome == "Deferred":
+            continue
+
+        values = {}
+        attempts = tims_request.attempts + 1
+
+        if tims_request.outcome == "Completed":
+            values.update(status="Sent", attempts=attempts, last_error=None)
+
+        elif tims_request.outcome == "Failed":
+            values.update(
+                last_error=tims_request.error,
+                next_retry_at=add_to_date(
+                    now, minutes=get_backoff_minutes(attempts, setting)
+                ),
+            )
+            if tims_request.reached_device:
+                values.update(attempts=attempts)
+
+            if tims_request.reached_device and attempts >= max_attempts:
+                values.update(status="Dead Letter")
+                dead_letters.append(tims_request.invoice)
+            else:
+                values.update(status="Queued")
+
+        else:
+            values.update(status="Queued", next_retry_at=now)
+
+        frappe.db.set_value(
+            OUTBOX_DOCTYPE, tims_request.outbox, values, update_modified=False
+        )
+
+    return dead_letters
+
+
+def release_backlog(setting: frappe._dict) -> int:
+    """Make the queued rows of the setting's device that never reached it due now,
+    e.g. those that failed to connect while it was offline
+
+    Args:
+        setting (frappe._dict): The TIMS Settings of the device
+
+    Returns:
+        int: The number of rows queued for the device
+    """
+    frappe.db.set_value(
+        OUTBOX_DOCTYPE,
+        {
+            "device": setting.name,
+            "status": "Queued",
+            "attempts": 0,
+            "next_retry_at": [">", now_datetime()],
+        },
+        {"next_retry_at": now_datetime()},
+        update_modified=False,
+    )
+
+    return frappe.db.count(OUTBOX_DOCTYPE, {"device": setting.name, "status": "Queued"})
+
+
+def get_backoff_minutes(attempts: int, setting: frappe._dict) -> float:
+    """Return how long to wait before retrying an invoice, doubling with each failed attempt"""
+    backoff = setting.resend_backoff_minutes or DEFAULT_BACKOFF_MINUTES
+    max_backoff = setting.max_resend_backoff_minutes or DEFAULT_MAX_BACKOFF_MINUTES
+
+    return min(backoff * 2 ** (attempts - 1), max_backoff)
+
+
+def requeue_dead_letters(invoices: list[str]) -> dict[str, list[str]]:
+    """Give dead-lettered invoices a fresh set of attempts, due now
+
+    Args:
+        invoices (list[str]): The Sales Invoices to requeue
+
+    Returns:
+        dict[str, list[str]]: The requeued invoices, keyed by TIMS Settings
+    """
+    rows = frappe.get_all(
+        OUTBOX_DOCTYPE,
+        filters={"sales_invoice": ["in", invoices], "status": "Dead Letter"},
+        fields=["sales_invoice", "device"],
+    )
+    if not rows:
+        return {}
+
+    requeued = {}
+    for row in rows:
+        requeued.setdefault(row.device, []).append(row.sales_invoice)
+
+    invoices = [row.sales_invoice for row in rows]
+    frappe.db.set_value(
+        OUTBOX_DOCTYPE,
+        {"name": ["in", invoices]},
+        {"status": "Queued", "attempts": 0, "next_retry_at": now_datetime()},
+        update_modified=False,
+    )
+    frappe.db.set_value(
+        "Sales Invoice",
+        {"name": ["in", invoices]},
+        {"custom_tims_status": "Pending"},
+        update_modified=False,
+    )
+
+    return requeued
+
+
+def reroute_outbox(setting: frappe._dict) -> int:
+    """Move the queued invoices of an unavailable device to the next device they are routed to.
+
+    Only invoices that were never sent are moved, since one that might have
+    reached the device must be retried there to not be fiscalised twice.
+
+    Args:
+        setting (frappe._dict): The TIMS Settings of the unavailable device
+
+    Returns:
+        int: The number of invoices moved
+    """
+    rows = frappe.get_all(
+        OUTBOX_DOCTYPE,
+        filters={
+            "device": setting.name,
+            "status": "Queued",
+            "claimed_at": ["is", "not set"],
+        },
+        fields=["name", "payload"],
+        limit=REROUTE_BATCH_SIZE,
+    )
+    if not rows:
+        return 0
+
+    payloads = {row.name: row.payload for row in rows}
+    invoices = frappe.get_all(
+        "Sales Invoice",
+        filters={"name": ["in", list(payloads)]},
+        fields=get_routing_fields(),
+    )
+
+    unavailable = get_unavailable_devices()
+    moved = 0
+    for invoice in invoices:
+        device = route_invoice(invoice, unavailable=unavailable)
+        if not device or device.name == setting.name:
+            continue
+
+        values = {"device": device.name}
+        if payloads[invoice.name]:
+            payload = json.loads(payloads[invoice.name])
+            payload["Invoice"]["SenderId"] = device.sender_id
+            values["payload"] = dumps_payload(payload).decode()
+
+        frappe.db.set_value(OUTBOX_DOCTYPE, invoice.name, values, update_modified=False)
+        moved += 1
+
+    return moved
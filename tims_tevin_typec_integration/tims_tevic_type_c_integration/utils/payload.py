@@ -0,0 +1,345 @@
+"""Builds the invoice payloads sent to the TIMS device.
+
+Line items are handled as columns, one list per field, rather than as child
+row documents. Invoices that aren't already loaded have their rows read from
+the database in that form directly, so even invoices with thousands of lines
+are built without loading the full document.
+"""
+
+import json
+import re
+from datetime import timedelta
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import flt
+
+from .cache import get_tax_metadata
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+CASH_CUSTOMER_CONTROL = "CASH CUSTOMER CONTROL"
+
+INVOICE_FIELDS = (
+    "name",
+    "customer",
+    "tax_id",
+    "tax_category",
+    "is_return",
+    "return_against",
+    "posting_date",
+    "posting_time",
+    "grand_total",
+    "net_total",
+    "total_taxes_and_charges",
+    "custom_relevant_invoice_number",
+    "custom_cash_customer_kra_pin",
+)
+ITEM_FIELDS = (
+    "item_code",
+    "description",
+    "net_amount",
+    "net_rate",
+    "qty",
+    "custom_tax_rate",
+    "custom_tax_amount",
+)
+
+
+def build_invoice_payload(
+    doc: Document | frappe._dict,
+    setting: frappe._dict,
+    items: dict[str, list] | None = None,
+) -> dict:
+    """Validate the Sales Invoice and build the payload sent to the TIMS device
+
+    Args:
+        doc (Document | frappe._dict): The Sales Invoice, or its fields
+        setting (frappe._dict): The TIMS Settings the invoice is sent with
+        items (dict[str, list] | None, optional): The item columns. Defaults to those of `doc.items`.
+
+    Returns:
+        dict: The invoice payload
+    """
+    tax_metadata = validate_invoice(doc)
+    hs_code, tax_rate = tax_metadata.hs_code, tax_metadata.tax_rate
+
+    invoice_category = "Credit Note" if doc.is_return else "Tax Invoice"
+
+    relevant_invoice_number = ""
+    if doc.is_return:
+        # If this is a Credit Note
+        if not doc.return_against:
+            # A standalone Credit Note's CU Invoice No. is entered by the user
+            relevant_invoice_number = doc.custom_relevant_invoice_number
+
+        else:
+            # If this isn't a standalone Credit Note, fetch CU invoice number
+            relevant_invoice_number = frappe.db.get_value(
+                "Sales Invoice",
+                {"name": doc.return_against},
+                ["custom_cu_invoice_number"],
+            )
+
+    if items is None:
+        items = get_doc_item_columns(doc)
+
+    item_details = build_item_details(
+        items, tax_rate, hs_code, aggregate=bool(setting.aggregate_item_lines)
+    )
+
+    # Get numbers portion of name, i.e. INV-123456 > 123456
+    trader_invoice_no = doc.name.split("-", 1)[-1]
+    if isinstance(doc.posting_time, str):
+        # If it's a string
+        posting_time = doc.posting_time.split(".", 1)[0]
+    elif isinstance(doc.posting_time, timedelta):
+        # If it's a timedelta object
+        posting_time = str(doc.posting_time).split(".", 1)[0]
+    posting_time_ = format_time_for_invoice(posting_time)
+    if doc.customer == CASH_CUSTOMER_CONTROL:
+        pin = doc.custom_cash_customer_kra_pin or ""
+    else:
+        pin = doc.tax_id or ""
+
+    return {
+        "Invoice": {
+            "SenderId": setting.sender_id,
+            "TraderSystemInvoiceNumber": trader_invoice_no,
+            "InvoiceCategory": invoice_category,
+            "InvoiceTimestamp": f"{doc.posting_date}T{posting_time_}",
+            "RelevantInvoiceNumber": relevant_invoice_number,
+            "PINOfBuyer": pin,
+            "Discount": 0,
+            "InvoiceType": "Original",
+            "TotalInvoiceAmount": abs(doc.grand_total),
+            "TotalTaxableAmount": abs(doc.net_total),
+            "TotalTaxAmount": (
+                abs(doc.total_taxes_and_charges)
+                if doc.tax_category != "Exempt"
+                else 0
+            ),
+            "ExemptionNumber": "",
+            "ItemDetails": item_details,
+        }
+    }
+
+
+def validate_invoice(doc: Document | frappe._dict) -> frappe._dict:
+    """Check the Sales Invoice has what its payload needs, without building it.
+
+    Only the KRA PIN's format and cached tax metadata are checked, so this is
+    cheap enough to run before every submit.
+
+    Returns:
+        frappe._dict: The tax metadata of the invoice's Tax Category
+    """
+    if doc.tax_id and not is_valid_kra_pin(doc.tax_id):
+        # Validate KRA PIN if provided and raise exception if invalid
+        frappe.throw(
+            f"The entered PIN: <b>{doc.tax_id}</b>, is not valid. Please review this."
+        )
+
+    # HS Codes and the Tax Rate are resolved from the Tax Category, via its sales Tax Rule
+    tax_metadata = get_tax_metadata(doc.tax_category)
+    if not tax_metadata.sales_tax_template:
+        frappe.throw(
+            f"Please ensure a Sales Tax Rule exists for the Tax Category <b>{doc.tax_category}</b>"
+        )
+
+    if tax_metadata.tax_rate == 0 and not tax_metadata.hs_code:
+        # Ensure only Tax Rate 16% can have an empty HS Code. Otherwise, if no HS Code, raise error
+        frappe.throw(
+            "Please contact the <b>Account Controller</b> to ensure the HSCode for this customer's Tax Category is set"
+        )
+
+    if doc.is_return and not doc.return_against and not doc.custom_relevant_invoice_number:
+        # If it's a standalone Credit Note, prompt user to Enter CU Invoice No.
+        frappe.throw(
+            "Please enter the CU Number in the <b>Relevant Invoice Number</b> field"
+        )
+
+    return tax_metadata
+
+
+def build_invoice_payload_from_db(invoice: str, setting: frappe._dict) -> dict:
+    """Build the payload of a submitted invoice without loading the full document"""
+    meta = frappe.get_meta("Sales Invoice")
+    fields = [
+        field
+        for field in INVOICE_FIELDS
+        if not field.startswith("custom_") or meta.has_field(field)
+    ]
+
+    doc = frappe.db.get_value("Sales Invoice", invoice, fields, as_dict=True)
+
+    return build_invoice_payload(doc, setting, get_item_columns(invoice))
+
+
+def get_item_columns(invoice: str) -> dict[str, list]:
+    """Read the invoice's item rows from the database as one list per field"""
+    meta = frappe.get_meta("Sales Invoice Item")
+    fields = [
+        field
+        for field in ITEM_FIELDS
+        if not field.startswith("custom_") or meta.has_field(field)
+    ]
+
+    rows = frappe.db.sql(
+        f"""
+        SELECT {", ".join(f"`{field}`" for field in fields)}
+        FROM `tabSales Invoice Item`
+        WHERE parent = %s AND parenttype = 'Sales Invoice'
+        ORDER BY idx
+        """,
+        invoice,
+    )
+
+    columns = dict(zip(fields, map(list, zip(*rows)))) if rows else {}
+    for field in ITEM_FIELDS:
+        columns.setdefault(field, [None] * len(rows))
+
+    return columns
+
+
+def get_doc_item_columns(doc: Document) -> dict[str, list]:
+    return {field: [item.get(field) for item in doc.items] for field in ITEM_FIELDS}
+
+
+def build_item_details(
+    items: dict[str, list],
+    tax_rate: float | None,
+    hs_code: str | None,
+    aggregate: bool = False,
+) -> list[dict]:
+    """Build the ItemDetails of the payload from the item columns
+
+    Args:
+        items (dict[str, list]): The item columns
+        tax_rate (float | None): The invoice's tax rate, used for lines without one
+        hs_code (str | None): The HS Code of the invoice's Tax Category
+        aggregate (bool, optional): Whether to merge lines of the same item, HS Code and tax rate. Defaults to False.
+
+    Returns:
+        list[dict]: The ItemDetails
+    """
+    if tax_rate == 0:
+        # Exempt customers: TaxRate: 0, TaxAmount: 0, and HSCode can't be empty
+        item_details = [
+            {
+                "HSDesc": description,
+                "TaxRate": 0,
+                "ItemAmount": abs(net_amount),
+                "TaxAmount": 0,
+                "TransactionType": "1",
+                "UnitPrice": net_rate,
+                "HSCode": hs_code,
+                "Quantity": abs(qty),
+            }
+            for description, net_amount, net_rate, qty in zip(
+                items["description"], items["net_amount"], items["net_rate"], items["qty"]
+            )
+        ]
+
+    else:
+        # Lines without their own tax fall back to the invoice's rate, resolved once per invoice
+        line_tax_rates = [
+            tax_rate if line_tax_rate is None else line_tax_rate
+            for line_tax_rate in items["custom_tax_rate"]
+        ]
+        item_details = [
+            {
+                "HSDesc": description,
+                "TaxRate": line_tax_rate,
+                "ItemAmount": net_amount,
+                "TaxAmount": (
+                    flt(net_amount * flt(line_tax_rate) / 100, 2)
+                    if tax_amount is None
+                    else tax_amount
+                ),
+                "TransactionType": "1",
+                "UnitPrice": net_rate,
+                "HSCode": "",
+                "Quantity": abs(qty),
+            }
+            for description, net_amount, net_rate, qty, line_tax_rate, tax_amount in zip(
+                items["description"],
+                items["net_amount"],
+                items["net_rate"],
+                items["qty"],
+                line_tax_rates,
+                items["custom_tax_amount"],
+            )
+        ]
+
+    if aggregate:
+        return aggregate_item_details(item_details, items["item_code"])
+
+    return item_details
+
+
+def aggregate_item_details(
+    item_details: list[dict], item_codes: list[str | None]
+) -> list[dict]:
+    """Merge the lines sharing an item code, HS Code and tax rate, keeping the order they first appear in"""
+    groups: dict[tuple, dict] = {}
+
+    for item_code, detail in zip(item_codes, item_details):
+        key = (item_code, detail["HSCode"], detail["TaxRate"])
+
+        group = groups.get(key)
+        if group is None:
+            groups[key] = dict(detail)
+            continue
+
+        group["ItemAmount"] += detail["ItemAmount"]
+        group["TaxAmount"] += detail["TaxAmount"]
+        group["Quantity"] += detail["Quantity"]
+
+    for group in groups.values():
+        group["ItemAmount"] = flt(group["ItemAmount"], 2)
+        group["TaxAmount"] = flt(group["TaxAmount"], 2)
+        if group["Quantity"]:
+            group["UnitPrice"] = flt(abs(group["ItemAmount"]) / group["Quantity"], 2)
+
+    return list(groups.values())
+
+
+def dumps_payload(payload: dict | str | bytes) -> bytes:
+    """Serialise the payload to JSON, with orjson when it's installed.
+
+    Payloads already serialised, e.g. as stored in the TIMS Outbox, are returned as is."""
+    if isinstance(payload, bytes):
+        return payload
+
+    if isinstance(payload, str):
+        return payload.encode()
+
+    if orjson:
+        return orjson.dumps(payload, default=str)
+
+    return json.dumps(payload, default=str, separators=(",", ":")).encode()
+
+
+def is_valid_kra_pin(pin: str) -> bool:
+    """Checks if the string provided conforms to the pattern of a KRA PIN.
+    This function does not validate if the PIN actually exists, only that
+    it resembles a valid KRA PIN.
+
+    Args:
+        pin (str): The KRA PIN to test
+
+    Returns:
+        bool: True if input is a valid KRA PIN, False otherwise
+    """
+    pattern = r"^[a-zA-Z]{1}[0-9]{9}[a-zA-Z]{1}$"
+    return bool(re.match(pattern, pin))
+
+
+def format_time_for_invoice(time: str) -> str:
+    """Format time to ensure leading zero for single-digit hours."""
+    hour, minute, second = time.split(":")
+    return f"{int(hour):02d}:{minute}:{second}"
@@ -0,0 +1,127 @@
+"""QR Code rendering for fiscalised invoices.
+
+Rendered images are kept in an LRU cache keyed by the QR data and rendering
+options, so retries and duplicate responses for the same invoice don't render
+it again. The image is either stored inline on the invoice as a data URI, or
+as a File attached to the invoice, depending on the TIMS Settings.
+"""
+
+from base64 import b64encode
+from functools import lru_cache
+from io import BytesIO
+
+import qrcode
+from qrcode.image.svg import SvgPathImage
+
+import frappe
+
+DEFAULT_FORMAT = "PNG"
+DEFAULT_BOX_SIZE = 10
+DEFAULT_ERROR_CORRECTION = "M"
+RENDER_CACHE_SIZE = 512
+
+ERROR_CORRECTION_LEVELS = {
+    "L": qrcode.constants.ERROR_CORRECT_L,
+    "M": qrcode.constants.ERROR_CORRECT_M,
+    "Q": qrcode.constants.ERROR_CORRECT_Q,
+    "H": qrcode.constants.ERROR_CORRECT_H,
+}
+FILE_TYPES = {"PNG": ("png", "image/png"), "SVG": ("svg", "image/svg+xml")}
+
+
+def get_qr_code_value(
+    data: str, invoice: str, setting: frappe._dict | None = None
+) -> str:
+    """Render the QR Code and return the value stored in the invoice's QR Code field
+
+    Args:
+        data (str): The information used to generate the QR Code
+        invoice (str): The Sales Invoice the QR Code belongs to
+        setting (frappe._dict | None, optional): The TIMS Settings holding the rendering options. Defaults to None.
+
+    Returns:
+        str: A data URI, or the URL of the attached File
+    """
+    setting = setting or frappe._dict()
+    format = setting.qr_code_format or DEFAULT_FORMAT
+
+    qr_code_bytes = get_qr_code_bytes(
+        data,
+        format=format,
+        box_size=setting.qr_code_box_size or DEFAULT_BOX_SIZE,
+        error_correction=setting.qr_code_error_correction or DEFAULT_ERROR_CORRECTION,
+    )
+
+    if setting.qr_code_storage == "File Attachment":
+        return attach_qr_code(qr_code_bytes, invoice, format)
+
+    return add_file_info(bytes_to_base64_string(qr_code_bytes), format)
+
+
+def add_file_info(data: str, format: str = "PNG") -> str:
+    """Add info about the file type and encoding.
+
+    This is required so the browser can make sense of the data."""
+    return f"data:{FILE_TYPES[format][1]};base64, {data}"
+
+
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def get_qr_code_bytes(
+    data: bytes | str,
+    format: str = DEFAULT_FORMAT,
+    box_size: int = DEFAULT_BOX_SIZE,
+    error_correction: str = DEFAULT_ERROR_CORRECTION,
+) -> bytes:
+    """Create a QR code and return the bytes.
+
+    PNGs are 1-bit images, as QR Codes only need black and white."""
+    qr = qrcode.QRCode(
+        error_correction=ERROR_CORRECTION_LEVELS[error_correction],
+        box_size=box_size,
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+
+    buffered = BytesIO()
+    if format == "SVG":
+        qr.make_image(image_factory=SvgPathImage).save(buffered)
+    else:
+        qr.make_image().save(buffered, format=format, optimize=True)
+
+    return buffered.getvalue()
+
+
+def bytes_to_base64_string(data: bytes) -> str:
+    """Convert bytes to a base64 encoded string."""
+    return b64encode(data).decode("utf-8")
+
+
+def attach_qr_code(qr_code_bytes: bytes, invoice: str, format: str = "PNG") -> str:
+    """Save the QR Code as a File attached to the invoice and return its URL"""
+    file_name = f"{invoice}-qr.{FILE_TYPES[format][0]}"
+
+    existing = frappe.db.get_value(
+        "File",
+        {
+            "attached_to_doctype": "Sales Invoice",
+            "attached_to_name": invoice,
+            "file_name": file_name,
+        },
+        "file_url",
+    )
+    if existing:
+        return existing
+
+    file = frappe.get_doc(
+        {
+            "doctype": "File",
+            "file_name": file_name,
+            "attached_to_doctype": "Sales Invoice",
+            "attached_to_name": invoice,
+            "content": qr_code_bytes,
+            "is_private": 0,
+        }
+    )
+    file.insert(ignore_permissions=True)
+
+    return file.file_url
@@ -0,0 +1,132 @@
+"""Per-device token bucket rate limiter shared by all workers through Redis.
+
+Buckets must be created on the main thread, since Redis keys are namespaced by
+site, but `acquire` can then be called from the threads sending requests.
+"""
+
+import asyncio
+import time
+
+import frappe
+
+RATE_LIMIT_KEY = "tims_rate_limit"
+SEND_RATE_KEY = "tims_send_rate"
+DEFAULT_BURST = 10
+DEFAULT_ACQUIRE_TIMEOUT = 30  # seconds
+
+# Refills the bucket for the time elapsed since it was last used, then takes a
+# token if one is available. Returns how long to wait for the next token, as a
+# string since Redis truncates numbers returned by scripts to integers.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated_at")
+local tokens = tonumber(bucket[1]) or burst
+local updated_at = tonumber(bucket[2]) or now
+
+tokens = math.min(burst, tokens + math.max(0, now - updated_at) * rate)
+
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    redis.call("INCR", KEYS[2])
+    redis.call("EXPIRE", KEYS[2], 120)
+else
+    wait = (1 - tokens) / rate
+end
+
+redis.call("HMSET", KEYS[1], "tokens", tokens, "updated_at", now)
+redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate) + 1)
+
+return tostring(wait)
+"""
+
+
+class RateLimitExceeded(Exception):
+    """Raised when no token was available to send a request within the timeout"""
+
+
+class TokenBucket:
+    """Limits the requests sent to a device to `rate` per second, in bursts of at most `burst`.
+
+    A rate of 0 means the device isn't rate limited."""
+
+    def __init__(self, server_address: str, rate: float, burst: int = DEFAULT_BURST):
+        cache = frappe.cache()
+
+        self.rate = rate or 0
+        self.burst = max(burst or DEFAULT_BURST, 1)
+        self.key = cache.make_key(f"{RATE_LIMIT_KEY}:{server_address}")
+        self.send_rate_prefix = cache.make_key(f"{SEND_RATE_KEY}:{server_address}")
+        self.script = cache.register_script(TOKEN_BUCKET_SCRIPT) if self.rate else None
+        self.redis = cache
+
+    def acquire(self, timeout: float = DEFAULT_ACQUIRE_TIMEOUT) -> bool:
+        """Wait for a token to send a request
+
+        Returns:
+            bool: True once a token is taken, False if none was available within `timeout` seconds
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            wait = self.take()
+            if not wait:
+                return True
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+
+            time.sleep(min(wait, remaining))
+
+    async def acquire_async(self, timeout: float = DEFAULT_ACQUIRE_TIMEOUT) -> bool:
+        """Like `acquire`, but lets other coroutines run while waiting for a token"""
+        deadline = time.monotonic() + timeout
+        while True:
+            wait = self.take()
+            if not wait:
+                return True
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+
+            await asyncio.sleep(min(wait, remaining))
+
+    def take(self) -> float:
+        """Take a token if one is available
+
+        Returns:
+            float: 0 if a token was taken, otherwise the seconds until the next one is
+        """
+        send_rate_key = f"{self.send_rate_prefix}:{int(time.time() // 60)}"
+
+        if not self.rate:
+            self.redis.incr(send_rate_key)
+            self.redis.expire(send_rate_key, 120)
+            return 0
+
+        return float(
+            self.script(
+                keys=[self.key, send_rate_key],
+                args=[self.rate, self.burst, time.time()],
+            )
+        )
+
+
+def get_token_bucket(setting: frappe._dict) -> TokenBucket:
+    return TokenBucket(
+        setting.server_address, setting.rate_limit, setting.rate_limit_burst
+    )
+
+
+def get_send_rate(server_address: str) -> float:
+    """Return the requests per second sent to the device during the last full minute"""
+    last_minute = int(time.time() // 60) - 1
+    sent = frappe.cache().get(
+        frappe.cache().make_key(f"{SEND_RATE_KEY}:{server_address}:{last_minute}")
+    )
+
+    return round(int(sent or 0) / 60, 2)
@@ -0,0 +1,307 @@
+"""Reconciliation of the devices' End Of Day summaries against ERPNext.
+
+The day's fiscalised Sales Invoices of the device are streamed from an
+unbuffered cursor, in invoice number order, and aggregated in a single pass:
+their count and totals, the first and last invoice numbers, and the gaps
+between consecutive numbers. Memory use doesn't grow with the number of
+invoices, and the pass stops once its time budget is spent, in which case
+the record is marked Incomplete.
+
+The gaps are only those of the company's invoice number series when the device
+is the company's only one. Invoices spread across several devices leave each
+of them part of the series, so the numbers reported missing are instead those
+of the day's invoices sent to the device and not fiscalised.
+"""
+
+import time
+from decimal import Decimal
+
+import frappe
+from frappe.utils import now_datetime
+
+from .cache import get_active_tims_settings
+
+EOD_DOCTYPE = "End Of Day TIMS Records"
+
+RECONCILIATION_TIME_BUDGET = 300  # seconds
+DEADLINE_CHECK_INTERVAL = 1000  # invoices
+MAX_REPORTED_GAPS = 50
+AMOUNT_TOLERANCE = Decimal("0.01")
+
+# Summary field of the device > aggregated ERPNext total it's compared with
+COMPARED_TOTALS = {
+    "number_of_invoices_sent": "erpnext_invoice_count",
+    "total_invoice_amount": "erpnext_total_invoice_amount",
+    "total_taxable_amount": "erpnext_total_taxable_amount",
+    "total_tax_amount": "erpnext_total_tax_amount",
+}
+
+
+def reconcile_eod_record(
+    eod_record: str, time_budget: float = RECONCILIATION_TIME_BUDGET
+) -> frappe._dict:
+    """Compare an End Of Day summary with the day's fiscalised invoices of its device,
+    and record the ERPNext totals and any discrepancies and gaps on it.
+
+    Args:
+        eod_record (str): The End Of Day TIMS Records entry
+        time_budget (float, optional): Seconds the invoices may be streamed for. Defaults to 300.
+
+    Returns:
+        frappe._dict: The reconciled values
+    """
+    record = frappe.db.get_value(
+        EOD_DOCTYPE,
+        eod_record,
+        [
+            "device",
+            "date_of_summary",
+            "first_invoice_number",
+            "last_invoice_number",
+            *COMPARED_TOTALS,
+        ],
+        as_dict=True,
+    )
+    if not record.device or not record.date_of_summary:
+        frappe.throw(f"{eod_record} has no device or date to reconcile against")
+
+    sole_device = is_sole_device(record.device)
+    totals = aggregate_fiscalised_invoices(
+        record.device,
+        record.date_of_summary,
+        time.monotonic() + time_budget,
+        track_gaps=sole_device,
+    )
+
+    if totals.complete:
+        discrepancies = get_discrepancies(record, totals)
+        if sole_device:
+            gaps = get_missing_ranges(record, totals)
+        else:
+            gaps = get_unfiscalised_ranges(record.device, record.date_of_summary, totals)
+        status = "Discrepancies Found" if discrepancies or gaps else "Matched"
+    else:
+        # Totals of part of the day can't be compared with the device's
+        discrepancies = [
+            f"Stopped after {totals.erpnext_invoice_count} invoices, as the time budget was spent"
+        ]
+        gaps = totals.gaps
+        status = "Incomplete"
+
+    values = frappe._dict(
+        reconciliation_status=status,
+        reconciled_at=now_datetime(),
+        erpnext_invoice_count=totals.erpnext_invoice_count,
+        erpnext_total_invoice_amount=totals.erpnext_total_invoice_amount,
+        erpnext_total_taxable_amount=totals.erpnext_total_taxable_amount,
+        erpnext_total_tax_amount=totals.erpnext_total_tax_amount,
+        erpnext_first_invoice_number=totals.first_invoice_number,
+        erpnext_last_invoice_number=totals.last_invoice_number,
+        discrepancies="\n".join(discrepancies),
+        missing_invoice_numbers=format_ranges(gaps, totals.missing_count),
+    )
+    frappe.db.set_value(EOD_DOCTYPE, eod_record, values, update_modified=False)
+
+    return values
+
+
+def enqueue_reconciliation(eod_record: str) -> None:
+    """Reconcile an End Of Day summary from a background job, once it's committed"""
+    frappe.enqueue(
+        reconcile_eod_record,
+        eod_record=eod_record,
+        queue="long",
+        # Leaves the job time to record what it aggregated once the budget is spent
+        timeout=RECONCILIATION_TIME_BUDGET + 60,
+        job_id=f"tims_eod_reconciliation::{eod_record}",
+        deduplicate=True,
+        enqueue_after_commit=True,
+    )
+
+
+def is_sole_device(device: str) -> bool:
+    """Whether the device is its company's only active one, i.e. it's sent the
+    company's whole invoice number series"""
+    company = frappe.db.get_value("TIMS Settings", device, "company")
+
+    return not any(
+        setting.company == company and setting.name != device
+        for setting in get_active_tims_settings()
+    )
+
+
+def aggregate_fiscalised_invoices(
+    device: str, date, deadline: float, track_gaps: bool = True
+) -> frappe._dict:
+    """Aggregate the fiscalised invoices a device received on a day, in one streamed pass
+
+    Args:
+        device (str): The TIMS Settings of the device
+        date (date): The invoices' posting date
+        deadline (float): `time.monotonic()` value after which to stop
+        track_gaps (bool, optional): Whether to record the gaps between invoice
+            numbers, i.e. the device is sent the whole series. Defaults to True.
+
+    Returns:
+        frappe._dict: The invoice count and totals, first and last invoice
+            numbers, up to `MAX_REPORTED_GAPS` gaps between invoice numbers and
+            the count of all the numbers missing, and whether every invoice was read
+    """
+    totals = frappe._dict(
+        erpnext_invoice_count=0,
+        erpnext_total_invoice_amount=Decimal(0),
+        erpnext_total_taxable_amount=Decimal(0),
+        erpnext_total_tax_amount=Decimal(0),
+        first_invoice_number=None,
+        last_invoice_number=None,
+        gaps=[],
+        missing_count=0,
+        track_gaps=track_gaps,
+        complete=True,
+    )
+
+    # The rows are read as they arrive rather than all loaded first, so no
+    # other query may run until the cursor is closed
+    with frappe.db.unbuffered_cursor():
+        rows = frappe.db.sql(
+            """
+            SELECT name, grand_total, net_total, total_taxes_and_charges, tax_category
+            FROM `tabSales Invoice`
+            WHERE docstatus = 1
+                AND custom_tims_status = 'Fiscalised'
+                AND custom_tims_device = %(device)s
+                AND posting_date = %(date)s
+            ORDER BY LENGTH(name), name
+            """,
+            {"device": device, "date": date},
+            as_iterator=True,
+        )
+
+        for index, (name, grand_total, net_total, taxes, tax_category) in enumerate(
+            rows, 1
+        ):
+            # Amounts are summed as sent in the payloads
+            totals.erpnext_invoice_count += 1
+            totals.erpnext_total_invoice_amount += abs(grand_total or 0)
+            totals.erpnext_total_taxable_amount += abs(net_total or 0)
+            if tax_category != "Exempt":
+                totals.erpnext_total_tax_amount += abs(taxes or 0)
+
+            add_invoice_number(totals, name.split("-", 1)[-1])
+
+            if not index % DEADLINE_CHECK_INTERVAL and time.monotonic() > deadline:
+                totals.complete = False
+                break
+
+    return totals
+
+
+def add_invoice_number(totals: frappe._dict, invoice_number: str) -> None:
+    # Amended invoices, e.g. INV-123-1, aren't part of the sequence
+    if not invoice_number.isdigit():
+        return
+
+    number = int(invoice_number)
+    previous = totals.last_invoice_number
+
+    if previous is None:
+        totals.first_invoice_number = number
+
+    elif number > previous + 1 and totals.track_gaps:
+        add_gap(totals, previous + 1, number - 1)
+
+    totals.last_invoice_number = number
+
+
+def add_gap(totals: frappe._dict, start: int, end: int) -> None:
+    totals.missing_count += end - start + 1
+    if len(totals.gaps) < MAX_REPORTED_GAPS:
+        totals.gaps.append((start, end))
+
+
+def get_discrepancies(record: frappe._dict, totals: frappe._dict) -> list[str]:
+    """Return a line per total that differs between the device and ERPNext"""
+    discrepancies = []
+
+    for device_field, erpnext_field in COMPARED_TOTALS.items():
+        device_value = Decimal(str(record.get(device_field) or 0))
+        erpnext_value = totals[erpnext_field]
+
+        if abs(device_value - erpnext_value) > AMOUNT_TOLERANCE:
+            discrepancies.append(
+                f"{frappe.unscrub(device_field)}: {round(device_value, 2)} on the device, "
+                f"{round(erpnext_value, 2)} in ERPNext"
+            )
+
+    for field in ("first_invoice_number", "last_invoice_number"):
+        if record.get(field) and record.get(field) != totals.get(field):
+            discrepancies.append(
+                f"{frappe.unscrub(field)}: {record.get(field)} on the device, "
+                f"{totals.get(field)} in ERPNext"
+            )
+
+    return discrepancies
+
+
+def get_missing_ranges(record: frappe._dict, totals: frappe._dict) -> list[tuple[int, int]]:
+    """Return the invoice numbers in the device's range that ERPNext has no
+    fiscalised invoice for, as inclusive ranges"""
+    first, last = record.first_invoice_number, record.last_invoice_number
+
+    if totals.first_invoice_number is None:
+        if first and last and last >= first:
+            add_gap(totals, first, last)
+
+        return totals.gaps
+
+    if first and first < totals.first_invoice_number:
+        add_gap(totals, first, totals.first_invoice_number - 1)
+
+    if last and last > totals.last_invoice_number:
+        add_gap(totals, totals.last_invoice_number + 1, last)
+
+    return totals.gaps
+
+
+def get_unfiscalised_ranges(device: str, date, totals: frappe._dict) -> list[tuple[int, int]]:
+    """Return the numbers of the day's invoices last sent to the device that
+    aren't fiscalised, as inclusive ranges"""
+    # Each send records the device on the invoice, as on its TIMS Request Log
+    invoices = frappe.db.sql_list(
+        """
+        SELECT name
+        FROM `tabSales Invoice`
+        WHERE docstatus = 1
+            AND IFNULL(custom_tims_status, '') != 'Fiscalised'
+            AND custom_tims_device = %(device)s
+            AND posting_date = %(date)s
+        """,
+        {"device": device, "date": date},
+    )
+    numbers = sorted(
+        int(number)
+        for number in (invoice.split("-", 1)[-1] for invoice in invoices)
+        if number.isdigit()
+    )
+
+    start = None
+    for index, number in enumerate(numbers):
+        if start is None:
+            start = number
+
+        if index + 1 == len(numbers) or numbers[index + 1] != number + 1:
+            add_gap(totals, start, number)
+            start = None
+
+    return totals.gaps
+
+
+def format_ranges(ranges: list[tuple[int, int]], count: int) -> str:
+    """Format invoice number ranges, e.g. 1201-1203, 1250"""
+    formatted = ", ".join(
+        str(start) if start == end else f"{start}-{end}" for start, end in sorted(ranges)
+    )
+    if count > sum(end - start + 1 for start, end in ranges):
+        formatted += f" ({count} in total)"
+
+    return formatted
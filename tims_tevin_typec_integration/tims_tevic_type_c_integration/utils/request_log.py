@@ -0,0 +1,136 @@
+"""Compact log of the invoices sent to the TIMS devices.
+
+Each invoice has a single TIMS Request Log, named after it, whose attempt
+counter is bumped by every resend instead of adding an Integration Request per
+attempt. Payloads are stored zlib-compressed, and a batch of attempts is logged
+with one upsert statement.
+
+Old logs are deleted in batches by Log Settings, after the number of days set
+there for each TIMS doctype.
+"""
+
+import base64
+import zlib
+
+import frappe
+from frappe.utils import add_days, now_datetime
+
+from .payload import dumps_payload
+
+REQUEST_LOG_DOCTYPE = "TIMS Request Log"
+COMPRESSION_LEVEL = 6
+RETENTION_BATCH_SIZE = 1000
+
+
+def log_tims_requests(url: str, payloads: dict[str, dict | str], device: str) -> None:
+    """Log an attempt to send each invoice, with a single upsert.
+
+    Invoices sent before have their log's attempts incremented and its
+    status, payload and device replaced.
+
+    Args:
+        url (str): The device endpoint the payloads are sent to
+        payloads (dict[str, dict | str]): The invoice payloads, keyed by Sales Invoice
+        device (str): The TIMS Settings of the device
+    """
+    if not payloads:
+        return
+
+    now, user = now_datetime(), frappe.session.user
+    values = [
+        (
+            invoice,
+            now,
+            now,
+            user,
+            user,
+            invoice,
+            device,
+            "Queued",
+            1,
+            now,
+            url,
+            compress_payload(payload),
+        )
+        for invoice, payload in payloads.items()
+    ]
+
+    frappe.db.sql(
+        f"""
+        INSERT INTO `tabTIMS Request Log`
+            (name, creation, modified, owner, modified_by, sales_invoice, device,
+            status, attempts, last_attempt, url, payload)
+        VALUES {", ".join(["%s"] * len(values))}
+        ON DUPLICATE KEY UPDATE
+            modified = VALUES(modified),
+            modified_by = VALUES(modified_by),
+            device = VALUES(device),
+            status = VALUES(status),
+            attempts = attempts + 1,
+            last_attempt = VALUES(last_attempt),
+            url = VALUES(url),
+            payload = VALUES(payload),
+            output = NULL,
+            error = NULL
+        """,
+        values,
+    )
+
+
+def update_request_log(
+    invoice: str,
+    status: str,
+    output: str | None = None,
+    error: str | None = None,
+) -> None:
+    """Record the outcome of the last attempt to send an invoice
+
+    Args:
+        invoice (str): The Sales Invoice, i.e. the name of its log
+        status (str): Completed, Failed or Cancelled
+        output (str | None, optional): The response body, if any. Defaults to None.
+        error (str | None, optional): The error message, if any. Defaults to None.
+    """
+    frappe.db.set_value(
+        REQUEST_LOG_DOCTYPE,
+        invoice,
+        {"status": status, "output": output, "error": error},
+        update_modified=True,
+    )
+
+
+def compress_payload(payload: dict | str | bytes) -> str:
+    """Return the payload zlib-compressed, as base64 to store in a text column"""
+    data = dumps_payload(payload)
+    if isinstance(data, str):
+        data = data.encode()
+
+    return base64.b64encode(zlib.compress(data, COMPRESSION_LEVEL)).decode()
+
+
+def decompress_payload(value: str | None) -> str | None:
+    """Return the JSON payload stored by `compress_payload`"""
+    if not value:
+        return value
+
+    return zlib.decompress(base64.b64decode(value)).decode()
+
+
+def clear_old_rows(doctype: str, days: int, filters: dict | None = None) -> None:
+    """Delete a doctype's rows last modified more than `days` ago, in batches.
+
+    Each batch is committed, so the table is never locked for long and the
+    deleted rows don't pile up in a single transaction.
+
+    Args:
+        doctype (str): The doctype to clear
+        days (int): The number of days rows are kept for
+        filters (dict | None, optional): Only delete the rows matching these. Defaults to None.
+    """
+    filters = {**(filters or {}), "modified": ["<", add_days(now_datetime(), -days)]}
+
+    while names := frappe.get_all(
+        doctype, filters=filters, pluck="name", limit=RETENTION_BATCH_SIZE
+    ):
+        frappe.db.delete(doctype, {"name": ["in", names]})
+        frappe.db.commit()
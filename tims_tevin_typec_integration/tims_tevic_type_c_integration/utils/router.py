@@ -0,0 +1,131 @@
+"""Routing of invoices across the TIMS devices of a company.
+
+A company may have several active TIMS Settings. Each can be restricted to a
+POS Profile, Warehouse and/or Branch; invoices are routed to the most specific
+devices whose restrictions they all match, falling back to the company's
+unrestricted devices. The Branch selector is only matched on sites where Sales
+Invoice has a `branch` field, e.g. as an accounting dimension.
+
+Invoices are spread across equally specific devices by rendezvous hashing, so
+an invoice always goes to the same device while it's healthy, and only the
+invoices of a device whose circuit is open are failed over to the others.
+"""
+
+import zlib
+
+import frappe
+
+from .cache import get_active_tims_settings
+from .circuit_breaker import is_circuit_open
+
+# Sales Invoice field each TIMS Settings selector is matched against
+SELECTOR_FIELDS = {
+    "pos_profile": "pos_profile",
+    "warehouse": "set_warehouse",
+    "branch": "branch",
+}
+
+
+def get_invoice_devices(invoice: frappe._dict) -> list[frappe._dict]:
+    """Return the active TIMS Settings the invoice may be sent to, in order of preference.
+
+    Args:
+        invoice (frappe._dict): The Sales Invoice, or at least its `name`, `company`,
+            selector fields and `custom_tims_device`
+
+    Returns:
+        list[frappe._dict]: The matching settings, most specific first. The
+            device the invoice was last sent to comes first among its peers.
+    """
+    groups: dict[int, list[frappe._dict]] = {}
+
+    for setting in get_active_tims_settings():
+        if setting.company != invoice.company:
+            continue
+
+        specificity = 0
+        for selector, field in SELECTOR_FIELDS.items():
+            if not setting.get(selector):
+                continue
+
+            if setting.get(selector) != invoice.get(field):
+                break
+
+            specificity += 1
+        else:
+            groups.setdefault(specificity, []).append(setting)
+
+    devices = []
+    for specificity in sorted(groups, reverse=True):
+        devices.extend(
+            sorted(
+                groups[specificity],
+                key=lambda setting: get_rank(setting, invoice),
+                reverse=True,
+            )
+        )
+
+    return devices
+
+
+def route_invoice(
+    invoice: frappe._dict,
+    devices: list[frappe._dict] | None = None,
+    unavailable: set[str] | None = None,
+) -> frappe._dict | None:
+    """Return the TIMS Settings of the device to send the invoice to.
+
+    This is the most preferred device whose circuit is closed, i.e. the invoice
+    fails over to the next device when its own is unavailable.
+
+    Args:
+        invoice (frappe._dict): The Sales Invoice
+        devices (list[frappe._dict] | None, optional): The invoice's devices, if already looked up
+        unavailable (set[str] | None, optional): Server addresses of the devices whose
+            circuit is open, if already looked up
+
+    Returns:
+        frappe._dict | None: The setting, or None if all the invoice's devices are unavailable
+    """
+    if devices is None:
+        devices = get_invoice_devices(invoice)
+
+    for setting in devices:
+        if unavailable is None:
+            if not is_circuit_open(setting.server_address):
+                return setting
+
+        elif setting.server_address not in unavailable:
+            return setting
+
+    return None
+
+
+def get_unavailable_devices() -> set[str]:
+    """Return the server addresses of the active devices whose circuit is open"""
+    return {
+        setting.server_address
+        for setting in get_active_tims_settings()
+        if is_circuit_open(setting.server_address)
+    }
+
+
+def get_routing_fields() -> list[str]:
+    """Return the Sales Invoice fields invoices are routed by, for queries"""
+    meta = frappe.get_meta("Sales Invoice")
+
+    return [
+        "name",
+        "company",
+        "custom_tims_device",
+        *(field for field in SELECTOR_FIELDS.values() if meta.has_field(field)),
+    ]
+
+
+def get_rank(setting: frappe._dict, invoice: frappe._dict) -> int:
+    # A device the invoice was already sent to must answer retries, so that
+    # it returns the Existing invoice rather than fiscalise it a second time
+    if invoice.get("custom_tims_device") == setting.name:
+        return 1 << 32
+
+    return zlib.crc32(f"{setting.name}:{invoice.name}".encode())
@@ -0,0 +1,97 @@
+"""Line taxes of Sales Invoices and Delivery Notes.
+
+Each line's tax rate is the document's, i.e. that of its first tax row, unless
+the line has an Item Tax Template with its own rate for that tax's account.
+Template rates are looked up through the TIMS cache, once per distinct template
+on the document, and the amounts are then computed for all the lines at once,
+as columns, rounded to the precision of the line amounts.
+"""
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import flt
+
+from .cache import ITEM_TAX_TEMPLATE_CACHE_KEY, TAX_TEMPLATE_CACHE_KEY, get_cached_value
+
+
+def set_line_taxes(doc: Document) -> None:
+    """Set the `custom_tax_rate` and `custom_tax_amount` of each of the document's lines"""
+    if not doc.items:
+        return
+
+    account_head, rate = get_document_tax(doc)
+
+    item_tax_templates = [item.item_tax_template for item in doc.items]
+    template_rates = {
+        template: get_item_tax_rates(template).get(account_head, rate)
+        for template in set(item_tax_templates)
+        if template
+    }
+    rates = [template_rates.get(template, rate) for template in item_tax_templates]
+
+    amounts = compute_tax_amounts(
+        [item.net_amount for item in doc.items],
+        rates,
+        doc.precision("net_amount", "items"),
+    )
+
+    for item, line_rate, amount in zip(doc.items, rates, amounts):
+        item.custom_tax_rate = line_rate
+        item.custom_tax_amount = amount
+
+
+def compute_tax_amounts(
+    net_amounts: list[float | None],
+    rates: list[float | None],
+    precision: int | None = 2,
+) -> list[float]:
+    """Return the tax of each line, rounded on its own to `precision` decimals"""
+    return [
+        flt(flt(net_amount) * rate / 100, precision) if rate else 0
+        for net_amount, rate in zip(net_amounts, rates)
+    ]
+
+
+def get_document_tax(doc: Document) -> tuple[str | None, float | None]:
+    """Return the account and rate of the document's first tax row, falling
+    back to its Sales Taxes and Charges Template's if it has no tax rows yet"""
+    if doc.get("taxes"):
+        tax = doc.taxes[0]
+        return tax.account_head, tax.rate
+
+    if not doc.taxes_and_charges:
+        return None, None
+
+    return get_template_tax(doc.taxes_and_charges)
+
+
+def get_template_tax(template: str) -> tuple[str | None, float | None]:
+    """Return the account and rate of the first row of a Sales Taxes and Charges Template"""
+    tax = get_cached_value(
+        TAX_TEMPLATE_CACHE_KEY,
+        template,
+        lambda: frappe.db.get_value(
+            "Sales Taxes and Charges",
+            {"parent": template, "parenttype": "Sales Taxes and Charges Template"},
+            ["account_head", "rate"],
+            order_by="idx asc",
+        ),
+    )
+
+    return tuple(tax) if tax else (None, None)
+
+
+def get_item_tax_rates(item_tax_template: str) -> dict[str, float]:
+    """Return the rates of an Item Tax Template, keyed by tax account"""
+    return get_cached_value(
+        ITEM_TAX_TEMPLATE_CACHE_KEY,
+        item_tax_template,
+        lambda: dict(
+            frappe.get_all(
+                "Item Tax Template Detail",
+                filters={"parent": item_tax_template, "parenttype": "Item Tax Template"},
+                fields=["tax_type", "tax_rate"],
+                as_list=True,
+            )
+        ),
+    )